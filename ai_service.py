@@ -1,7 +1,26 @@
 import json
 import os
+import re
 import logging
+import secrets
+import queue
+import random
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, date, time, timedelta
+from functools import lru_cache
+from itertools import islice
+from time import monotonic
+from types import MappingProxyType
+
+from flask import current_app
+from itsdangerous import BadData, URLSafeTimedSerializer
+
+logger = logging.getLogger(__name__)
+
 try:
     import google.generativeai as genai
     GENAI_AVAILABLE = True
@@ -12,6 +31,22 @@ except ImportError as e:
 # Configurar cliente Gemini
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 model = None
+_model_lock = threading.Lock()
+
+# Gemini só é consultado quando o classificador local não tem confiança
+CLASSIFICADOR_GEMINI_ATIVO = os.environ.get(
+    "CLASSIFICADOR_GEMINI_ATIVO", "1").lower() not in ("0", "false", "nao")
+CONFIANCA_MINIMA_CLASSIFICADOR = 0.2
+# Diferença mínima para a segunda classe: uma palavra em comum ("consulta")
+# basta para passar de 0.2, então casos ambíguos seguem para Gemini/regras
+MARGEM_MINIMA_CLASSIFICADOR = 0.1
+
+# Fração (0 a 1) das intenções resolvidas sem a IA que são conferidas pelo
+# Gemini em segundo plano; desligada por padrão (cada auditoria é uma chamada)
+try:
+    AUDITORIA_INTENCAO_TAXA = float(os.environ.get("AUDITORIA_INTENCAO_TAXA", "0"))
+except ValueError:
+    AUDITORIA_INTENCAO_TAXA = 0.0
 
 
 def _initialize_genai():
@@ -28,22 +63,483 @@ def _initialize_genai():
         )
 
     if model is None:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-1.5-flash')
+        # Evitar que requisições concorrentes criem clientes duplicados
+        with _model_lock:
+            if model is None:
+                genai.configure(api_key=GEMINI_API_KEY)
+                model = genai.GenerativeModel('gemini-1.5-flash')
 
     return model
 
 
+def aquecer_genai():
+    """Cria o cliente e faz uma chamada descartável em segundo plano,
+    para que o primeiro paciente não pague o custo da conexão inicial"""
+    if not (CLASSIFICADOR_GEMINI_ATIVO and GENAI_AVAILABLE and GEMINI_API_KEY):
+        return
+
+    def _aquecer():
+        try:
+            _initialize_genai().generate_content("ping")
+        except Exception as e:
+            logger.debug("Aquecimento do Gemini falhou: %s", e)
+
+    threading.Thread(target=_aquecer, name='aquecer-genai', daemon=True).start()
+
+
+def _compilar_palavras(palavras):
+    """Compila uma lista de palavras-chave em uma única alternação regex"""
+    return re.compile('|'.join(re.escape(palavra) for palavra in palavras))
+
+
+# Padrões de intenção compilados uma única vez (ordem = prioridade)
+PADROES_INTENCAO = (
+    ('cancelamento',
+     _compilar_palavras(['cancelar', 'desmarcar', 'remover consulta',
+                         'cancelo'])),
+    ('consulta',
+     _compilar_palavras(['meus agendamentos', 'minhas consultas',
+                         'consultar agendamento', 'ver consultas'])),
+    ('informacao',
+     _compilar_palavras(['telefone', 'endereço', 'onde fica',
+                         'horário funcionamento', 'localização'])),
+    ('fora_escopo',
+     _compilar_palavras(['clima', 'tempo', 'futebol', 'política',
+                         'receita culinária'])),
+)
+
+# Palavras-chave de sintomas -> especialidade (ordem = prioridade)
+MAPEAMENTO_SINTOMAS = {
+    'coração': 'Cardiologia',
+    'pele': 'Dermatologia',
+    'criança': 'Pediatria',
+    'neuro': 'NeuroPediatra',
+    'neurologia': 'NeuroPediatra',
+    'neurologista': 'NeuroPediatra',
+    'neuropediatra': 'NeuroPediatra',
+    'pediatra': 'NeuroPediatra',
+    'avaliação': 'Avaliação - terapia',
+    'terapia': 'Avaliação - terapia',
+    'avaliacao': 'Avaliação - terapia',
+    'mulher': 'Ginecologia',
+    'osso': 'Ortopedia',
+    'mental': 'Psiquiatria',
+    'olho': 'Oftalmologia'
+}
+# Especialidade -> nome em minúsculas, na ordem de prioridade do mapeamento
+ESPECIALIDADES_SINTOMAS = MappingProxyType({
+    especialidade: especialidade.lower()
+    for especialidade in MAPEAMENTO_SINTOMAS.values()
+})
+SINTOMAS_RE = _compilar_palavras(
+    sorted(MAPEAMENTO_SINTOMAS, key=len, reverse=True))
+
+
+@lru_cache(maxsize=32)
+def _padrao_nomes(nomes):
+    """Compila a alternação regex de uma tupla de nomes (recompila quando mudam)"""
+    if not nomes:
+        return None
+    return _compilar_palavras(sorted(nomes, key=len, reverse=True))
+
+
+def _nomes_citados(nomes, mensagem_lower):
+    """Retorna o conjunto de nomes que aparecem na mensagem"""
+    padrao = _padrao_nomes(tuple(sorted(set(filter(None, nomes)))))
+    return set(padrao.findall(mensagem_lower)) if padrao else set()
+
+
+@lru_cache(maxsize=512)
+def _sem_acentos(texto):
+    """Minúsculas sem acentos (ex.: São Paulo -> sao paulo)"""
+    texto = unicodedata.normalize('NFKD', texto.lower())
+    return texto.encode('ascii', 'ignore').decode()
+
+
+# Saudação só no início da mensagem e como palavra inteira ("foi" e
+# "Heloísa" não reiniciam a conversa)
+SAUDACAO_RE = re.compile(
+    r'^\s*(oi+|ol[áa]|hey|hello|hi|bom\s+dia|boa\s+(tarde|noite))\b',
+    re.IGNORECASE)
+CANCELAMENTO_RE = re.compile(
+    r'\b(cancelar|cancelo|cancelamento|desmarcar|remover\s+consulta)',
+    re.IGNORECASE)
+
+# Respostas nas etapas de anexo e confirmação. Palavras curtas ("s", "n",
+# "ok", "sim", "não") só contam como palavra inteira: antes, qualquer "s" na
+# mensagem confirmava o agendamento
+# Na etapa de anexo todas as categorias são buscadas em uma só passada;
+# "enviado" tem prioridade sobre "pular", que tem prioridade sobre "link"
+ANEXO_RESPOSTA_RE = re.compile(
+    r'(?P<enviado>\b(?:enviei|enviado|anexei|anexado|upload|foto|arquivo'
+    r'|pronto)|\b(?:ok|sim)\b)'
+    r'|(?P<pular>\b(?:pular|sem anexo|não tenho|nao tenho|depois)'
+    r'|\b(?:não|nao)\b)'
+    r'|(?P<link>\b(?:link|anexo))')
+CONFIRMACAO_SIM_RE = re.compile(r'\b(?:sim|s|ok)\b|\bconfirm(?:o|ar)')
+CONFIRMACAO_NAO_RE = re.compile(r'\b(?:não|nao|n)\b|\b(?:cancelar|voltar)')
+
+
+def _categoria_resposta_anexo(mensagem_lower):
+    """Classifica a resposta da etapa de anexo: enviado, pular, link ou None"""
+    categoria = None
+    for achado in ANEXO_RESPOSTA_RE.finditer(mensagem_lower):
+        if achado.lastgroup == 'enviado':
+            return 'enviado'
+        if categoria != 'pular':
+            categoria = achado.lastgroup
+    return categoria
+
+# Link de upload do pedido médico: o token assina a conversa, o horário
+# escolhido e um identificador de uso único. O upload só guarda o arquivo
+# na conversa; o agendamento é gravado apenas na confirmação pelo chat
+ANEXO_TOKEN_SALT = 'anexo-pedido-medico'
+ANEXO_TOKEN_VALIDADE = 2 * 24 * 60 * 60  # segundos
+CAMPOS_TOKEN_ANEXO = ('paciente_id', 'medico_id', 'especialidade_id',
+                      'local_id', 'data', 'hora')
+
+
+def _serializador_anexo():
+    return URLSafeTimedSerializer(current_app.secret_key,
+                                  salt=ANEXO_TOKEN_SALT)
+
+
+def gerar_token_anexo(conversa_id, **selecao):
+    """Assina a seleção de horário usada pelo link de upload"""
+    return _serializador_anexo().dumps({
+        'conversa_id': conversa_id,
+        'uso': secrets.token_hex(8),
+        'selecao': {campo: selecao.get(campo) for campo in CAMPOS_TOKEN_ANEXO},
+    })
+
+
+def ler_token_anexo(token):
+    """Retorna {'conversa_id', 'uso', 'selecao'} assinados no token,
+    ou None se inválido/expirado"""
+    try:
+        dados_token = _serializador_anexo().loads(token,
+                                                  max_age=ANEXO_TOKEN_VALIDADE)
+    except BadData:
+        return None
+    # Links no formato anterior (só a seleção) não valem mais
+    return dados_token if 'selecao' in dados_token else None
+
+# Resumo exibido antes da confirmação (com ou sem informação de anexo)
+MENSAGEM_RESUMO = (
+    "{cabecalho}"
+    "📋 **Resumo do Agendamento**\n\n"
+    "👤 **Paciente:** {paciente}\n"
+    "🩺 **Médico:** {medico}\n"
+    "🏥 **Especialidade:** {especialidade}\n"
+    "📍 **Local:** {local}\n"
+    "📅 **Data:** {data}\n"
+    "⏰ **Horário:** {hora}\n"
+    "{anexo}\n"
+    "Confirma o agendamento? Digite **'sim'** para confirmar ou **'não'** para cancelar:")
+
+# Mensagens da etapa de pedido médico (partes fixas montadas uma vez)
+MENSAGEM_ANEXO_OBRIGATORIO = (
+    "📋 **Agendamento Selecionado**\n\n"
+    "🩺 **Médico:** {medico}\n"
+    "🏥 **Especialidade:** {especialidade}\n"
+    "📅 **Data:** {data}\n"
+    "⏰ **Horário:** {hora}\n\n"
+    "🚨🚨🚨 **ATENÇÃO: PEDIDO MÉDICO OBRIGATÓRIO** 🚨🚨🚨\n\n"
+    "🛑 **IMPORTANTE:** Esta consulta requer PEDIDO MÉDICO OBRIGATÓRIO\n"
+    "🛑 **SEM O PEDIDO MÉDICO A CONSULTA NÃO PODERÁ SER REALIZADA**\n"
+    "🛑 **SEM PEDIDO MÉDICO, NÃO REALIZAMOS ATENDIMENTOS**\n"
+    "🛑 **É necessário apresentar o pedido médico para este tipo de procedimento**\n\n"
+    "📎 **ENVIE SEU PEDIDO MÉDICO AGORA:**\n"
+    "🔗 {link}\n\n"
+    "✅ **FORMAS DE ENVIO:**\n"
+    "• 📱 Clique no 📎 (anexar) no chat e selecione o arquivo\n"
+    "• 🌐 Use o link acima para upload via navegador\n"
+    "• 📷 Fotografe o pedido médico com seu celular\n"
+    "• 📄 Aceitos: PDF, JPG, PNG, DOC, DOCX\n\n"
+    "⚠️ **ATENÇÃO:** O pedido médico deve estar legível e completo\n"
+    "Após enviar o arquivo, digite **'anexo enviado'** para continuar.")
+
+MENSAGEM_LINK_ANEXO = (
+    "📎 **Link para Anexar Arquivo**\n\n"
+    "Clique no link abaixo para anexar seu arquivo:\n"
+    "🔗 {link}\n\n"
+    "Após anexar o arquivo, digite **'anexo enviado'** para continuar.")
+
+MENSAGEM_ANEXO_NAO_RECEBIDO = (
+    "📎 **Ainda não recebemos o pedido médico**\n\n"
+    "Envie o arquivo pelo link abaixo:\n"
+    "🔗 {link}\n\n"
+    "Depois digite **'anexo enviado'**, ou **'sem anexo'** para prosseguir sem ele.")
+
+MENSAGEM_ANEXO_NECESSARIO = (
+    "📎 **Anexo de Pedido Médico Necessário**\n\n"
+    "Para esta especialidade é obrigatório anexar o pedido médico.\n\n"
+    "**Como anexar:**\n"
+    "• Digite 'link' para receber link de upload\n"
+    "• Digite 'enviei' se já enviou o arquivo\n"
+    "• Digite 'sem anexo' se não tem o pedido agora\n\n"
+    "⚠️ *Sem o anexo, será necessário levar o pedido físico na consulta.*")
+
+TIPOS_MENSAGEM = ('agendamento', 'cancelamento', 'consulta', 'informacao',
+                  'fora_escopo')
+
+ESPACOS_RE = re.compile(r'\s+')
+
+# Janela de dias consultada ao gerar horários disponíveis
+DIAS_BUSCA_HORARIOS = 50
+MAX_HORARIOS_OFERECIDOS = 5
+
+# Balão de cada horário oferecido (preenchido com o dict do horário)
+BALAO_HORARIO = (
+    "📅 **{data_formatada}** ({dia_semana})\n"
+    "• **{hora_formatada}** - Dr(a). **{medico_nome}**\n"
+    "• **{especialidade}** - CRM: {crm}\n"
+    "• **Local:** {local_nome}\n"
+    "• **Duração:** {duracao} minutos")
+SEPARADOR_BALOES = "\n━━━━━━━━━━━━━━━━━━━━━━\n"
+DIAS_SEMANA = ('Segunda', 'Terça', 'Quarta', 'Quinta', 'Sexta', 'Sábado',
+               'Domingo')
+
+
+def _minutos_hhmm(hora):
+    """Converte 'HH:MM' em minutos desde a meia-noite (sem strptime)"""
+    horas, minutos = hora.split(':')
+    return int(horas) * 60 + int(minutos)
+
+
+@lru_cache(maxsize=128)
+def _slots_do_turno(hora_inicio, hora_fim, duracao):
+    """Slots ('HH:MM', time) de um turno; poucos padrões se repetem na clínica"""
+    minutos_inicio = _minutos_hhmm(hora_inicio)
+    minutos_fim = _minutos_hhmm(hora_fim)
+    return tuple((f"{m // 60:02d}:{m % 60:02d}", time(m // 60, m % 60))
+                 for m in range(minutos_inicio, minutos_fim, duracao))
+
+# Regex de extração de dados do paciente (compiladas uma única vez)
+NAO_DIGITO_RE = re.compile(r'\D')
+NAO_ALFANUMERICO_RE = re.compile(r'[\W_]+')
+EMAIL_RE = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b')
+DATA_NASCIMENTO_RE = re.compile(r'^(\d{1,2})([/.-])(\d{1,2})\2(\d{4})$')
+
+# Escolha de horário digitada pelo paciente (número, data e/ou hora)
+# Cada padrão vem com o trecho literal que ele exige: sem esse trecho na
+# mensagem, a busca por regex é pulada
+ESCOLHA_DATA_RES = (
+    ('/', re.compile(r'(\d{1,2})/(\d{1,2})')),  # 10/01
+    ('-', re.compile(r'(\d{1,2})-(\d{1,2})')),  # 10-01
+    ('.', re.compile(r'(\d{1,2})\.(\d{1,2})')),  # 10.01
+)
+# (trecho, padrão, só horas): "14 horas" não tem grupo de minutos
+ESCOLHA_HORA_RES = (
+    (':', re.compile(r'(\d{1,2}):(\d{2})'), False),  # 14:00
+    ('h', re.compile(r'(\d{1,2})h(\d{2})?'), False),  # 14h00 ou 14h
+    (' hora', re.compile(r'(\d{1,2}) horas?'), True),  # 14 horas
+)
+ESCOLHA_ESPECIFICA_RE = re.compile(
+    r'\d{1,2}[/.-]\d{1,2}|\d{1,2}:\d{2}|\d{1,2}h\d{2}?|\d{1,2}\s*horas?')
+
+# Cache LRU + TTL das classificações feitas pela IA
+INTENCAO_CACHE_TTL = 3600  # segundos
+INTENCAO_CACHE_MAXSIZE = 4096
+_intencao_cache = OrderedDict()
+_intencao_cache_lock = threading.Lock()
+
+
+def _normalizar_mensagem(mensagem):
+    """Normaliza a mensagem para uso como chave de cache"""
+    texto = unicodedata.normalize('NFKD', mensagem).lower().strip()
+    return ESPACOS_RE.sub(' ', texto)
+
+
+def _obter_intencao_cache(chave):
+    """Retorna a classificação em cache ou None se ausente/expirada"""
+    with _intencao_cache_lock:
+        item = _intencao_cache.get(chave)
+        if item is None:
+            return None
+        tipo, criado_em = item
+        if monotonic() - criado_em > INTENCAO_CACHE_TTL:
+            del _intencao_cache[chave]
+            return None
+        _intencao_cache.move_to_end(chave)
+        return tipo
+
+
+def _salvar_intencao_cache(chave, tipo):
+    """Armazena a classificação descartando as entradas mais antigas"""
+    with _intencao_cache_lock:
+        _intencao_cache[chave] = (tipo, monotonic())
+        _intencao_cache.move_to_end(chave)
+        while len(_intencao_cache) > INTENCAO_CACHE_MAXSIZE:
+            _intencao_cache.popitem(last=False)
+
+
+PROMPT_CLASSIFICACAO = """Classifique cada mensagem de paciente de uma clínica:
+agendamento=marcar consulta, saudação, sintoma; cancelamento=desmarcar; consulta=ver agendamentos; informacao=dados da clínica; fora_escopo=outros assuntos.
+Responda só "N) categoria" por linha.
+{mensagens}
+"""
+
+ROTULO_LOTE_RE = re.compile(r'^\s*(\d+)\s*[).:-]?\s*([a-z_]+)')
+
+# Micro-lotes: mensagens que chegam dentro da janela viram uma única chamada
+LOTE_JANELA_SEGUNDOS = 0.1
+LOTE_MAX_ITENS = 16
+LOTE_TIMEOUT_SEGUNDOS = 30
+_fila_classificacao = queue.Queue()
+_classificador_thread = None
+_classificador_thread_lock = threading.Lock()
+
+
+def _classificar_lote(mensagens):
+    """Classifica várias mensagens com uma única chamada ao Gemini"""
+    linhas = "\n".join(f"{i}) {ESPACOS_RE.sub(' ', mensagem).strip()}"
+                       for i, mensagem in enumerate(mensagens, 1))
+    ai_model = _initialize_genai()
+    response = ai_model.generate_content(
+        PROMPT_CLASSIFICACAO.format(mensagens=linhas), stream=True)
+
+    # Ler o stream só até ter um rótulo válido para cada mensagem
+    rotulos = {}
+    pendente = ''
+    for chunk in response:
+        pendente += (chunk.text or '').lower()
+        *completas, pendente = pendente.split('\n')
+        for linha in completas:
+            _registrar_rotulo(linha, rotulos)
+        if (len(rotulos) < len(mensagens)
+                and _registrar_rotulo(pendente, rotulos, apenas_validos=True)):
+            pendente = ''
+        if len(rotulos) >= len(mensagens):
+            break
+    else:
+        _registrar_rotulo(pendente, rotulos)
+
+    return [rotulos.get(i, '') for i in range(1, len(mensagens) + 1)]
+
+
+def _registrar_rotulo(linha, rotulos, apenas_validos=False):
+    """Interpreta uma linha 'N) categoria'; retorna True se registrou"""
+    match = ROTULO_LOTE_RE.match(linha)
+    if not match or (apenas_validos and match.group(2) not in TIPOS_MENSAGEM):
+        return False
+    rotulos[int(match.group(1))] = match.group(2)
+    return True
+
+
+def _loop_classificador_lote():
+    """Drena a fila em lotes de até LOTE_MAX_ITENS por janela"""
+    while True:
+        lote = [_fila_classificacao.get()]
+        limite = monotonic() + LOTE_JANELA_SEGUNDOS
+        while len(lote) < LOTE_MAX_ITENS:
+            restante = limite - monotonic()
+            if restante <= 0:
+                break
+            try:
+                lote.append(_fila_classificacao.get(timeout=restante))
+            except queue.Empty:
+                break
+
+        try:
+            rotulos = _classificar_lote([mensagem for mensagem, _ in lote])
+        except Exception as e:
+            for _, futuro in lote:
+                futuro.set_exception(e)
+            continue
+
+        for (_, futuro), rotulo in zip(lote, rotulos):
+            futuro.set_result(rotulo)
+
+
+def _classificar_mensagem_ia(mensagem):
+    """Enfileira a mensagem no classificador em lote e aguarda o rótulo"""
+    global _classificador_thread
+
+    # Falhar imediatamente se a IA não estiver configurada
+    _initialize_genai()
+
+    with _classificador_thread_lock:
+        if _classificador_thread is None or not _classificador_thread.is_alive():
+            _classificador_thread = threading.Thread(
+                target=_loop_classificador_lote,
+                name='classificador-intencao',
+                daemon=True)
+            _classificador_thread.start()
+
+    futuro = Future()
+    _fila_classificacao.put((mensagem, futuro))
+    return futuro.result(timeout=LOTE_TIMEOUT_SEGUNDOS)
+
+
+# Auditoria em segundo plano das intenções resolvidas sem a IA (amostrada por
+# AUDITORIA_INTENCAO_TAXA). Usa sua própria thread e chama o Gemini direto,
+# sem passar por _fila_classificacao: nunca ocupa vaga nos lotes dos pacientes
+AUDITORIA_MAX_PENDENTES = 100
+_executor_auditoria = ThreadPoolExecutor(max_workers=1,
+                                         thread_name_prefix='auditoria-intencao')
+_vagas_auditoria = threading.BoundedSemaphore(AUDITORIA_MAX_PENDENTES)
+
+
+def _auditar_intencao(mensagem, tipo_previsto, origem):
+    """Pede ao Gemini um rótulo de confirmação e registra a comparação"""
+    try:
+        tipo_ia = _classificar_lote([mensagem])[0]
+        AuditoriaIntencao.create(mensagem=mensagem,
+                                 tipo_previsto=tipo_previsto,
+                                 tipo_ia=tipo_ia or None,
+                                 origem=origem)
+        if tipo_ia and tipo_ia != tipo_previsto:
+            logger.info(
+                "Auditoria: '%s' classificou '%s' como '%s', IA sugeriu '%s'",
+                origem, mensagem, tipo_previsto, tipo_ia)
+    except Exception as e:
+        logger.debug("Auditoria de intenção ignorada: %s", e)
+    finally:
+        _vagas_auditoria.release()
+
+
+def _agendar_auditoria_intencao(mensagem, tipo_previsto, origem):
+    """Enfileira a auditoria (se sorteada) sem bloquear a resposta ao usuário"""
+    if not (AUDITORIA_INTENCAO_TAXA > 0 and CLASSIFICADOR_GEMINI_ATIVO
+            and GENAI_AVAILABLE and GEMINI_API_KEY):
+        return
+    if random.random() >= AUDITORIA_INTENCAO_TAXA:
+        return
+    # Descartar auditorias quando a fila estiver cheia
+    if not _vagas_auditoria.acquire(blocking=False):
+        return
+    _executor_auditoria.submit(_auditar_intencao, mensagem, tipo_previsto,
+                               origem)
+
+
+from classificador_intencao import classificador_intencao
+
 # Importar modelos SQLite
+from database import db
 from models import (Paciente, Local, Especialidade, Medico, HorarioDisponivel,
-                    Agendamento, Conversa, Configuracao, AgendamentoRecorrente)
+                    Agendamento, Conversa, Configuracao, AgendamentoRecorrente,
+                    AuditoriaIntencao, ArquivoPaciente)
 
 
 class ChatbotService:
     """Serviço de chatbot para agendamento médico usando Gemini"""
 
     def __init__(self):
-        pass
+        # Despacho por estado da conversa: (mensagem, conversa, dados)
+        self._handlers = {
+            'inicio': self._processar_inicio,
+            'finalizado': self._processar_inicio,
+            'aguardando_cpf': self._processar_cpf,
+            'cadastro': self._processar_cadastro,
+            'local': self._processar_local,
+            'especialidade': self._processar_especialidade,
+            'horarios': self._processar_horarios,
+            'solicitacao_anexo': self._processar_solicitacao_anexo,
+            'confirmacao': self._processar_confirmacao,
+            'cancelamento': self._processar_cancelamento,
+            'consulta_agendamentos': self._processar_cpf,
+        }
 
     def processar_mensagem(self, mensagem, conversa):
         """
@@ -61,13 +557,13 @@ class ChatbotService:
             dados = conversa.get_dados() or {}
 
             # Log para debug
-            logging.info(f"Estado atual: {estado}, Mensagem: {mensagem}")
+            logger.info("Estado atual: %s, Mensagem: %s", estado, mensagem)
 
             # MELHORIA: Detectar cancelamento em qualquer estado (exceto já cancelando)
             if estado != 'cancelamento' and self._eh_cancelamento(mensagem):
-                logging.info(
-                    f"Cancelamento detectado, mudando estado de '{estado}' para 'cancelamento'"
-                )
+                logger.info(
+                    "Cancelamento detectado, mudando estado de '%s' para 'cancelamento'",
+                    estado)
                 conversa.estado = 'cancelamento'
                 conversa.set_dados({})
                 return self._processar_cancelamento(mensagem, conversa)
@@ -75,49 +571,31 @@ class ChatbotService:
             # INTELIGÊNCIA MELHORADA: Verificar se é saudação em qualquer estado
             # Se for saudação, sempre resetar conversa para evitar estados inconsistentes
             if self._eh_saudacao(mensagem):
-                logging.info(
-                    f"Saudação detectada, resetando conversa do estado '{estado}' para 'inicio'"
-                )
+                logger.info(
+                    "Saudação detectada, resetando conversa do estado '%s' para 'inicio'",
+                    estado)
                 conversa.estado = 'inicio'
                 conversa.set_dados({})
                 return self._processar_inicio(mensagem, conversa)
 
-            if estado == 'inicio' or estado == 'finalizado':
-                return self._processar_inicio(mensagem, conversa)
-            elif estado == 'aguardando_cpf':
-                return self._processar_cpf(mensagem, conversa)
-            elif estado == 'cadastro':
-                return self._processar_cadastro(mensagem, conversa, dados)
-            elif estado == 'local':
-                return self._processar_local(mensagem, conversa)
-            elif estado == 'especialidade':
-                return self._processar_especialidade(mensagem, conversa)
-            elif estado == 'horarios':
-                return self._processar_horarios(mensagem, conversa, dados)
-            elif estado == 'solicitacao_anexo':
-                return self._processar_solicitacao_anexo(
-                    mensagem, conversa, dados)
-            elif estado == 'confirmacao':
-                return self._processar_confirmacao(mensagem, conversa, dados)
-            elif estado == 'cancelamento':
-                return self._processar_cancelamento(mensagem, conversa)
-            elif estado == 'consulta_agendamentos':
-                return self._processar_cpf(mensagem, conversa)
-            else:
-                # Resetar estado para início
-                conversa.estado = 'inicio'
-                conversa.set_dados({})
-                return self._processar_inicio(mensagem, conversa)
+            handler = self._handlers.get(estado)
+            if handler:
+                return handler(mensagem, conversa, dados)
+
+            # Resetar estado para início
+            conversa.estado = 'inicio'
+            conversa.set_dados({})
+            return self._processar_inicio(mensagem, conversa)
 
         except Exception as e:
-            logging.error(f"Erro ao processar mensagem: {e}")
+            logger.error("Erro ao processar mensagem: %s", e)
             # Resetar conversa em caso de erro
             conversa.estado = 'inicio'
             conversa.set_dados({})
             return self._resposta_erro(
                 "Desculpe, ocorreu um erro. Vamos recomeçar o atendimento.")
 
-    def _processar_inicio(self, mensagem, conversa):
+    def _processar_inicio(self, mensagem, conversa, dados=None):
         """Processa mensagem inicial e pede CPF"""
         mensagem_lower = mensagem.lower().strip()
 
@@ -144,12 +622,14 @@ class ChatbotService:
             }
         elif tipo == 'informacao':
             # Obter informações dinâmicas das configurações
-            nome_clinica = Configuracao.get_valor('nome_clinica',
-                                                  'Clínica João Layon')
-            telefone = Configuracao.get_valor('telefone_clinica',
-                                              '(31) 3333-4444')
-            horario = Configuracao.get_valor('horario_funcionamento',
-                                             'Segunda a Sexta, 8h às 18h')
+            config = Configuracao.get_muitos({
+                'nome_clinica': 'Clínica João Layon',
+                'telefone_clinica': '(31) 3333-4444',
+                'horario_funcionamento': 'Segunda a Sexta, 8h às 18h'
+            })
+            nome_clinica = config['nome_clinica']
+            telefone = config['telefone_clinica']
+            horario = config['horario_funcionamento']
 
             # Buscar locais ativos
             locais = Local.find_active()
@@ -169,12 +649,14 @@ class ChatbotService:
             }
         elif tipo == 'fora_escopo':
             # Obter informações dinâmicas das configurações
-            nome_clinica = Configuracao.get_valor('nome_clinica',
-                                                  'Clínica João Layon')
-            nome_assistente = Configuracao.get_valor('nome_assistente',
-                                                     'Assistente Virtual')
-            telefone = Configuracao.get_valor('telefone_clinica',
-                                              '(31) 3333-4444')
+            config = Configuracao.get_muitos({
+                'nome_clinica': 'Clínica João Layon',
+                'nome_assistente': 'Assistente Virtual',
+                'telefone_clinica': '(31) 3333-4444'
+            })
+            nome_clinica = config['nome_clinica']
+            nome_assistente = config['nome_assistente']
+            telefone = config['telefone_clinica']
 
             return {
                 'success': True,
@@ -203,98 +685,57 @@ class ChatbotService:
         # FALLBACK 1: Regras básicas para casos críticos
         mensagem_lower = mensagem.lower().strip()
 
-        # Palavras-chave para detecção básica
-        if any(palavra in mensagem_lower for palavra in
-               ['cancelar', 'desmarcar', 'remover consulta', 'cancelo']):
-            return 'cancelamento'
-
-        if any(palavra in mensagem_lower for palavra in [
-                'meus agendamentos', 'minhas consultas',
-                'consultar agendamento', 'ver consultas'
-        ]):
-            return 'consulta'
-
-        if any(palavra in mensagem_lower for palavra in [
-                'telefone', 'endereço', 'onde fica', 'horário funcionamento',
-                'localização'
-        ]):
-            return 'informacao'
-
-        if any(palavra in mensagem_lower for palavra in
-               ['clima', 'tempo', 'futebol', 'política', 'receita culinária']):
-            return 'fora_escopo'
+        # Palavras-chave para detecção básica (regex pré-compiladas)
+        for tipo, padrao in PADROES_INTENCAO:
+            if padrao.search(mensagem_lower):
+                _agendar_auditoria_intencao(mensagem, tipo, 'regras')
+                return tipo
+
+        # Classificador local (TF-IDF), sem chamada de rede
+        tipo_local, confianca, margem = classificador_intencao.classificar(
+            mensagem)
+        if (confianca >= CONFIANCA_MINIMA_CLASSIFICADOR
+                and margem >= MARGEM_MINIMA_CLASSIFICADOR):
+            _agendar_auditoria_intencao(mensagem, tipo_local, 'modelo_local')
+            return tipo_local
+
+        # Reaproveitar classificação recente da IA para a mesma mensagem
+        chave_cache = _normalizar_mensagem(mensagem)
+        tipo_cache = _obter_intencao_cache(chave_cache)
+        if tipo_cache:
+            return tipo_cache
 
         # FALLBACK 2: Tentar usar IA com tratamento robusto
         try:
-            prompt = f"""
-            Você é um assistente médico virtual especializado em agendamentos. Analise cuidadosamente a mensagem do usuário e classifique com máxima precisão.
+            if not CLASSIFICADOR_GEMINI_ATIVO:
+                raise RuntimeError("Classificador Gemini desativado")
 
-            Mensagem do usuário: "{mensagem}"
-            
-            Classifique a mensagem em uma das categorias, considerando contexto, intenção e nuances:
-            
-            1. "agendamento" - Qualquer intenção de agendar consulta, marcar horário, saudações iniciais (oi, olá, boa tarde), pedidos de ajuda para marcar consulta, menções de sintomas ou necessidade médica
-            
-            2. "cancelamento" - Intenção clara de cancelar, desmarcar ou remover agendamento existente
-            
-            3. "consulta" - Quer verificar, ver, listar seus agendamentos ou consultas já marcadas
-            
-            4. "informacao" - Perguntas sobre a clínica (telefone, endereço, horários de funcionamento, médicos disponíveis, especialidades oferecidas, localização)
-            
-            5. "fora_escopo" - Conversas casuais não relacionadas à clínica, perguntas pessoais, assuntos não médicos ou de agendamento
-            
-            Exemplos:
-            - "oi" → agendamento
-            - "preciso de uma consulta" → agendamento  
-            - "estou com dor de cabeça" → agendamento
-            - "quero cancelar minha consulta" → cancelamento
-            - "quais são meus agendamentos?" → consulta
-            - "qual o telefone da clínica?" → informacao
-            - "como está o tempo?" → fora_escopo
-            
-            Responda APENAS com uma palavra: agendamento, cancelamento, consulta, informacao, fora_escopo
-            """
-
-            ai_model = _initialize_genai()
-            response = ai_model.generate_content(prompt)
-
-            resultado = response.text.strip().lower(
-            ) if response.text else "agendamento"
+            # Mensagens concorrentes são agrupadas em uma única chamada
+            resultado = _classificar_mensagem_ia(mensagem)
 
             # Validar resposta da IA
-            if resultado in [
-                    'agendamento', 'cancelamento', 'consulta', 'informacao',
-                    'fora_escopo'
-            ]:
-                logging.info(
-                    f"IA detectou tipo '{resultado}' para mensagem: '{mensagem}'"
-                )
+            if resultado in TIPOS_MENSAGEM:
+                logger.info(
+                    "IA detectou tipo '%s' para mensagem: '%s'",
+                    resultado, mensagem)
+                _salvar_intencao_cache(chave_cache, resultado)
                 return resultado
             else:
-                logging.warning(
-                    f"IA retornou valor inválido '{resultado}', usando fallback"
-                )
+                logger.warning(
+                    "IA retornou valor inválido '%s', usando fallback",
+                    resultado)
                 return 'agendamento'  # Fallback padrão
 
         except Exception as e:
-            logging.warning(
-                f"IA temporariamente indisponível: {e}. Usando fallback inteligente."
-            )
-
-            # FALLBACK 3: Lógica heurística avançada
-            # Saudações e sintomas -> agendamento
-            if any(palavra in mensagem_lower for palavra in [
-                    'oi', 'olá', 'ola', 'bom dia', 'boa tarde', 'boa noite',
-                    'hello', 'hi', 'dor', 'problema', 'consulta', 'médico',
-                    'doutor', 'sintoma', 'doença', 'preciso', 'quero marcar',
-                    'agendar', 'emergência'
-            ]):
-                return 'agendamento'
-
-            # Se nada se encaixar, assumir agendamento (mais seguro)
+            logger.warning(
+                "IA temporariamente indisponível: %s. Usando fallback inteligente.",
+                e)
+
+            # FALLBACK 3: saudações, sintomas e qualquer outra mensagem
+            # são tratados como agendamento (mais seguro)
             return 'agendamento'
 
-    def _processar_cpf(self, mensagem, conversa):
+    def _processar_cpf(self, mensagem, conversa, dados=None):
         """Processa CPF e verifica se existe no sistema"""
         # Extrair CPF da mensagem
         cpf = self._extrair_cpf(mensagem)
@@ -312,7 +753,7 @@ class ChatbotService:
         paciente = Paciente.find_by_cpf(cpf)
 
         # Verificar o que o usuário quer fazer baseado no estado anterior
-        dados_temp = conversa.get_dados() or {}
+        dados_temp = dados if dados is not None else conversa.get_dados() or {}
         acao_desejada = dados_temp.get('acao_desejada', 'agendar')
 
         if paciente:
@@ -402,8 +843,8 @@ class ChatbotService:
                 # Converter data para string para serialização JSON
                 dados['data_nascimento'] = data_nascimento.strftime('%Y-%m-%d')
                 dados['etapa_cadastro'] = 'telefone'
-                logging.info(
-                    f"Data armazenada nos dados: {dados['data_nascimento']}")
+                logger.info(
+                    "Data armazenada nos dados: %s", dados['data_nascimento'])
                 conversa.set_dados(dados)
 
                 return {
@@ -481,7 +922,7 @@ class ChatbotService:
                     'particular', 'nao', 'não', 'sem plano', 'pular'
             ]:
                 # Validar se é um número de carteirinha válido
-                carteirinha_limpa = ''.join(c for c in mensagem if c.isalnum())
+                carteirinha_limpa = NAO_ALFANUMERICO_RE.sub('', mensagem)
                 if len(carteirinha_limpa
                        ) >= 6:  # Mínimo 6 caracteres para carteirinha
                     carteirinha = carteirinha_limpa[:
@@ -529,7 +970,7 @@ class ChatbotService:
                     'proximo_estado': 'local'
                 }
             except Exception as e:
-                logging.error(f"Erro ao salvar paciente: {e}")
+                logger.error("Erro ao salvar paciente: %s", e)
                 return {
                     'success': False,
                     'message':
@@ -538,27 +979,34 @@ class ChatbotService:
                     'proximo_estado': 'inicio'
                 }
 
-    def _processar_local(self, mensagem, conversa):
+    def _processar_local(self, mensagem, conversa, dados=None):
         """Processa seleção de local de atendimento - FALLBACK PRIMEIRO"""
         # Buscar locais ativos
         locais = Local.find_active()
 
-        # PRIMEIRO: Tentar detecção direta (sem IA)
-        mensagem_lower = mensagem.lower().strip()
+        # PRIMEIRO: Tentar detecção direta (sem IA), ignorando acentos
+        mensagem_norm = _sem_acentos(mensagem.strip())
         local_escolhido = None
+        nomes = [(local, _sem_acentos(local.nome),
+                  _sem_acentos(local.cidade or '')) for local in locais]
+
+        # Nomes/cidades citados na mensagem (uma única busca regex)
+        citados = _nomes_citados(
+            [nome for _, nome, _ in nomes] + [cidade for _, _, cidade in nomes],
+            mensagem_norm)
 
-        for local in locais:
+        for local, nome, cidade in nomes:
             # Busca exata pelo nome ou cidade
-            if (local.nome.lower() in mensagem_lower or
-                (local.cidade and local.cidade.lower() in mensagem_lower)
-                    or mensagem_lower in local.nome.lower() or
-                (local.cidade and mensagem_lower in local.cidade.lower())):
+            if (nome in citados or cidade in citados
+                    or mensagem_norm in nome
+                    or (cidade and mensagem_norm in cidade)):
                 local_escolhido = local
                 break
 
         if local_escolhido:
             # Salvar local escolhido
-            dados = conversa.get_dados() or {}
+            if dados is None:
+                dados = conversa.get_dados() or {}
             dados['local_id'] = local_escolhido.id
             dados['local_nome'] = local_escolhido.nome
             conversa.set_dados(dados)
@@ -584,24 +1032,16 @@ class ChatbotService:
             'proximo_estado': 'local'
         }
 
-    def _processar_especialidade(self, mensagem, conversa):
+    def _processar_especialidade(self, mensagem, conversa, dados=None):
         """Processa seleção de especialidade - FALLBACK PRIMEIRO"""
         # Buscar especialidades que têm médicos disponíveis no local escolhido
-        dados = conversa.get_dados() or {}
+        if dados is None:
+            dados = conversa.get_dados() or {}
         local_id = dados.get('local_id')
 
         if local_id:
             # Buscar apenas especialidades que têm médicos com horários no local escolhido
-            from database import db
-            query = """
-                SELECT DISTINCT e.* FROM especialidades e
-                JOIN medicos m ON e.id = m.especialidade_id
-                JOIN horarios_disponiveis h ON m.id = h.medico_id
-                WHERE h.local_id = ? AND e.ativo = 1 AND m.ativo = 1 AND h.ativo = 1
-            """
-            rows = db.execute_query(query.replace('?', str(local_id)))
-            especialidades = [Especialidade(**dict(row))
-                              for row in rows] if rows else []
+            especialidades = Especialidade.find_active_by_local(local_id)
         else:
             # Fallback para todas as especialidades se não tiver local
             especialidades = Especialidade.find_active()
@@ -610,55 +1050,37 @@ class ChatbotService:
         mensagem_lower = mensagem.lower().strip()
         especialidade_escolhida = None
 
+        # Nomes em minúsculas calculados uma vez para as duas buscas
+        nomes = [(esp, esp.nome.lower()) for esp in especialidades]
+
         # Busca exata pelo nome da especialidade
-        for esp in especialidades:
-            if (esp.nome.lower() in mensagem_lower
-                    or mensagem_lower in esp.nome.lower()):
+        citados = _nomes_citados([nome for _, nome in nomes], mensagem_lower)
+        for esp, nome in nomes:
+            if nome in citados or mensagem_lower in nome:
                 especialidade_escolhida = esp
                 break
 
         # Busca por palavras-chave relacionadas se não encontrou
         if not especialidade_escolhida:
-            mapeamento_sintomas = {
-                'coração': 'Cardiologia',
-                'pele': 'Dermatologia',
-                'criança': 'Pediatria',
-                'neuro': 'NeuroPediatra',
-                'neurologia': 'NeuroPediatra',
-                'neurologista': 'NeuroPediatra',
-                'neuropediatra': 'NeuroPediatra',
-                'pediatra': 'NeuroPediatra',
-                'avaliação': 'Avaliação - terapia',
-                'terapia': 'Avaliação - terapia',
-                'avaliacao': 'Avaliação - terapia',
-                'mulher': 'Ginecologia',
-                'osso': 'Ortopedia',
-                'mental': 'Psiquiatria',
-                'olho': 'Oftalmologia'
+            alvos = {
+                MAPEAMENTO_SINTOMAS[palavra]
+                for palavra in SINTOMAS_RE.findall(mensagem_lower)
             }
-
-            for palavra, especialidade_nome in mapeamento_sintomas.items():
-                if palavra in mensagem_lower:
-                    for esp in especialidades:
-                        if especialidade_nome.lower() in esp.nome.lower():
-                            especialidade_escolhida = esp
-                            break
-                    if especialidade_escolhida:
-                        break
+            especialidade_escolhida = next(
+                (esp for alvo in ESPECIALIDADES_SINTOMAS if alvo in alvos
+                 for esp, nome in nomes if ESPECIALIDADES_SINTOMAS[alvo] in nome),
+                None)
 
         if especialidade_escolhida:
             # Salvar especialidade escolhida
-            dados = conversa.get_dados() or {}
             dados['especialidade_id'] = especialidade_escolhida.id
             dados['especialidade_nome'] = especialidade_escolhida.nome
             conversa.set_dados(dados)
             conversa.estado = 'horarios'
 
             # Buscar médicos da especialidade
-            medicos_especialidade = [
-                m for m in Medico.find_active()
-                if m.especialidade_id == especialidade_escolhida.id
-            ]
+            medicos_especialidade = Medico.find_by_especialidade(
+                especialidade_escolhida.id)
 
             if not medicos_especialidade:
                 return {
@@ -701,40 +1123,31 @@ class ChatbotService:
         especialidade_id = dados.get('especialidade_id')
 
         # DEBUG: Log para entender o que está acontecendo
-        logging.info(
-            f"DEBUG _processar_horarios: local_id={local_id}, especialidade_id={especialidade_id}, dados={dados}"
-        )
+        logger.debug(
+            "_processar_horarios: local_id=%s, especialidade_id=%s, dados=%s",
+            local_id, especialidade_id, dados)
 
         if not local_id or not especialidade_id:
             conversa.estado = 'inicio'
             conversa.set_dados({})
             return self._resposta_erro("Erro nos dados. Vamos recomeçar.")
 
-        # Buscar médicos da especialidade
-        from database import db
-        query = """
-            SELECT m.*, h.* FROM medicos m
-            JOIN horarios_disponiveis h ON m.id = h.medico_id
-            WHERE m.especialidade_id = ? AND h.local_id = ? AND m.ativo = 1 AND h.ativo = 1
-        """
-        rows = db.execute_query(query, (especialidade_id, local_id))
+        # Buscar médicos da especialidade (cache invalidado ao salvar médicos/horários)
+        rows = HorarioDisponivel.find_grade(especialidade_id, local_id)
 
         # DEBUG: Log do resultado da query
-        logging.info(
-            f"DEBUG query result: encontrou {len(rows) if rows else 0} registros"
-        )
-        if rows:
-            logging.info(f"DEBUG primeiro registro: {dict(rows[0])}")
+        logger.debug(
+            "query result: encontrou %s registros", len(rows) if rows else 0)
+        if rows and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("primeiro registro: %s", dict(rows[0]))
 
         if not rows:
-            logging.error(
-                f"ERRO: Nenhum médico/horário encontrado para especialidade_id={especialidade_id}, local_id={local_id}"
-            )
+            logger.error(
+                "ERRO: Nenhum médico/horário encontrado para especialidade_id=%s, local_id=%s",
+                especialidade_id, local_id)
             # Verificar se o problema é falta de médicos ou falta de horários
-            medicos_especialidade = [
-                m for m in Medico.find_active()
-                if m.especialidade_id == especialidade_id
-            ]
+            medicos_especialidade = Medico.find_by_especialidade(
+                especialidade_id)
             if not medicos_especialidade:
                 return {
                     'success': False,
@@ -780,10 +1193,10 @@ class ChatbotService:
                                                     horarios_disponiveis)
 
         # DEBUG: Log da escolha interpretada
-        logging.info(
-            f"DEBUG _processar_horarios: mensagem='{mensagem}', escolha={escolha}"
-        )
-        logging.info(f"DEBUG dados atuais antes da escolha: {dados}")
+        logger.debug(
+            "_processar_horarios: mensagem='%s', escolha=%s",
+            mensagem, escolha)
+        logger.debug("dados atuais antes da escolha: %s", dados)
 
         if escolha:
             # Salvar escolha e ir para confirmação
@@ -806,50 +1219,21 @@ class ChatbotService:
             conversa.set_dados(dados)
 
             # Verificar se a especialidade requer anexo
-            especialidade = Especialidade.find_by_id(especialidade_id)
+            especialidade = Especialidade.find_by_id_cached(especialidade_id)
             if especialidade and getattr(especialidade, 'requer_anexo', False):
-                # Criar agendamento temporário para gerar link de upload imediatamente
-                temp_agendamento = Agendamento.create(
-                    paciente_id=conversa.paciente_id,
-                    medico_id=escolha['medico_id'],
-                    especialidade_id=especialidade_id,
-                    local_id=escolha.get('local_id'),
-                    data=escolha['data'],
-                    hora=escolha['hora'],
-                    status='pendente_anexo')
-
-                dados['agendamento_temp_id'] = temp_agendamento.id
-                conversa.set_dados(dados)
                 conversa.estado = 'solicitacao_anexo'
-
-                # Gerar link para upload
-                upload_link = f"/anexar-arquivo/{temp_agendamento.id}"
+                upload_link = self._link_anexo(conversa, dados)
 
                 return {
                     'success':
                     True,
                     'message':
-                    f"📋 **Agendamento Selecionado**\n\n" +
-                    f"🩺 **Médico:** {escolha['medico_nome']}\n" +
-                    f"🏥 **Especialidade:** {especialidade.nome}\n" +
-                    f"📅 **Data:** {escolha['data_formatada']}\n" +
-                    f"⏰ **Horário:** {escolha['hora_formatada']}\n\n" +
-                    f"🚨🚨🚨 **ATENÇÃO: PEDIDO MÉDICO OBRIGATÓRIO** 🚨🚨🚨\n\n" +
-                    f"🛑 **IMPORTANTE:** Esta consulta requer PEDIDO MÉDICO OBRIGATÓRIO\n"
-                    +
-                    f"🛑 **SEM O PEDIDO MÉDICO A CONSULTA NÃO PODERÁ SER REALIZADA**\n"
-                    +
-                    f"🛑 **SEM PEDIDO MÉDICO, NÃO REALIZAMOS ATENDIMENTOS**\n" +
-                    f"🛑 **É necessário apresentar o pedido médico para este tipo de procedimento**\n\n"
-                    + f"📎 **ENVIE SEU PEDIDO MÉDICO AGORA:**\n" +
-                    f"🔗 {upload_link}\n\n" + f"✅ **FORMAS DE ENVIO:**\n" +
-                    f"• 📱 Clique no 📎 (anexar) no chat e selecione o arquivo\n"
-                    + f"• 🌐 Use o link acima para upload via navegador\n" +
-                    f"• 📷 Fotografe o pedido médico com seu celular\n" +
-                    f"• 📄 Aceitos: PDF, JPG, PNG, DOC, DOCX\n\n" +
-                    f"⚠️ **ATENÇÃO:** O pedido médico deve estar legível e completo\n"
-                    +
-                    f"Após enviar o arquivo, digite **'anexo enviado'** para continuar.",
+                    MENSAGEM_ANEXO_OBRIGATORIO.format(
+                        medico=escolha['medico_nome'],
+                        especialidade=especialidade.nome,
+                        data=escolha['data_formatada'],
+                        hora=escolha['hora_formatada'],
+                        link=upload_link),
                     'tipo':
                     'solicitacao_anexo',
                     'proximo_estado':
@@ -858,21 +1242,11 @@ class ChatbotService:
             else:
                 conversa.estado = 'confirmacao'
 
-            paciente = Paciente.find_by_id(conversa.paciente_id)
-            local = Local.find_by_id(local_id)
-
             return {
                 'success':
                 True,
                 'message':
-                f"📋 **Resumo do Agendamento**\n\n" +
-                f"👤 **Paciente:** {paciente.nome if paciente else 'N/A'}\n" +
-                f"🩺 **Médico:** {escolha['medico_nome']}\n" +
-                f"🏥 **Especialidade:** {especialidade.nome if especialidade else 'N/A'}\n"
-                + f"📍 **Local:** {local.nome if local else 'N/A'}\n" +
-                f"📅 **Data:** {escolha['data_formatada']}\n" +
-                f"⏰ **Horário:** {escolha['hora_formatada']}\n\n" +
-                f"Confirma o agendamento? Digite **'sim'** para confirmar ou **'não'** para cancelar:",
+                self._mensagem_resumo(conversa, dados),
                 'tipo':
                 'confirmacao',
                 'proximo_estado':
@@ -887,8 +1261,8 @@ class ChatbotService:
                 'success':
                 True,
                 'message':
-                f"📅 **Horários Disponíveis:**\n\n{horarios_texto}\n\n" +
-                f"Digite a **data e horário** desejados (ex: '10/01 às 14:00' ou 'amanhã 9h'):",
+                (f"📅 **Horários Disponíveis:**\n\n{horarios_texto}\n\n"
+                 f"Digite a **data e horário** desejados (ex: '10/01 às 14:00' ou 'amanhã 9h'):"),
                 'tipo':
                 'horarios',
                 'horarios':
@@ -899,104 +1273,66 @@ class ChatbotService:
 
     def _processar_solicitacao_anexo(self, mensagem, conversa, dados):
         """Processa solicitação de anexo de pedido médico"""
-        # Verificar se o usuário quer pular o anexo (por enquanto, implementaremos depois)
         mensagem_lower = mensagem.lower().strip()
 
-        # Por enquanto, vamos aceitar qualquer mensagem como "anexo enviado"
-        # TODO: Implementar upload real de arquivos
-        if any(palavra in mensagem_lower for palavra in [
-                'enviei', 'enviado', 'anexei', 'anexado', 'upload', 'foto',
-                'arquivo', 'ok', 'pronto', 'sim'
-        ]):
-            # Simular que o anexo foi recebido
-            dados['anexo_recebido'] = True
-            dados[
-                'anexo_nome'] = f"pedido_medico_{dados.get('paciente_id', 'user')}"
-            conversa.set_dados(dados)
+        # O arquivo chega pelo link (/anexar-pedido/<token>) ou pelo upload do
+        # chat, que gravam anexo_path nos dados; aqui só se lê a resposta
+        categoria = _categoria_resposta_anexo(mensagem_lower)
+        if categoria == 'enviado' and not dados.get('anexo_path'):
+            # O arquivo (pelo link ou pelo chat) ainda não chegou
+            return {
+                'success':
+                True,
+                'message':
+                MENSAGEM_ANEXO_NAO_RECEBIDO.format(
+                    link=self._link_anexo(conversa, dados)),
+                'tipo':
+                'solicitacao_anexo',
+                'proximo_estado':
+                'solicitacao_anexo'
+            }
+        elif categoria == 'enviado':
             conversa.estado = 'confirmacao'
 
             # Mostrar confirmação com anexo
-            paciente = Paciente.find_by_id(conversa.paciente_id)
-            local = Local.find_by_id(dados.get('local_id'))
-            especialidade = Especialidade.find_by_id(
-                dados.get('especialidade_id'))
-
             return {
                 'success':
                 True,
                 'message':
-                f"✅ **Anexo Recebido!**\n\n" +
-                f"📋 **Resumo do Agendamento**\n\n" +
-                f"👤 **Paciente:** {paciente.nome if paciente else 'N/A'}\n" +
-                f"🩺 **Médico:** {dados.get('medico_nome', 'N/A')}\n" +
-                f"🏥 **Especialidade:** {especialidade.nome if especialidade else 'N/A'}\n"
-                + f"📍 **Local:** {local.nome if local else 'N/A'}\n" +
-                f"📅 **Data:** {dados.get('data_formatada', 'N/A')}\n" +
-                f"⏰ **Horário:** {dados.get('hora_formatada', 'N/A')}\n" +
-                f"📎 **Anexo:** ✅ Pedido médico recebido\n\n" +
-                f"Confirma o agendamento? Digite **'sim'** para confirmar ou **'não'** para cancelar:",
+                self._mensagem_resumo(
+                    conversa, dados,
+                    cabecalho="✅ **Anexo Recebido!**\n\n",
+                    anexo="📎 **Anexo:** ✅ Pedido médico recebido\n"),
                 'tipo':
                 'confirmacao',
                 'proximo_estado':
                 'confirmacao'
             }
-        elif any(palavra in mensagem_lower for palavra in [
-                'pular', 'sem anexo', 'não tenho', 'nao tenho', 'depois',
-                'não', 'nao'
-        ]):
-            # Permitir prosseguir sem anexo (por enquanto)
+        elif categoria == 'pular':
+            # Prosseguir sem anexo: o pedido físico é levado na consulta
             conversa.estado = 'confirmacao'
 
-            paciente = Paciente.find_by_id(conversa.paciente_id)
-            local = Local.find_by_id(dados.get('local_id'))
-            especialidade = Especialidade.find_by_id(
-                dados.get('especialidade_id'))
-
             return {
                 'success':
                 True,
                 'message':
-                f"⚠️ **Prosseguindo sem anexo**\n\n" +
-                f"📋 **Resumo do Agendamento**\n\n" +
-                f"👤 **Paciente:** {paciente.nome if paciente else 'N/A'}\n" +
-                f"🩺 **Médico:** {dados.get('medico_nome', 'N/A')}\n" +
-                f"🏥 **Especialidade:** {especialidade.nome if especialidade else 'N/A'}\n"
-                + f"📍 **Local:** {local.nome if local else 'N/A'}\n" +
-                f"📅 **Data:** {dados.get('data_formatada', 'N/A')}\n" +
-                f"⏰ **Horário:** {dados.get('hora_formatada', 'N/A')}\n" +
-                f"📎 **Anexo:** ⚠️ Será necessário levar o pedido físico\n\n" +
-                f"Confirma o agendamento? Digite **'sim'** para confirmar ou **'não'** para cancelar:",
+                self._mensagem_resumo(
+                    conversa, dados,
+                    cabecalho="⚠️ **Prosseguindo sem anexo**\n\n",
+                    anexo="📎 **Anexo:** ⚠️ Será necessário levar o pedido físico\n"),
                 'tipo':
                 'confirmacao',
                 'proximo_estado':
                 'confirmacao'
             }
-        elif any(palavra in mensagem_lower
-                 for palavra in ['link', 'upload', 'anexo']):
-            # Criar agendamento temporário para gerar link de upload
-            temp_agendamento = Agendamento.create(
-                paciente_id=conversa.paciente_id,
-                medico_id=dados.get('medico_id'),
-                especialidade_id=dados.get('especialidade_id'),
-                local_id=dados.get('local_id'),
-                data=dados.get('data'),
-                hora=dados.get('hora'),
-                status='pendente_anexo')
-
-            dados['agendamento_temp_id'] = temp_agendamento.id
-            conversa.set_dados(dados)
-
-            # Gerar link para upload (usar URL real da aplicação)
-            upload_link = f"/anexar-arquivo/{temp_agendamento.id}"
+        elif categoria == 'link':
+            upload_link = self._link_anexo(conversa, dados)
 
             return {
                 'success':
                 True,
                 'message':
-                f"📎 **Link para Anexar Arquivo**\n\n" +
-                f"Clique no link abaixo para anexar seu arquivo:\n" +
-                f"🔗 {upload_link}\n\n" +
-                f"Após anexar o arquivo, digite **'anexo enviado'** para continuar.",
+                MENSAGEM_LINK_ANEXO.format(link=upload_link),
                 'tipo':
                 'solicitacao_anexo',
                 'proximo_estado':
@@ -1008,90 +1344,146 @@ class ChatbotService:
                 'success':
                 True,
                 'message':
-                f"📎 **Anexo de Pedido Médico Necessário**\n\n" +
-                f"Para esta especialidade é obrigatório anexar o pedido médico.\n\n"
-                + f"**Como anexar:**\n" +
-                f"• Digite 'link' para receber link de upload\n" +
-                f"• Digite 'enviei' se já enviou o arquivo\n" +
-                f"• Digite 'sem anexo' se não tem o pedido agora\n\n" +
-                f"⚠️ *Sem o anexo, será necessário levar o pedido físico na consulta.*",
+                MENSAGEM_ANEXO_NECESSARIO,
                 'tipo':
                 'solicitacao_anexo',
                 'proximo_estado':
                 'solicitacao_anexo'
             }
 
+    def _link_anexo(self, conversa, dados):
+        """Link de upload do pedido médico para o horário selecionado"""
+        token = gerar_token_anexo(conversa.id,
+                                  paciente_id=conversa.paciente_id,
+                                  medico_id=dados.get('medico_id'),
+                                  especialidade_id=dados.get('especialidade_id'),
+                                  local_id=dados.get('local_id'),
+                                  data=dados.get('data_agendamento'),
+                                  hora=dados.get('hora_agendamento'))
+        return f"/anexar-pedido/{token}"
+
+    def _mensagem_resumo(self, conversa, dados, cabecalho='', anexo=''):
+        """Monta o resumo do agendamento exibido antes da confirmação"""
+        paciente = Paciente.find_by_id(conversa.paciente_id)
+        # Locais e especialidades mudam pouco: leitura pelo cache TTL
+        local = Local.find_by_id_cached(dados.get('local_id'))
+        especialidade = Especialidade.find_by_id_cached(
+            dados.get('especialidade_id'))
+        return MENSAGEM_RESUMO.format(
+            cabecalho=cabecalho,
+            paciente=paciente.nome if paciente else 'N/A',
+            medico=dados.get('medico_nome', 'N/A'),
+            especialidade=especialidade.nome if especialidade else 'N/A',
+            local=local.nome if local else 'N/A',
+            data=dados.get('data_formatada', 'N/A'),
+            hora=dados.get('hora_formatada', 'N/A'),
+            anexo=anexo)
+
     def _processar_confirmacao(self, mensagem, conversa, dados):
         """Processa confirmação do agendamento"""
         mensagem_lower = mensagem.lower().strip()
 
-        if any(palavra in mensagem_lower
-               for palavra in ['sim', 's', 'confirmo', 'ok', 'confirmar']):
+        if CONFIRMACAO_SIM_RE.search(mensagem_lower):
             # Confirmar agendamento
             try:
                 # Preparar informações do anexo se presente
                 anexo_nome = dados.get('anexo_nome', '')
-                anexo_path = ''
+                anexo_path = dados.get('anexo_path', '')
                 observacoes = ""
 
                 if dados.get('anexo_recebido'):
                     observacoes = "✅ Pedido médico anexado via chatbot"
-                    anexo_path = f"anexos/{anexo_nome}"
                 elif not anexo_nome:
                     # Verificar se especialidade requer anexo mas não foi enviado
-                    especialidade = Especialidade.find_by_id(
+                    especialidade = Especialidade.find_by_id_cached(
                         dados['especialidade_id'])
                     if especialidade and getattr(especialidade, 'requer_anexo',
                                                  False):
                         observacoes = "⚠️ Especialidade requer pedido médico - levar documento físico"
 
-                agendamento = Agendamento.create(
-                    paciente_id=conversa.paciente_id,
-                    medico_id=dados['medico_id'],
-                    especialidade_id=dados['especialidade_id'],
-                    local_id=dados['local_id'],
-                    data=dados['data_agendamento'],
-                    hora=dados['hora_agendamento'],
-                    observacoes=observacoes,
-                    anexo_nome=anexo_nome,
-                    anexo_path=anexo_path)
+                # Checagem do horário e gravação na mesma transação (BEGIN
+                # IMMEDIATE): dois pacientes não confirmam o mesmo horário.
+                # A grade exibida vem de cache, então médico ativo e horário
+                # de atendimento também são conferidos de novo no banco
+                data_escolhida = date.fromisoformat(dados['data_agendamento'])
+                with db.transacao():
+                    if not (HorarioDisponivel.atende(
+                                dados['medico_id'], dados['local_id'],
+                                data_escolhida, dados['hora_agendamento'])
+                            and self._verificar_disponibilidade_slot(
+                                dados['medico_id'], data_escolhida,
+                                time.fromisoformat(dados['hora_agendamento']))):
+                        conversa.estado = 'horarios'
+                        return {
+                            'success': False,
+                            'message':
+                            "Este horário não está mais disponível. Vou mostrar outros horários disponíveis:",
+                            'tipo': 'horarios',
+                            'proximo_estado': 'horarios'
+                        }
+
+                    agendamento = Agendamento.create(
+                        paciente_id=conversa.paciente_id,
+                        medico_id=dados['medico_id'],
+                        especialidade_id=dados['especialidade_id'],
+                        local_id=dados['local_id'],
+                        data=dados['data_agendamento'],
+                        hora=dados['hora_agendamento'],
+                        observacoes=observacoes,
+                        anexo_nome=anexo_nome,
+                        anexo_path=anexo_path)
+
+                    # Vincular o arquivo enviado (chat ou link) ao agendamento gravado
+                    arquivo = dados.get('arquivo_id') and ArquivoPaciente.find_by_id(
+                        dados['arquivo_id'])
+                    if arquivo:
+                        arquivo.update_fields(agendamento_id=agendamento.id)
 
                 conversa.estado = 'finalizado'
                 conversa.set_dados({})
 
-                paciente = Paciente.find_by_id(conversa.paciente_id)
-                local = Local.find_by_id(dados['local_id'])
+                # Paciente e local do resumo em uma única consulta
+                rows = db.execute_query(
+                    """
+                    SELECT p.nome AS paciente_nome, l.nome AS local_nome,
+                           l.endereco, l.cidade, l.telefone
+                    FROM pacientes p
+                    LEFT JOIN locais l ON l.id = ?
+                    WHERE p.id = ?
+                    """, (dados['local_id'], conversa.paciente_id))
+                resumo = rows[0] if rows else None
+                paciente_nome = resumo['paciente_nome'] if resumo else 'N/A'
+                local_nome = (resumo['local_nome'] if resumo else None) or 'N/A'
 
                 # Buscar endereço completo do local
                 endereco_completo = "Endereço não disponível"
-                if local:
+                if resumo and resumo['local_nome']:
                     endereco_parts = []
-                    if hasattr(local, 'endereco') and local.endereco:
-                        endereco_parts.append(local.endereco)
-                    if hasattr(local, 'cidade') and local.cidade:
-                        endereco_parts.append(local.cidade)
-                    if hasattr(local, 'telefone') and local.telefone:
-                        endereco_parts.append(f"Tel: {local.telefone}")
+                    if resumo['endereco']:
+                        endereco_parts.append(resumo['endereco'])
+                    if resumo['cidade']:
+                        endereco_parts.append(resumo['cidade'])
+                    if resumo['telefone']:
+                        endereco_parts.append(f"Tel: {resumo['telefone']}")
                     endereco_completo = ", ".join(
-                        endereco_parts) if endereco_parts else local.nome
+                        endereco_parts) if endereco_parts else local_nome
 
                 return {
                     'success':
                     True,
                     'message':
-                    f"✅ **Agendamento Confirmado!**\n\n" +
-                    f"📋 **Número:** #{agendamento.id}\n" +
-                    f"👤 **Paciente:** {paciente.nome if paciente else 'N/A'}\n"
-                    + f"🩺 **Médico:** {dados['medico_nome']}\n" +
-                    f"🏥 **Especialidade:** {dados['especialidade_nome']}\n" +
-                    f"📍 **Local:** {local.nome if local else 'N/A'}\n" +
-                    f"🗺️ **Endereço:** {endereco_completo}\n" +
-                    f"📅 **Data:** {dados['data_formatada']}\n" +
-                    f"⏰ **Horário:** {dados['hora_formatada']}\n\n" +
-                    f"📸 **IMPORTANTE:** Faça um print (captura de tela) desta mensagem para guardar as informações do seu agendamento!\n\n"
-                    +
-                    f"📞 Em caso de dúvidas, entre em contato com a clínica.\n\n"
-                    + f"Obrigado por usar nosso sistema! 😊",
+                    (f"✅ **Agendamento Confirmado!**\n\n"
+                     f"📋 **Número:** #{agendamento.id}\n"
+                     f"👤 **Paciente:** {paciente_nome}\n"
+                     f"🩺 **Médico:** {dados['medico_nome']}\n"
+                     f"🏥 **Especialidade:** {dados['especialidade_nome']}\n"
+                     f"📍 **Local:** {local_nome}\n"
+                     f"🗺️ **Endereço:** {endereco_completo}\n"
+                     f"📅 **Data:** {dados['data_formatada']}\n"
+                     f"⏰ **Horário:** {dados['hora_formatada']}\n\n"
+                     f"📸 **IMPORTANTE:** Faça um print (captura de tela) desta mensagem para guardar as informações do seu agendamento!\n\n"
+                     f"📞 Em caso de dúvidas, entre em contato com a clínica.\n\n"
+                     f"Obrigado por usar nosso sistema! 😊"),
                     'tipo':
                     'sucesso',
                     'agendamento_id':
@@ -1101,7 +1493,7 @@ class ChatbotService:
                 }
 
             except Exception as e:
-                logging.error(f"Erro ao criar agendamento: {e}")
+                logger.error("Erro ao criar agendamento: %s", e)
                 return {
                     'success': False,
                     'message':
@@ -1110,8 +1502,7 @@ class ChatbotService:
                     'proximo_estado': 'horarios'
                 }
 
-        elif any(palavra in mensagem_lower
-                 for palavra in ['não', 'nao', 'n', 'cancelar', 'voltar']):
+        elif CONFIRMACAO_NAO_RE.search(mensagem_lower):
             # Cancelar e voltar
             conversa.estado = 'horarios'
             return {
@@ -1134,27 +1525,16 @@ class ChatbotService:
     # Continuar com outros métodos auxiliares...
     def _eh_saudacao(self, mensagem):
         """Verifica se é uma saudação"""
-        saudacoes = [
-            'oi', 'olá', 'ola', 'hey', 'hello', 'bom dia', 'boa tarde',
-            'boa noite'
-        ]
-        return any(saudacao in mensagem.lower() for saudacao in saudacoes)
+        return bool(SAUDACAO_RE.match(mensagem))
 
     def _eh_cancelamento(self, mensagem):
         """Verifica se é uma solicitação de cancelamento"""
-        palavras_cancelamento = [
-            'cancelar', 'desmarcar', 'remover consulta', 'cancelo',
-            'cancelamento'
-        ]
-        return any(palavra in mensagem.lower()
-                   for palavra in palavras_cancelamento)
+        return bool(CANCELAMENTO_RE.search(mensagem))
 
     def _extrair_cpf(self, mensagem):
         """Extrai e valida CPF da mensagem"""
-        import re
         # Extrair apenas números
-        numeros = re.findall(r'\d', mensagem)
-        cpf = ''.join(numeros)
+        cpf = NAO_DIGITO_RE.sub('', mensagem)
 
         # Validar se tem 11 dígitos
         if len(cpf) == 11:
@@ -1169,9 +1549,7 @@ class ChatbotService:
 
     def _extrair_telefone(self, mensagem):
         """Extrai e valida telefone da mensagem"""
-        import re
-        numeros = re.findall(r'\d', mensagem)
-        telefone = ''.join(numeros)
+        telefone = NAO_DIGITO_RE.sub('', mensagem)
 
         # Validar se tem entre 10 e 11 dígitos
         if len(telefone) >= 10 and len(telefone) <= 11:
@@ -1180,343 +1558,282 @@ class ChatbotService:
 
     def _extrair_email(self, mensagem):
         """Extrai e valida email da mensagem"""
-        import re
-        email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
-        emails = re.findall(email_pattern, mensagem)
-        return emails[0] if emails else None
+        match = EMAIL_RE.search(mensagem)
+        return match.group(0) if match else None
 
     def _validar_data_nascimento(self, data_str):
-        """Valida e converte data de nascimento"""
-        try:
-            # Tentar diferentes formatos
-            formatos = ['%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y']
-            for formato in formatos:
-                try:
-                    data = datetime.strptime(data_str, formato).date()
-                    # Verificar se é uma data válida (não no futuro, não muito antiga)
-                    hoje = date.today()
-                    if data <= hoje and data >= date(1900, 1, 1):
-                        return data
-                except ValueError:
-                    continue
+        """Valida e converte data de nascimento (DD/MM/AAAA, DD-MM-AAAA ou DD.MM.AAAA)"""
+        match = DATA_NASCIMENTO_RE.match(data_str)
+        if not match:
             return None
-        except:
+        dia, _, mes, ano = match.groups()
+        try:
+            data = date(int(ano), int(mes), int(dia))
+        except ValueError:
             return None
 
+        # Verificar se é uma data válida (não no futuro, não muito antiga)
+        if date(1900, 1, 1) <= data <= date.today():
+            return data
+        return None
+
     def _gerar_horarios_disponiveis(self, rows):
         """Gera horários disponíveis - versão simplificada para corrigir hang"""
         try:
-            horarios = []
-            hoje = date.today()
-            hora_atual = datetime.now().time()
+            # Um único relógio para a data de hoje e a margem de 1 hora
+            agora = datetime.now()
+            hoje = agora.date()
+            hora_limite = agora + timedelta(hours=1)
 
             # DEBUG: Log inicial
-            logging.info(
-                f"DEBUG _gerar_horarios_disponiveis: hoje={hoje}, hora_atual={hora_atual}, rows={len(rows)}"
-            )
-
-            # SIMPLIFICAÇÃO: Próximos 7 dias e horários mais variados
-            horarios_fixos = [
-                '08:00', '09:00', '10:00', '11:00', '13:00', '14:00', '15:00',
-                '16:00', '17:00'
-            ]
-
-            for dia in range(50):  # Próximos 50 dias para dar mais opções
-                data_atual = hoje + timedelta(days=dia)
-                dia_semana = data_atual.weekday()
-
-                # DEBUG: Log do dia sendo processado
-                logging.info(
-                    f"DEBUG processando dia {dia}: data={data_atual}, dia_semana={dia_semana}"
-                )
-
-                # Pular fins de semana
-                if dia_semana >= 5:
-                    logging.info(
-                        f"DEBUG pulando fim de semana: dia_semana={dia_semana}"
-                    )
-                    continue
-
-                # Processar médicos disponíveis para este dia
-                for row in rows:
-                    logging.info(
-                        f"DEBUG verificando médico: nome={row['nome']}, dia_semana_medico={row['dia_semana']}, dia_semana_atual={dia_semana}"
-                    )
+            logger.debug(
+                "_gerar_horarios_disponiveis: hoje=%s, hora_atual=%s, rows=%s",
+                hoje, agora.time(), len(rows))
+
+            # Médicos, especialidades e locais carregados uma única vez
+            medicos = {
+                medico.id: medico
+                for medico in Medico.find_by_ids(
+                    {row['medico_id'] for row in rows})
+            }
+            nomes_especialidades = {
+                esp.id: esp.nome
+                for esp in Especialidade.find_by_ids(
+                    {medico.especialidade_id for medico in medicos.values()})
+            }
+            nomes_locais = {
+                local.id: local.nome
+                for local in Local.find_by_ids(
+                    {row['local_id'] for row in rows})
+            }
 
-                    if row['dia_semana'] != dia_semana:
+            # Horários já ocupados no período, em uma única consulta
+            ocupados = self._horarios_ocupados(
+                medicos, hoje, hoje + timedelta(days=DIAS_BUSCA_HORARIOS))
+
+            # Turnos pré-processados e agrupados por dia da semana: horas
+            # convertidas e slots calculados uma vez por linha
+            turnos_por_dia = defaultdict(list)
+            tem_crm = bool(rows) and 'crm' in rows[0].keys()
+            # Abertura da agenda e especialidade resolvidas uma vez por médico
+            aberturas = {
+                medico_id: medico.data_abertura()
+                for medico_id, medico in medicos.items()
+            }
+            especialidade_por_medico = {
+                medico_id: nomes_especialidades.get(medico.especialidade_id,
+                                                    'Especialidade')
+                for medico_id, medico in medicos.items()
+            }
+            for row in rows:
+                duracao_consulta = self._duracao_consulta(row)
+                turnos_por_dia[row['dia_semana']].append(
+                    (row, row['medico_id'], aberturas.get(row['medico_id']),
+                     row['crm'] if tem_crm else 'N/A', duracao_consulta,
+                     _slots_do_turno(row['hora_inicio'], row['hora_fim'],
+                                     duracao_consulta)))
+
+            # Logs dentro dos laços só quando DEBUG estiver habilitado
+            debug = logger.isEnabledFor(logging.DEBUG)
+
+            def slots_livres():
+                """Percorre os dias em ordem cronológica gerando slots livres"""
+                for dia in range(DIAS_BUSCA_HORARIOS):
+                    data_atual = hoje + timedelta(days=dia)
+                    dia_semana = data_atual.weekday()
+
+                    # Pular fins de semana e dias sem médicos atendendo
+                    turnos = turnos_por_dia.get(dia_semana)
+                    if dia_semana >= 5 or not turnos:
                         continue
 
-                    medico_id = row[
-                        'medico_id'] if 'medico_id' in row else row['id']
-
-                    # Verificar se a agenda do médico está aberta para esta data
-                    medico = Medico.find_by_id(medico_id)
-                    if medico and not medico.agenda_aberta(data_atual):
-                        logging.info(
-                            f"DEBUG agenda fechada para médico {row['nome']} na data {data_atual}"
-                        )
-                        continue
+                    # Formatos da data calculados uma vez por dia
+                    data_iso = data_atual.isoformat()
+                    data_formatada = data_atual.strftime('%d/%m/%Y')
+
+                    # Processar médicos disponíveis para este dia
+                    for (row, medico_id, abertura, crm, duracao_consulta,
+                         slots) in turnos:
+                        # Verificar se a agenda do médico está aberta para esta data
+                        if abertura and data_atual < abertura:
+                            if debug:
+                                logger.debug(
+                                    "agenda fechada para médico %s na data %s",
+                                    row['nome'], data_atual)
+                            continue
+
+                        for hora_slot, slot_time in slots:
+                            slot_datetime = datetime.combine(
+                                data_atual, slot_time)
+
+                            # Se é hoje, só horários futuros (com margem de 1 hora)
+                            if data_atual == hoje and slot_datetime <= hora_limite:
+                                continue
 
-                    hora_inicio = datetime.strptime(row['hora_inicio'],
-                                                    '%H:%M').time()
-                    hora_fim = datetime.strptime(row['hora_fim'],
-                                                 '%H:%M').time()
-                    # Obter duração da consulta de forma segura
-                    if 'duracao_consulta' in row.keys(
-                    ) and row['duracao_consulta']:
-                        try:
-                            duracao_consulta = int(row['duracao_consulta'])
-                            if duracao_consulta < 5:  # Mínimo de 5 minutos
-                                duracao_consulta = 30
-                        except (ValueError, TypeError):
-                            duracao_consulta = 30
-                    else:
-                        duracao_consulta = 30
-
-                    logging.info(
-                        f"DEBUG médico {row['nome']} trabalha de {hora_inicio} às {hora_fim}, duração: {duracao_consulta}min"
-                    )
-
-                    # Gerar horários baseado na duração específica da consulta
-                    inicio_datetime = datetime.combine(data_atual, hora_inicio)
-                    fim_datetime = datetime.combine(data_atual, hora_fim)
-
-                    slot_datetime = inicio_datetime
-                    while slot_datetime < fim_datetime:
-                        if len(horarios
-                               ) >= 5:  # Limitar para apenas 5 horários
-                            break
-
-                        slot_time = slot_datetime.time()
-
-                        # Se é hoje, só horários futuros (com margem de 1 hora)
-                        if data_atual == hoje:
-                            hora_limite = datetime.now() + timedelta(hours=1)
-                            if slot_datetime <= hora_limite:
-                                logging.info(
-                                    f"DEBUG pulando horário passado: {slot_time} <= {hora_limite.time()}"
-                                )
-                                slot_datetime += timedelta(
-                                    minutes=duracao_consulta)
+                            # Verificação de disponibilidade em memória
+                            if (medico_id, data_iso, hora_slot) in ocupados:
+                                if debug:
+                                    logger.debug("horário ocupado: %s %s",
+                                                 data_iso, hora_slot)
                                 continue
 
-                        # Verificação simples de disponibilidade
-                        if self._verificar_disponibilidade_slot_simples(
-                                medico_id, data_atual, slot_time):
-                            # Buscar nome do local corretamente
-                            nome_local = self._obter_nome_local(
-                                row['local_id'])
-
-                            # Buscar dados do médico para especialidade correta
-                            dados_medico = self._obter_dados_medico(medico_id)
-                            especialidade_nome = dados_medico[
-                                'especialidade'] if dados_medico else 'Especialidade'
-
-                            horario_info = {
-                                'medico_id':
-                                medico_id,
-                                'medico_nome':
-                                row['nome'],
-                                'medico':
-                                row['nome'],
-                                'especialidade':
-                                especialidade_nome,
-                                'crm':
-                                row['crm'] if 'crm' in row.keys() else 'N/A',
-                                'local_id':
-                                row['local_id'],
-                                'local_nome':
-                                nome_local,
-                                'data':
-                                data_atual.strftime('%Y-%m-%d'),
-                                'hora':
-                                slot_time.strftime('%H:%M'),
-                                'data_formatada':
-                                data_atual.strftime('%d/%m/%Y'),
-                                'hora_formatada':
-                                slot_time.strftime('%H:%M'),
-                                'dia_semana': [
-                                    'Segunda', 'Terça', 'Quarta', 'Quinta',
-                                    'Sexta', 'Sábado', 'Domingo'
-                                ][dia_semana] if dia_semana < 7 else 'N/A',
-                                'duracao':
-                                duracao_consulta,
-                                'timestamp':
-                                slot_datetime.timestamp()
+                            yield {
+                                'medico_id': medico_id,
+                                'medico_nome': row['nome'],
+                                'medico': row['nome'],
+                                'especialidade': especialidade_por_medico.get(
+                                    medico_id, 'Especialidade'),
+                                'crm': crm,
+                                'local_id': row['local_id'],
+                                'local_nome': nomes_locais.get(
+                                    row['local_id'], 'Local não encontrado'),
+                                'data': data_iso,
+                                'hora': hora_slot,
+                                'data_formatada': data_formatada,
+                                'hora_formatada': hora_slot,
+                                'dia_semana': DIAS_SEMANA[dia_semana],
+                                'duracao': duracao_consulta,
+                                'timestamp': slot_datetime.timestamp()
                             }
-                            horarios.append(horario_info)
-                            logging.info(
-                                f"DEBUG adicionado horário: {data_atual} {slot_time} - Dr. {row['nome']} (duração: {duracao_consulta}min)"
-                            )
-                        else:
-                            logging.info(
-                                f"DEBUG horário ocupado: {data_atual} {slot_time}"
-                            )
-
-                        # Avançar para o próximo slot baseado na duração da consulta
-                        slot_datetime += timedelta(minutes=duracao_consulta)
-
-                    if len(horarios) >= 5:
-                        break
-
-                if len(horarios) >= 5:
-                    break
 
-            # Ordenar horários priorizando quinta-feira primeiro, depois cronológico
-            def sort_key(h):
-                # Se for quinta-feira (dia_semana == 3), dar prioridade (valor 0)
-                # Caso contrário, usar o timestamp normal (valor 1 + timestamp)
-                data_obj = datetime.strptime(h['data'], '%Y-%m-%d').date()
-                dia_semana_num = data_obj.weekday()
-                if dia_semana_num == 3:  # Quinta-feira
-                    return (0, h['timestamp'])  # Prioridade alta
-                else:
-                    return (1, h['timestamp'])  # Prioridade normal
+            # A busca para assim que o limite de horários é atingido
+            horarios = list(islice(slots_livres(), MAX_HORARIOS_OFERECIDOS))
 
-            horarios_ordenados = sorted(horarios, key=sort_key)
+            # Ordenar horários priorizando quinta-feira primeiro, depois
+            # cronológico (o dia da semana já vem calculado em cada horário)
+            horarios_ordenados = sorted(
+                horarios,
+                key=lambda h: (h['dia_semana'] != 'Quinta', h['timestamp']))
 
-            logging.info(
-                f"DEBUG total de horários gerados: {len(horarios_ordenados)}")
-            logging.info(
-                f"DEBUG primeiro horário: {horarios_ordenados[0] if horarios_ordenados else 'nenhum'}"
-            )
+            logger.debug(
+                "total de horários gerados: %s", len(horarios_ordenados))
+            logger.debug(
+                "primeiro horário: %s",
+                horarios_ordenados[0] if horarios_ordenados else 'nenhum')
 
-            return horarios_ordenados[:5]
+            return horarios_ordenados
 
-        except Exception as e:
-            logging.error(f"Erro em _gerar_horarios_disponiveis: {e}")
-            import traceback
-            logging.error(f"Traceback: {traceback.format_exc()}")
+        except (sqlite3.Error, KeyError, TypeError, ValueError) as e:
+            # Falhas de banco/dados da grade; erros de programação propagam
+            logger.exception("Erro em _gerar_horarios_disponiveis: %s", e)
             return []
 
-    def _verificar_disponibilidade_slot_simples(self, medico_id, data, hora):
-        """Verificação simplificada de disponibilidade para evitar hang"""
+    def _duracao_consulta(self, row):
+        """Duração da consulta do horário, com padrão de 30 minutos"""
+        try:
+            duracao_consulta = int(row['duracao_consulta'] or 0)
+        except (IndexError, KeyError, ValueError, TypeError):
+            return 30
+        # Mínimo de 5 minutos
+        return duracao_consulta if duracao_consulta >= 5 else 30
+
+    def _horarios_ocupados(self, medico_ids, data_inicio, data_fim):
+        """Retorna {(medico_id, 'AAAA-MM-DD', 'HH:MM')} ocupados no período"""
+        medico_ids = list(medico_ids)
+        if not medico_ids:
+            return set()
         try:
-            from database import db
-            query = "SELECT COUNT(*) as count FROM agendamentos WHERE medico_id = ? AND data = ? AND hora = ? AND status = 'agendado'"
-            result = db.execute_query(
-                query,
-                (medico_id, data.strftime('%Y-%m-%d'), hora.strftime('%H:%M')))
-            return not (result and result[0]['count'] > 0)
-        except:
-            return True  # Se der erro, assumir disponível
+            placeholders = ', '.join('?' for _ in medico_ids)
+            query = f"""
+                SELECT medico_id, data, hora FROM agendamentos
+                WHERE medico_id IN ({placeholders}) AND data BETWEEN ? AND ?
+                AND status = 'agendado'
+            """
+            inicio_iso = data_inicio.strftime('%Y-%m-%d')
+            fim_iso = data_fim.strftime('%Y-%m-%d')
+            rows = db.execute_query(query, (*medico_ids, inicio_iso, fim_iso))
+            ocupados = {(row['medico_id'], row['data'], str(row['hora'])[:5])
+                        for row in rows}
+
+            # Agendamentos recorrentes vigentes no período, expandidos para
+            # as datas do dia da semana correspondente
+            recorrentes = db.execute_query(
+                f"""
+                SELECT medico_id, dia_semana, hora, data_inicio, data_fim
+                FROM agendamentos_recorrentes
+                WHERE medico_id IN ({placeholders}) AND ativo = 1
+                AND data_inicio <= ? AND (data_fim IS NULL OR data_fim >= ?)
+                """, (*medico_ids, fim_iso, inicio_iso))
+            for row in recorrentes:
+                hora = str(row['hora'])[:5]
+                dia = data_inicio + timedelta(
+                    days=(row['dia_semana'] - data_inicio.weekday()) % 7)
+                while dia <= data_fim:
+                    dia_iso = dia.isoformat()
+                    if (row['data_inicio'] <= dia_iso
+                            and (not row['data_fim'] or row['data_fim'] >= dia_iso)):
+                        ocupados.add((row['medico_id'], dia_iso, hora))
+                    dia += timedelta(days=7)
+            return ocupados
+        except (sqlite3.Error, TypeError) as e:
+            logger.warning("Erro ao buscar horários ocupados: %s", e)
+            return set()  # Se der erro, assumir disponível
 
     def _verificar_disponibilidade_slot(self, medico_id, data, hora):
         """Verifica se um slot específico está disponível"""
-        from database import db
+        data_iso = data.isoformat()
+        hora_hhmm = hora.strftime('%H:%M')
 
         # Verificar agendamentos regulares
+        # SELECT 1 ... LIMIT 1: basta saber se existe (ix_agendamentos_medico_data)
         query = """
-            SELECT COUNT(*) as count FROM agendamentos 
+            SELECT 1 FROM agendamentos 
             WHERE medico_id = ? AND data = ? AND hora = ? AND status = 'agendado'
+            LIMIT 1
         """
-        result = db.execute_query(
-            query,
-            (medico_id, data.strftime('%Y-%m-%d'), hora.strftime('%H:%M')))
-
-        if result and result[0]['count'] > 0:
+        if db.execute_query(query, (medico_id, data_iso, hora_hhmm)):
             return False
 
         # Verificar agendamentos recorrentes
         dia_semana = data.weekday()
         query_recorrente = """
-            SELECT COUNT(*) as count FROM agendamentos_recorrentes 
+            SELECT 1 FROM agendamentos_recorrentes 
             WHERE medico_id = ? AND dia_semana = ? AND hora = ? AND ativo = 1
             AND data_inicio <= ? AND (data_fim IS NULL OR data_fim >= ?)
+            LIMIT 1
         """
-        result_recorrente = db.execute_query(
-            query_recorrente,
-            (medico_id, dia_semana, hora.strftime('%H:%M'),
-             data.strftime('%Y-%m-%d'), data.strftime('%Y-%m-%d')))
-
-        if result_recorrente and result_recorrente[0]['count'] > 0:
+        if db.execute_query(query_recorrente,
+                            (medico_id, dia_semana, hora_hhmm, data_iso,
+                             data_iso)):
             return False
 
         return True
 
-    def _obter_dados_medico(self, medico_id):
-        """Obtém dados completos do médico incluindo especialidade"""
-        from database import db
-
-        query = """
-            SELECT m.*, e.nome as especialidade_nome
-            FROM medicos m
-            JOIN especialidades e ON m.especialidade_id = e.id
-            WHERE m.id = ?
-        """
-
-        result = db.execute_query(query, (medico_id, ))
-        if result:
-            row = result[0]
-            return {
-                'nome': row['nome'],
-                'crm': row['crm'],
-                'especialidade': row['especialidade_nome']
-            }
-        return None
-
-    def _obter_nome_local(self, local_id):
-        """Obtém nome do local por ID"""
-        from database import db
-
-        query = "SELECT nome FROM locais WHERE id = ?"
-        result = db.execute_query(query, (local_id, ))
-
-        if result:
-            return result[0]['nome']
-        return 'Local não encontrado'
-
     def _interpretar_escolha_horario(self, mensagem, horarios_disponiveis):
         """Interpreta a escolha de horário do usuário"""
         mensagem_clean = mensagem.strip()
 
         # DEBUG: Log detalhado da interpretação
-        logging.info(
-            f"DEBUG _interpretar_escolha_horario: mensagem='{mensagem_clean}'")
-        logging.info(
-            f"DEBUG horarios_disponiveis count: {len(horarios_disponiveis)}")
+        logger.debug(
+            "_interpretar_escolha_horario: mensagem='%s'", mensagem_clean)
+        logger.debug(
+            "horarios_disponiveis count: %s", len(horarios_disponiveis))
 
         # Primeiro, verificar se é uma escolha por número (1, 2, 3, etc.)
-        import re
-        numero_match = re.match(r'^(\d+)$', mensagem_clean)
-        if numero_match:
-            indice = int(
-                numero_match.group(1)) - 1  # Converter para índice base 0
-            logging.info(
-                f"DEBUG numero_match: {numero_match.group(1)}, indice={indice}"
-            )
+        # (isdecimal cobre o mesmo conjunto que \d, sem passar por regex)
+        if mensagem_clean.isdecimal():
+            indice = int(mensagem_clean) - 1  # Converter para índice base 0
+            logger.debug(
+                "escolha por número: %s, indice=%s", mensagem_clean, indice)
             if 0 <= indice < len(horarios_disponiveis):
                 escolhido = horarios_disponiveis[indice]
-                logging.info(f"DEBUG horario escolhido: {escolhido}")
+                logger.debug("horario escolhido: %s", escolhido)
                 return escolhido
             else:
-                logging.warning(
-                    f"DEBUG índice {indice} fora do range [0-{len(horarios_disponiveis)-1}]"
-                )
+                logger.debug(
+                    "índice %s fora do range [0-%s]",
+                    indice, len(horarios_disponiveis)-1)
                 return None
 
         # Tentar encontrar data e hora na mensagem
-
-        # Padrões para data
-        data_patterns = [
-            r'(\d{1,2})/(\d{1,2})',  # 10/01
-            r'(\d{1,2})-(\d{1,2})',  # 10-01
-            r'(\d{1,2})\.(\d{1,2})',  # 10.01
-        ]
-
-        # Padrões para hora
-        hora_patterns = [
-            r'(\d{1,2}):(\d{2})',  # 14:00
-            r'(\d{1,2})h(\d{2})?',  # 14h00 ou 14h
-            r'(\d{1,2}) horas?',  # 14 horas
-        ]
-
         data_encontrada = None
         hora_encontrada = None
 
         # Buscar data
-        for pattern in data_patterns:
-            match = re.search(pattern, mensagem)
+        for trecho, pattern in ESCOLHA_DATA_RES:
+            if trecho not in mensagem:
+                continue
+            match = pattern.search(mensagem)
             if match:
                 dia, mes = match.groups()
                 try:
@@ -1524,14 +1841,16 @@ class ChatbotService:
                     ano = datetime.now().year
                     data_encontrada = f"{int(dia):02d}/{int(mes):02d}/{ano}"
                     break
-                except:
+                except ValueError:
                     continue
 
         # Buscar hora
-        for pattern in hora_patterns:
-            match = re.search(pattern, mensagem)
+        for trecho, pattern, so_horas in ESCOLHA_HORA_RES:
+            if trecho not in mensagem:
+                continue
+            match = pattern.search(mensagem)
             if match:
-                if pattern.endswith('horas?'):
+                if so_horas:
                     hora = int(match.group(1))
                     hora_encontrada = f"{hora:02d}:00"
                 else:
@@ -1540,18 +1859,24 @@ class ChatbotService:
                     hora_encontrada = f"{hora:02d}:{minutos:02d}"
                 break
 
-        # Se encontrou data e/ou hora, tentar fazer match com horários disponíveis
+        # Se encontrou data e/ou hora, tentar fazer match com horários
+        # disponíveis: índices por (dia/mês, hora), por dia/mês e por hora
+        # montados em uma passada, mantendo o primeiro horário de cada chave
+        por_chave, por_data, por_hora = {}, {}, {}
         for horario in horarios_disponiveis:
-            match_data = not data_encontrada or data_encontrada.startswith(
-                horario['data_formatada'][:5])
-            match_hora = not hora_encontrada or hora_encontrada == horario[
-                'hora']
-
-            if match_data and match_hora:
-                return horario
-
-        # Se não encontrou match exato, retornar None para mostrar opções
-        return None
+            dia_mes = horario['data_formatada'][:5]
+            por_chave.setdefault((dia_mes, horario['hora']), horario)
+            por_data.setdefault(dia_mes, horario)
+            por_hora.setdefault(horario['hora'], horario)
+
+        # Sem match exato, .get retorna None e as opções são mostradas
+        if data_encontrada and hora_encontrada:
+            return por_chave.get((data_encontrada[:5], hora_encontrada))
+        if data_encontrada:
+            return por_data.get(data_encontrada[:5])
+        if hora_encontrada:
+            return por_hora.get(hora_encontrada)
+        return horarios_disponiveis[0] if horarios_disponiveis else None
 
     def _formatar_horarios_para_exibicao(self, horarios):
         """Formata os 5 próximos horários em formato de balões como no chatbot"""
@@ -1560,19 +1885,10 @@ class ChatbotService:
 
         texto = ["🕐 **Estes são os horários disponíveis:**\n"]
 
-        for i, horario in enumerate(horarios[:5], 1):
-            # Criar balão com informações completas
-            balao = f"""📅 **{horario['data_formatada']}** ({horario['dia_semana']})
-• **{horario['hora_formatada']}** - Dr(a). **{horario['medico_nome']}**
-• **{horario['especialidade']}** - CRM: {horario['crm']}
-• **Local:** {horario['local_nome']}
-• **Duração:** {horario['duracao']} minutos"""
-
-            texto.append(balao)
-
-            # Adicionar separador entre horários
-            if i < len(horarios) and i < 5:
-                texto.append("━━━━━━━━━━━━━━━━━━━━━━")
+        # Um balão com informações completas por horário, com separador entre eles
+        texto.append(SEPARADOR_BALOES.join(
+            BALAO_HORARIO.format_map(horario)
+            for horario in horarios[:MAX_HORARIOS_OFERECIDOS]))
 
         # Instruções de como agendar
         texto.append("\n💬 **Para agendar, digite:**")
@@ -1585,10 +1901,11 @@ class ChatbotService:
 
     def _processar_cancelamento_cpf_valido(self, conversa, paciente):
         """Processa cancelamento quando CPF é válido"""
-        # Buscar agendamentos ativos do paciente
-        agendamentos = [
-            a for a in paciente.get_agendamentos() if a.status == 'agendado'
-        ]
+        # Buscar agendamentos ativos do paciente (nomes relacionados no mesmo SELECT)
+        agendamentos = Agendamento.find_with_joins({
+            'paciente_id': paciente.id,
+            'status': 'agendado'
+        })
 
         if not agendamentos:
             return {
@@ -1600,17 +1917,21 @@ class ChatbotService:
             }
 
         # Mostrar agendamentos para escolher qual cancelar
+        medicos, especialidades, locais = self._relacionados_agendamentos(
+            agendamentos)
         lista_agendamentos = []
+        agendamentos_dict = []
         for i, agendamento in enumerate(agendamentos, 1):
-            medico = agendamento.get_medico()
-            especialidade = agendamento.get_especialidade()
-            local = agendamento.get_local()
+            dados_agendamento = agendamento.to_dict()
+            agendamentos_dict.append(dados_agendamento)
+            medico = medicos.get(agendamento.medico_id)
+            especialidade = especialidades.get(agendamento.especialidade_id)
+            local = locais.get(agendamento.local_id)
 
             lista_agendamentos.append(
-                f"{i}. **{medico.nome if medico else 'N/A'}** - {especialidade.nome if especialidade else 'N/A'}\n"
-                +
-                f"   📅 {agendamento.to_dict()['data']} às {agendamento.to_dict()['hora']}\n"
-                + f"   📍 {local.nome if local else 'N/A'}")
+                (f"{i}. **{medico.nome if medico else 'N/A'}** - {especialidade.nome if especialidade else 'N/A'}\n"
+                 f"   📅 {dados_agendamento['data']} às {dados_agendamento['hora']}\n"
+                 f"   📍 {local.nome if local else 'N/A'}"))
 
         lista_texto = "\n\n".join(lista_agendamentos)
 
@@ -1623,13 +1944,24 @@ class ChatbotService:
             'message':
             f"Olá, {paciente.nome}! 👋\n\nVocê possui {len(agendamentos)} agendamento(s) ativo(s):\n\n{lista_texto}\n\nDigite o **número** do agendamento que deseja cancelar:",
             'tipo': 'cancelamento',
-            'agendamentos': [a.to_dict() for a in agendamentos],
+            'agendamentos': agendamentos_dict,
             'proximo_estado': 'cancelamento'
         }
 
+    def _relacionados_agendamentos(self, agendamentos):
+        """Carrega médicos, especialidades e locais dos agendamentos em lote"""
+        def por_id(modelo, ids):
+            return {obj.id: obj for obj in modelo.find_by_ids(set(ids) - {None})}
+
+        return (por_id(Medico, (a.medico_id for a in agendamentos)),
+                por_id(Especialidade,
+                       (a.especialidade_id for a in agendamentos)),
+                por_id(Local, (a.local_id for a in agendamentos)))
+
     def _processar_consulta_agendamentos_cpf_valido(self, conversa, paciente):
         """Processa consulta de agendamentos quando CPF é válido"""
-        agendamentos = paciente.get_agendamentos()
+        # Nomes relacionados no mesmo SELECT (to_dict não faz consultas extras)
+        agendamentos = Agendamento.find_with_joins({'paciente_id': paciente.id})
 
         if not agendamentos:
             return {
@@ -1640,10 +1972,18 @@ class ChatbotService:
                 'proximo_estado': 'inicio'
             }
 
+        # Serializar cada agendamento uma vez (mensagem e resposta reutilizam)
+        itens = [(a, a.to_dict()) for a in agendamentos]
+
         # Separar agendamentos por status
-        agendados = [a for a in agendamentos if a.status == 'agendado']
-        cancelados = [a for a in agendamentos if a.status == 'cancelado']
-        concluidos = [a for a in agendamentos if a.status == 'concluido']
+        agendados = [i for i in itens if i[0].status == 'agendado']
+        cancelados = [i for i in itens if i[0].status == 'cancelado']
+        concluidos = [i for i in itens if i[0].status == 'concluido']
+
+        # Médicos, especialidades e locais dos itens exibidos em lote
+        exibidos = [a for a, _ in agendados + cancelados[-3:] + concluidos[-3:]]
+        medicos, especialidades, locais = self._relacionados_agendamentos(
+            exibidos)
 
         mensagem_partes = [
             f"Olá, {paciente.nome}! 👋\n\n📋 **Seus Agendamentos:**\n"
@@ -1651,38 +1991,38 @@ class ChatbotService:
 
         if agendados:
             mensagem_partes.append("✅ **Agendamentos Ativos:**")
-            for agendamento in agendados:
-                medico = agendamento.get_medico()
-                especialidade = agendamento.get_especialidade()
-                local = agendamento.get_local()
+            for agendamento, dados_agendamento in agendados:
+                medico = medicos.get(agendamento.medico_id)
+                especialidade = especialidades.get(
+                    agendamento.especialidade_id)
+                local = locais.get(agendamento.local_id)
                 mensagem_partes.append(
-                    f"• **Dr(a). {medico.nome if medico else 'N/A'}** - {especialidade.nome if especialidade else 'N/A'}\n"
-                    +
-                    f"  📅 {agendamento.to_dict()['data']} às {agendamento.to_dict()['hora']}\n"
-                    + f"  📍 {local.nome if local else 'N/A'}")
+                    (f"• **Dr(a). {medico.nome if medico else 'N/A'}** - {especialidade.nome if especialidade else 'N/A'}\n"
+                     f"  📅 {dados_agendamento['data']} às {dados_agendamento['hora']}\n"
+                     f"  📍 {local.nome if local else 'N/A'}"))
             mensagem_partes.append("")
 
         if cancelados:
             mensagem_partes.append("❌ **Agendamentos Cancelados:**")
-            for agendamento in cancelados[-3:]:  # Mostrar só os últimos 3
-                medico = agendamento.get_medico()
-                especialidade = agendamento.get_especialidade()
+            for agendamento, dados_agendamento in cancelados[-3:]:  # Mostrar só os últimos 3
+                medico = medicos.get(agendamento.medico_id)
+                especialidade = especialidades.get(
+                    agendamento.especialidade_id)
                 mensagem_partes.append(
-                    f"• **Dr(a). {medico.nome if medico else 'N/A'}** - {especialidade.nome if especialidade else 'N/A'}\n"
-                    +
-                    f"  📅 {agendamento.to_dict()['data']} às {agendamento.to_dict()['hora']}"
+                    (f"• **Dr(a). {medico.nome if medico else 'N/A'}** - {especialidade.nome if especialidade else 'N/A'}\n"
+                     f"  📅 {dados_agendamento['data']} às {dados_agendamento['hora']}")
                 )
             mensagem_partes.append("")
 
         if concluidos:
             mensagem_partes.append("✅ **Consultas Realizadas:**")
-            for agendamento in concluidos[-3:]:  # Mostrar só os últimos 3
-                medico = agendamento.get_medico()
-                especialidade = agendamento.get_especialidade()
+            for agendamento, dados_agendamento in concluidos[-3:]:  # Mostrar só os últimos 3
+                medico = medicos.get(agendamento.medico_id)
+                especialidade = especialidades.get(
+                    agendamento.especialidade_id)
                 mensagem_partes.append(
-                    f"• **Dr(a). {medico.nome if medico else 'N/A'}** - {especialidade.nome if especialidade else 'N/A'}\n"
-                    +
-                    f"  📅 {agendamento.to_dict()['data']} às {agendamento.to_dict()['hora']}"
+                    (f"• **Dr(a). {medico.nome if medico else 'N/A'}** - {especialidade.nome if especialidade else 'N/A'}\n"
+                     f"  📅 {dados_agendamento['data']} às {dados_agendamento['hora']}")
                 )
 
         mensagem_partes.append(
@@ -1696,13 +2036,14 @@ class ChatbotService:
             'success': True,
             'message': "\n".join(mensagem_partes),
             'tipo': 'consulta',
-            'agendamentos': [a.to_dict() for a in agendamentos],
+            'agendamentos': [d for _, d in itens],
             'proximo_estado': 'inicio'
         }
 
-    def _processar_cancelamento(self, mensagem, conversa):
+    def _processar_cancelamento(self, mensagem, conversa, dados=None):
         """Processa cancelamento de agendamento"""
-        dados = conversa.get_dados() or {}
+        if dados is None:
+            dados = conversa.get_dados() or {}
 
         if 'agendamentos_para_cancelar' in dados:
             # Usuário está escolhendo qual agendamento cancelar
@@ -1721,6 +2062,7 @@ class ChatbotService:
 
                         medico = agendamento.get_medico()
                         especialidade = agendamento.get_especialidade()
+                        dados_agendamento = agendamento.to_dict()
 
                         conversa.estado = 'finalizado'
                         conversa.set_dados({})
@@ -1729,15 +2071,12 @@ class ChatbotService:
                             'success':
                             True,
                             'message':
-                            f"✅ **Agendamento Cancelado!**\n\n" +
-                            f"🩺 **Médico:** Dr(a). {medico.nome if medico else 'N/A'}\n"
-                            +
-                            f"🏥 **Especialidade:** {especialidade.nome if especialidade else 'N/A'}\n"
-                            +
-                            f"📅 **Data/Hora:** {agendamento.to_dict()['data']} às {agendamento.to_dict()['hora']}\n\n"
-                            +
-                            f"O agendamento foi cancelado com sucesso. Se precisar reagendar, digite 'agendar'.\n\n"
-                            + f"Obrigado! 😊",
+                            (f"✅ **Agendamento Cancelado!**\n\n"
+                             f"🩺 **Médico:** Dr(a). {medico.nome if medico else 'N/A'}\n"
+                             f"🏥 **Especialidade:** {especialidade.nome if especialidade else 'N/A'}\n"
+                             f"📅 **Data/Hora:** {dados_agendamento['data']} às {dados_agendamento['hora']}\n\n"
+                             f"O agendamento foi cancelado com sucesso. Se precisar reagendar, digite 'agendar'.\n\n"
+                             f"Obrigado! 😊"),
                             'tipo':
                             'sucesso',
                             'proximo_estado':
@@ -1774,25 +2113,15 @@ class ChatbotService:
 
     def _tem_escolha_especifica(self, mensagem):
         """Verifica se a mensagem tem uma escolha específica de horário"""
-        import re
         mensagem = mensagem.strip()
-
-        # Verificar se é um número simples (seleção por botão)
-        if re.match(r'^\d+$', mensagem):
+        # Número simples (seleção por botão) dispensa regex
+        if mensagem.isdecimal():
             return True
-
+        # Todos os padrões exigem um dígito: "oi", "agendar" etc. param aqui
+        if not any(c.isdigit() for c in mensagem):
+            return False
         # Buscar padrões de data e hora
-        data_patterns = [
-            r'\d{1,2}/\d{1,2}', r'\d{1,2}-\d{1,2}', r'\d{1,2}\.\d{1,2}'
-        ]
-        hora_patterns = [
-            r'\d{1,2}:\d{2}', r'\d{1,2}h\d{2}?', r'\d{1,2}\s*horas?'
-        ]
-
-        for pattern in data_patterns + hora_patterns:
-            if re.search(pattern, mensagem):
-                return True
-        return False
+        return bool(ESCOLHA_ESPECIFICA_RE.search(mensagem))
 
     def _resposta_erro(self, mensagem):
         """Retorna resposta padrão de erro"""
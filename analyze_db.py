@@ -3,9 +3,16 @@ import sqlite3
 import json
 from datetime import datetime, date, time
 
+DIAS_SEMANA = ('Segunda', 'Terça', 'Quarta', 'Quinta', 'Sexta', 'Sábado', 'Domingo')
+
 # Conectar ao banco
 conn = sqlite3.connect('sistema_agendamento.db')
 conn.row_factory = sqlite3.Row  # Para acessar colunas por nome
+# Mesmo journal do sistema; conexão única, então o cache de páginas é reaproveitado
+conn.execute('PRAGMA journal_mode=WAL')
+conn.execute('PRAGMA synchronous=NORMAL')
+conn.execute('PRAGMA temp_store=MEMORY')
+conn.execute('PRAGMA cache_size=-20000')
 cursor = conn.cursor()
 
 print("=== ANÁLISE COMPLETA DO SISTEMA DE AGENDAMENTO ===\n")
@@ -36,16 +43,7 @@ print("\n" + "="*50)
 # 3. Analisar horários disponíveis
 print("\n3. HORÁRIOS CONFIGURADOS:")
 cursor.execute("""
-    SELECT hd.*, m.nome as medico_nome, l.nome as local_nome,
-           CASE hd.dia_semana 
-               WHEN 0 THEN 'Segunda'
-               WHEN 1 THEN 'Terça' 
-               WHEN 2 THEN 'Quarta'
-               WHEN 3 THEN 'Quinta'
-               WHEN 4 THEN 'Sexta'
-               WHEN 5 THEN 'Sábado'
-               WHEN 6 THEN 'Domingo'
-           END as dia_nome
+    SELECT hd.*, m.nome as medico_nome, l.nome as local_nome
     FROM horarios_disponiveis hd
     JOIN medicos m ON hd.medico_id = m.id
     JOIN locais l ON hd.local_id = l.id
@@ -60,7 +58,7 @@ for horario in horarios:
         medico_atual = horario['medico_nome']
         print(f"\n   {medico_atual} ({horario['local_nome']}):")
     
-    print(f"     {horario['dia_nome']}: {horario['hora_inicio']} - {horario['hora_fim']} (duração: {horario['duracao_consulta']}min)")
+    print(f"     {DIAS_SEMANA[horario['dia_semana']]}: {horario['hora_inicio']} - {horario['hora_fim']} (duração: {horario['duracao_consulta']}min)")
 
 print("\n" + "="*50)
 
@@ -92,7 +90,7 @@ today = date.today()
 today_str = today.strftime('%Y-%m-%d')
 dia_semana_hoje = today.weekday()
 
-print(f"   Data: {today_str} ({['Segunda', 'Terça', 'Quarta', 'Quinta', 'Sexta', 'Sábado', 'Domingo'][dia_semana_hoje]})")
+print(f"   Data: {today_str} ({DIAS_SEMANA[dia_semana_hoje]})")
 
 # Buscar horários disponíveis para hoje
 cursor.execute("""
@@ -109,56 +107,52 @@ horarios_hoje = cursor.fetchall()
 
 if horarios_hoje:
     print(f"   Médicos disponíveis hoje:")
+    # Total de agendamentos de hoje por médico em uma única consulta
+    cursor.execute("""
+        SELECT medico_id, COUNT(*) as total 
+        FROM agendamentos 
+        WHERE data = ? AND status = 'agendado'
+        GROUP BY medico_id
+    """, (today_str,))
+    agendados_por_medico = {row['medico_id']: row['total'] for row in cursor.fetchall()}
+    
     for h in horarios_hoje:
-        # Verificar se há agendamentos para este médico hoje
-        cursor.execute("""
-            SELECT COUNT(*) as total 
-            FROM agendamentos 
-            WHERE medico_id = ? AND data = ? AND status = 'agendado'
-        """, (h['medico_id'], today_str))
-        
-        agendados = cursor.fetchone()['total']
+        agendados = agendados_por_medico.get(h['medico_id'], 0)
         
         print(f"     {h['medico_nome']} ({h['especialidade_nome']}) - {h['hora_inicio']}-{h['hora_fim']} em {h['local_nome']} - {agendados} agendamentos")
 else:
-    print(f"   Nenhum médico disponível hoje ({['Segunda', 'Terça', 'Quarta', 'Quinta', 'Sexta', 'Sábado', 'Domingo'][dia_semana_hoje]})")
+    print(f"   Nenhum médico disponível hoje ({DIAS_SEMANA[dia_semana_hoje]})")
 
 print("\n" + "="*50)
 
 # 6. Gerar slots de horário disponíveis para teste
 print("\n6. SLOTS DE HORÁRIOS CALCULADOS PARA HOJE:")
 
+def minutos(hora):
+    """Converte 'HH:MM' em minutos desde a meia-noite"""
+    horas, mins = hora.split(':')[:2]
+    return int(horas) * 60 + int(mins)
+
 def gerar_slots_horario(hora_inicio, hora_fim, duracao_minutos):
     """Gera lista de slots de horário"""
-    slots = []
-    inicio = datetime.strptime(hora_inicio, '%H:%M').time()
-    fim = datetime.strptime(hora_fim, '%H:%M').time()
-    
-    hora_atual = datetime.combine(date.today(), inicio)
-    hora_final = datetime.combine(date.today(), fim)
-    
-    while hora_atual < hora_final:
-        slots.append(hora_atual.strftime('%H:%M'))
-        hora_atual += timedelta(minutes=duracao_minutos)
-    
-    return slots
-
-from datetime import timedelta
+    return ['%02d:%02d' % divmod(m, 60)
+            for m in range(minutos(hora_inicio), minutos(hora_fim), duracao_minutos)]
 
 for h in horarios_hoje:
     slots = gerar_slots_horario(h['hora_inicio'], h['hora_fim'], h['duracao_consulta'])
     print(f"\n   {h['medico_nome']} ({h['especialidade_nome']}) em {h['local_nome']}:")
     
-    # Verificar quais slots estão ocupados
+    # Verificar quais slots estão ocupados (horários do dia em uma consulta)
+    cursor.execute("""
+        SELECT hora 
+        FROM agendamentos 
+        WHERE medico_id = ? AND data = ? AND status = 'agendado'
+    """, (h['medico_id'], today_str))
+    ocupados = {str(row['hora'])[:5] for row in cursor.fetchall()}
+    
     slots_disponiveis = []
     for slot in slots[:10]:  # Mostrar apenas primeiros 10 slots
-        cursor.execute("""
-            SELECT COUNT(*) as ocupado 
-            FROM agendamentos 
-            WHERE medico_id = ? AND data = ? AND hora = ? AND status = 'agendado'
-        """, (h['medico_id'], today_str, slot))
-        
-        ocupado = cursor.fetchone()['ocupado']
+        ocupado = slot in ocupados
         status = "🔴 OCUPADO" if ocupado else "🟢 DISPONÍVEL"
         slots_disponiveis.append((slot, not ocupado))
         print(f"     {slot} - {status}")
@@ -1,8 +1,23 @@
 import os
+import atexit
+import queue
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import sqlite3
 import uuid
+import secrets
+import shutil
+import itertools
+import hashlib
+import io
+from time import monotonic
+from functools import lru_cache, wraps
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, send_file
 from werkzeug.utils import secure_filename
+from werkzeug.security import generate_password_hash, check_password_hash
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import escape
 import mimetypes
 from datetime import datetime, date, time
 import json
@@ -10,18 +25,27 @@ import json
 # Importar novos modelos SQLite
 from models import (
     Paciente, Local, Especialidade, Medico, HorarioDisponivel, 
-    Agendamento, Conversa, Configuracao, AgendamentoRecorrente
+    Agendamento, Conversa, Configuracao, AgendamentoRecorrente, ArquivoPaciente, limpar_cache,
+    abrir_mapa_identidade, fechar_mapa_identidade
 )
+from database import db
 
-# Configure logging com formato melhorado
+# Configure logging com formato melhorado.
+# O request só enfileira o registro já formatado; a escrita no console e no
+# arquivo fica com a thread do QueueListener (esvaziada na saída do processo)
+_fila_log = queue.SimpleQueue()
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
-    handlers=[
-        logging.StreamHandler(),  # Console
-        logging.FileHandler('sistema_agendamento.log', mode='a')  # Arquivo
-    ]
+    handlers=[QueueHandler(_fila_log)]
 )
+_listener_log = QueueListener(
+    _fila_log,
+    logging.StreamHandler(),  # Console
+    logging.FileHandler('sistema_agendamento.log', mode='a')  # Arquivo
+)
+_listener_log.start()
+atexit.register(_listener_log.stop)
 
 # Logger específico para o sistema
 logger = logging.getLogger('SistemaAgendamento')
@@ -32,11 +56,59 @@ app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-joao-layon-202
 
 # Configurações de upload
 UPLOAD_FOLDER = 'uploads/anexos'
-ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx', 'xls', 'xlsx'}
+ALLOWED_EXTENSIONS = frozenset({'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx', 'xls', 'xlsx'})
+# Lista exibida nas mensagens de erro (ordem estável, montada uma vez)
+TIPOS_ACEITOS = ', '.join(sorted(ALLOWED_EXTENSIONS))
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
+UPLOAD_BUFFER = 1024 * 1024  # Bloco de cópia ao gravar uploads (1MB)
+
+# Campos dos formulários de horário disponível (cadastro e edição)
+CAMPOS_HORARIO = ('medico_id', 'local_id', 'dia_semana', 'hora_inicio', 'hora_fim', 'duracao_consulta')
+
+# Ícone Bootstrap por extensão de arquivo
+ICONES_EXTENSAO = {
+    'jpg': 'bi-file-earmark-image', 'jpeg': 'bi-file-earmark-image',
+    'png': 'bi-file-earmark-image', 'gif': 'bi-file-earmark-image',
+    'pdf': 'bi-file-earmark-pdf',
+    'doc': 'bi-file-earmark-word', 'docx': 'bi-file-earmark-word',
+    'xls': 'bi-file-earmark-excel', 'xlsx': 'bi-file-earmark-excel',
+    'txt': 'bi-file-earmark-text',
+}
+
+# Classe do badge Bootstrap por status de agendamento
+STATUS_BADGE = {
+    'agendado': 'success',
+    'concluido': 'info',
+    'cancelado': 'danger',
+}
+
+# Máximo de conversas abandonadas removidas por limpeza
+LIMITE_LIMPEZA_CONVERSAS = 100
+
+# Sequência para o cache_key das respostas de horários
+SEQUENCIA_CACHE_HORARIOS = itertools.count(1)
+
+# Remoção de anexos em segundo plano (tarefas pendentes terminam antes do processo sair)
+_executor_remocao = ThreadPoolExecutor(max_workers=1, thread_name_prefix='remocao-anexo')
+
+# Prefixos dos hashes gerados por werkzeug.security (senha do admin)
+PREFIXOS_HASH_SENHA = ('scrypt:', 'pbkdf2:')
+
+# Validade (segundos) do resumo de estatísticas usado em /log-test
+ESTATISTICAS_TTL_SEGUNDOS = 30
+_estatisticas_cache = {'valor': None, 'expira_em': 0.0}
+
+# (anexo_path, anexo_nome) por agendamento, para o download não consultar o banco.
+# Invalidado onde o anexo muda; em outro worker, um caminho antigo cai no
+# FileNotFoundError do download, que descarta a entrada e consulta de novo
+ANEXOS_CACHE_MAX = 1024
+_anexos_cache = {}
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+# Atrás de um servidor com suporte a X-Sendfile (Apache mod_xsendfile, lighttpd),
+# os anexos são enviados pelo próprio servidor web, sem passar pelo Python
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '0').lower() in ('1', 'true', 'sim')
 
 # Criar diretório de uploads se não existir
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -46,7 +118,20 @@ from werkzeug.middleware.proxy_fix import ProxyFix
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
 # Importar serviço de AI
-from ai_service import chatbot_service
+from ai_service import chatbot_service, aquecer_genai, ler_token_anexo, MENSAGEM_RESUMO
+aquecer_genai()
+
+# Templates compilados: cache em memória maior e bytecode em disco (diretório
+# temporário do sistema) para que novos workers não recompilem os templates.
+# O recarregamento automático continua seguindo o modo debug do Flask.
+TEMPLATES_PRECOMPILADOS = (
+    'chat.html', 'agendamentos.html', 'admin.html',
+    'admin_login.html', 'admin_config.html',
+)
+app.jinja_env.cache_size = 400
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+for nome_template in TEMPLATES_PRECOMPILADOS:
+    app.jinja_env.get_template(nome_template)
 
 # Registrar funções para usar nos templates
 @app.template_global()
@@ -54,51 +139,152 @@ def get_file_icon_template(filename):
     """Função para usar no template Jinja2"""
     return get_file_icon(filename)
 
+# Configurações disponíveis em todos os templates ({chave: padrão})
+CONFIG_TEMPLATES = {
+    'nome_clinica': 'Clínica João Layon',
+    'nome_assistente': 'Assistente Virtual',
+    'telefone_clinica': '(31) 3333-4444',
+    'email_admin': 'joao@gmail.com',
+}
+
 # Função global para disponibilizar configurações em todos os templates
 @app.context_processor
 def inject_config():
     """Injeta configurações do sistema em todos os templates"""
-    return {
-        'nome_clinica': Configuracao.get_valor('nome_clinica', 'Clínica João Layon'),
-        'nome_assistente': Configuracao.get_valor('nome_assistente', 'Assistente Virtual'),
-        'telefone_clinica': Configuracao.get_valor('telefone_clinica', '(31) 3333-4444'),
-        'email_admin': Configuracao.get_valor('email_admin', 'joao@gmail.com')
-    }
+    # Uma leitura do cache de configurações (invalidado em set_valor)
+    return Configuracao.get_muitos(CONFIG_TEMPLATES)
+
+# Uma conexão SQLite por request, reaproveitada por todas as consultas dele,
+# e um mapa de identidade para não repetir find_by_id do mesmo registro
+@app.before_request
+def abrir_conexao_banco():
+    db.abrir_conexao_request()
+    abrir_mapa_identidade()
+
+@app.teardown_request
+def fechar_conexao_banco(exc):
+    fechar_mapa_identidade()
+    db.fechar_conexao_request()
+
+# Estatísticas do planejador atualizadas periodicamente durante a execução
+db.iniciar_manutencao()
 
 # Decorator para proteger rotas administrativas
 def requer_login_admin(f):
     """Decorator para proteger rotas administrativas"""
+    @wraps(f)
     def decorated_function(*args, **kwargs):
         if not session.get('admin_logado'):
             flash('Acesso negado. Faça login como administrador.', 'error')
             return redirect(url_for('admin_login'))
         return f(*args, **kwargs)
-    decorated_function.__name__ = f.__name__
     return decorated_function
 
+def campos_formulario(nomes, **padroes):
+    """Lê vários campos do formulário de uma vez, sem espaços nas pontas"""
+    form = request.form
+    return tuple(form.get(nome, padroes.get(nome, '')).strip() for nome in nomes)
+
+def senha_admin_confere(senha):
+    """Confere a senha do admin com o hash armazenado; uma senha antiga ainda
+    em texto puro é convertida para hash no primeiro login bem-sucedido"""
+    armazenada = Configuracao.get_valor('senha_admin', '30031936Vo')
+    if armazenada.startswith(PREFIXOS_HASH_SENHA):
+        return check_password_hash(armazenada, senha)
+    if not secrets.compare_digest(armazenada.encode(), senha.encode()):
+        return False
+    Configuracao.set_valor('senha_admin', generate_password_hash(senha))
+    return True
+
 def allowed_file(filename):
     """Verifica se o arquivo tem extensão permitida"""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    ponto = filename.rfind('.')
+    return ponto >= 0 and filename[ponto + 1:].lower() in ALLOWED_EXTENSIONS
 
+def remover_arquivo(file_path):
+    """Apaga um arquivo de upload (executado em segundo plano)"""
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning("Falha ao remover arquivo %s: %s", file_path, e)
+
+def _descritor_arquivo(stream):
+    """Descritor do upload quando ele já está em um arquivo temporário (uploads
+    grandes no Werkzeug); None para uploads pequenos mantidos em memória"""
+    try:
+        return stream.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+def salvar_upload(file, file_path):
+    """Grava o upload em disco e retorna o tamanho gravado. Se o upload já está
+    em arquivo, a cópia é feita pelo kernel (os.sendfile); senão, em blocos"""
+    origem = file.stream
+    with open(file_path, 'wb') as destino:
+        fd_origem = _descritor_arquivo(origem) if hasattr(os, 'sendfile') else None
+        if fd_origem is not None:
+            inicio = posicao = origem.tell()
+            total = os.fstat(fd_origem).st_size
+            try:
+                while posicao < total:
+                    enviados = os.sendfile(destino.fileno(), fd_origem, posicao, total - posicao)
+                    if not enviados:
+                        break
+                    posicao += enviados
+            except OSError:
+                # Sistema de arquivos sem suporte: recomeça com a cópia em blocos
+                destino.seek(0)
+                destino.truncate()
+                origem.seek(inicio)
+                shutil.copyfileobj(origem, destino, UPLOAD_BUFFER)
+        else:
+            shutil.copyfileobj(origem, destino, UPLOAD_BUFFER)
+        destino.flush()
+        return os.fstat(destino.fileno()).st_size
+
+def deduplicar_upload(file_path):
+    """Calcula o SHA-256 do arquivo gravado; se o mesmo conteúdo já estiver
+    armazenado, troca a cópia nova por um hard link para o arquivo existente"""
+    with open(file_path, 'rb') as arquivo:
+        hash_conteudo = hashlib.file_digest(arquivo, 'sha256').hexdigest()
+    
+    existente = ArquivoPaciente.find_by_hash(hash_conteudo)
+    if existente:
+        caminho_existente = os.path.join(app.config['UPLOAD_FOLDER'], existente.caminho_arquivo)
+        temporario = file_path + '.link'
+        try:
+            os.link(caminho_existente, temporario)
+            os.replace(temporario, file_path)
+        except OSError as e:
+            # Sem hard link (arquivo removido, outro sistema de arquivos): mantém a cópia
+            logger.warning("Deduplicação ignorada para %s: %s", file_path, e)
+    return hash_conteudo
+
+@lru_cache(maxsize=64)
+def tipo_mime(extensao):
+    """Tipo MIME por extensão (adivinhado uma vez por extensão)"""
+    return mimetypes.guess_type(f'arquivo.{extensao}')[0] or 'application/octet-stream'
+
+def enviar_anexo(file_path, download_name):
+    """Resposta de download do anexo (responde 304 quando possível).
+    O único stat do arquivo é o do send_file: levanta FileNotFoundError se ele não existir"""
+    mimetype = tipo_mime(file_path.rpartition('.')[2].lower())
+    return send_file(
+        file_path,
+        as_attachment=True,
+        download_name=download_name,
+        mimetype=mimetype,
+        conditional=True
+    )
+
+@lru_cache(maxsize=2048)
 def get_file_icon(filename):
     """Retorna o ícone Bootstrap apropriado para o tipo de arquivo"""
-    if not filename:
-        return 'bi-file-earmark'
-    
-    ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
-    
-    if ext in ['jpg', 'jpeg', 'png', 'gif']:
-        return 'bi-file-earmark-image'
-    elif ext in ['pdf']:
-        return 'bi-file-earmark-pdf'
-    elif ext in ['doc', 'docx']:
-        return 'bi-file-earmark-word'
-    elif ext in ['xls', 'xlsx']:
-        return 'bi-file-earmark-excel'
-    elif ext in ['txt']:
-        return 'bi-file-earmark-text'
-    else:
+    if not filename or '.' not in filename:
         return 'bi-file-earmark'
+    return ICONES_EXTENSAO.get(filename.rpartition('.')[2].lower(), 'bi-file-earmark')
 
 @app.route('/')
 def index():
@@ -118,41 +304,13 @@ def listar_agendamentos():
     # Buscar locais ativos para o dropdown
     locais = Local.find_active()
     
-    # Esta página é apenas para administradores
-    agendamentos = Agendamento.find_all()
-    
-    # Aplicar filtros
-    agendamentos_filtrados = []
-    for agendamento in agendamentos:
-        # Filtro por data de início
-        if data_inicio:
-            if not agendamento.data or str(agendamento.data) < data_inicio:
-                continue
-        
-        # Filtro por data fim
-        if data_fim:
-            if not agendamento.data or str(agendamento.data) > data_fim:
-                continue
-        
-        # Filtro por status
-        if status_filtro and agendamento.status != status_filtro:
-            continue
-        
-        # Filtro por local
-        if local_filtro and str(agendamento.local_id) != local_filtro:
-            continue
-            
-        agendamentos_filtrados.append(agendamento)
-    
-    # Adicionar dados relacionados a cada agendamento
-    for agendamento in agendamentos_filtrados:
-        agendamento.paciente_rel = agendamento.get_paciente()
-        agendamento.medico_rel = agendamento.get_medico()
-        agendamento.especialidade_rel = agendamento.get_especialidade()
-        agendamento.local_rel = agendamento.get_local()
+    # Esta página é apenas para administradores; filtros aplicados no SQL
+    agendamentos_filtrados = Agendamento.find_filtrados(
+        data_inicio=data_inicio, data_fim=data_fim,
+        status=status_filtro, local_id=local_filtro)
     
-    # Ordenar por data e hora
-    agendamentos_filtrados.sort(key=lambda a: (a.data or '9999-12-31', a.hora or '00:00'))
+    # Adicionar dados relacionados (uma consulta por tabela)
+    Agendamento.carregar_relacionados(agendamentos_filtrados)
     return render_template('agendamentos.html', agendamentos=agendamentos_filtrados, locais=locais, admin=True)
 
 @app.route('/chat', methods=['POST'])
@@ -174,14 +332,10 @@ def processar_chat():
             session_id = str(uuid.uuid4())
             session['chat_session_id'] = session_id
         
-        # Buscar conversa existente
+        # Buscar conversa existente (uma nova só é gravada ao final)
         conversa = Conversa.find_by_session(session_id)
         if not conversa:
-            conversa = Conversa.create(session_id=session_id, estado='inicio')
-        
-        # Atualizar timestamp da conversa
-        conversa.atualizado_em = datetime.utcnow().isoformat()
-        conversa.save()
+            conversa = Conversa(session_id=session_id, estado='inicio')
         
         # Limpeza proativa de sessões abandonadas (5% das vezes)
         import random
@@ -189,19 +343,12 @@ def processar_chat():
             try:
                 from datetime import timedelta
                 data_limite = (datetime.utcnow() - timedelta(hours=6)).isoformat()
-                # Buscar conversas antigas para limpeza
-                query = "SELECT * FROM conversas WHERE atualizado_em < ? AND estado != 'finalizado' LIMIT 5"
-                from database import db
-                rows = db.execute_query(query, (data_limite,))
-                
-                if rows:
-                    # Deletar conversas antigas
-                    for row in rows:
-                        conversa_antiga = Conversa(**dict(row))
-                        conversa_antiga.delete()
-                    logger.info(f"Limpeza: {len(rows)} conversas abandonadas removidas")
+                # Deletar conversas antigas em um único comando
+                removidas = Conversa.delete_abandonadas(data_limite, LIMITE_LIMPEZA_CONVERSAS)
+                if removidas:
+                    logger.info("Limpeza: %s conversas abandonadas removidas", removidas)
             except Exception as cleanup_error:
-                logger.warning(f"Erro na limpeza: {cleanup_error}")
+                logger.warning("Erro na limpeza: %s", cleanup_error)
         
         # Processar mensagem com IA
         resposta = chatbot_service.processar_mensagem(mensagem, conversa)
@@ -209,9 +356,10 @@ def processar_chat():
         # MELHORIA: Adicionar timestamp para cache busting em horários
         if resposta.get('tipo') in ['horarios', 'horarios_atualizados']:
             resposta['timestamp'] = datetime.utcnow().isoformat()
-            resposta['cache_key'] = f"horarios_{datetime.utcnow().timestamp()}"
+            resposta['cache_key'] = f"horarios_{next(SEQUENCIA_CACHE_HORARIOS)}"
         
-        # Salvar mudanças na conversa
+        # Salvar mudanças na conversa (uma única gravação por mensagem)
+        conversa.atualizado_em = datetime.utcnow().isoformat()
         conversa.save()
         
         return jsonify(resposta)
@@ -220,11 +368,12 @@ def processar_chat():
         import traceback
         error_details = traceback.format_exc()
         mensagem = dados.get('mensagem', '') if 'dados' in locals() else 'N/A'
-        logger.error(f"Erro crítico no processamento do chat - Sessão: {session.get('chat_session_id', 'N/A')} - Mensagem: '{mensagem}' - Erro: {e}\n{error_details}")
+        error_id = f"ERR_{secrets.token_hex(6)}"
+        logger.error("Erro crítico no processamento do chat [%s] - Sessão: %s - Mensagem: '%s' - Erro: %s\n%s", error_id, session.get('chat_session_id', 'N/A'), mensagem, e, error_details)
         return jsonify({
             'success': False,
             'message': 'Erro interno do servidor. Nossa equipe foi notificada. Tente novamente em alguns minutos.',
-            'error_id': f"ERR_{int(datetime.utcnow().timestamp())}"
+            'error_id': error_id
         })
 
 @app.route('/chat/upload', methods=['POST'])
@@ -263,6 +412,9 @@ def processar_upload_chat():
         # Buscar dados da conversa
         dados = conversa.get_dados()
         agendamento_temp_id = dados.get('agendamento_temp_id')
+        # Horário escolhido aguardando o pedido médico (gravado só na confirmação)
+        selecao_pendente = (conversa.estado == 'solicitacao_anexo'
+                            and bool(dados.get('data_agendamento')))
         paciente_id = conversa.paciente_id
         
         # Se não há paciente cadastrado, solicitar cadastro primeiro
@@ -289,29 +441,22 @@ def processar_upload_chat():
         if not allowed_file(file.filename):
             return jsonify({
                 'success': False,
-                'message': f'Tipo de arquivo não permitido. Tipos aceitos: {", ".join(ALLOWED_EXTENSIONS)}'
+                'message': f'Tipo de arquivo não permitido. Tipos aceitos: {TIPOS_ACEITOS}'
             })
         
         # Salvar arquivo
         filename = secure_filename(file.filename)
         # Usar agendamento_id se disponível, senão usar paciente_id  
         file_prefix = f"{agendamento.id}" if agendamento else f"pac_{paciente_id}"
-        unique_filename = f"{file_prefix}_{uuid.uuid4().hex[:8]}_{filename}"
+        unique_filename = f"{file_prefix}_{secrets.token_hex(4)}_{filename}"
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
         
         # Criar diretório se não existir
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
         
-        # Obter o tamanho do arquivo antes de salvar
-        file.seek(0, 2)  # Ir para o final do arquivo
-        tamanho_arquivo = file.tell()
-        file.seek(0)  # Voltar para o início
-        
-        # Salvar arquivo
-        file.save(file_path)
-        
-        # Importar modelo ArquivoPaciente
-        from models import ArquivoPaciente
+        # Salvar arquivo (o tamanho vem do arquivo gravado)
+        tamanho_arquivo = salvar_upload(file, file_path)
+        hash_conteudo = deduplicar_upload(file_path)
         
         # Criar registro do arquivo
         arquivo_paciente = ArquivoPaciente.create(
@@ -322,48 +467,52 @@ def processar_upload_chat():
             caminho_arquivo=unique_filename,  # Armazenar apenas o nome do arquivo, não o path completo
             tipo_arquivo=file.content_type or (file.filename.split('.')[-1] if '.' in file.filename else 'unknown'),
             tamanho_arquivo=tamanho_arquivo,
-            descricao='Arquivo enviado via chat'
+            descricao='Arquivo enviado via chat',
+            hash_conteudo=hash_conteudo
         )
         
         # Se há agendamento, atualizar também o registro do agendamento
-        if agendamento:
-            agendamento.anexo_nome = filename
-            agendamento.anexo_path = unique_filename
-            agendamento.status = 'pendente_confirmacao'
-            agendamento.save()
+        if agendamento or selecao_pendente:
+            if agendamento:
+                agendamento.update_fields(anexo_nome=filename,
+                                          anexo_path=unique_filename,
+                                          status='pendente_confirmacao')
+                _anexos_cache.pop(agendamento.id, None)
+            else:
+                # Vinculado ao agendamento quando o paciente confirmar
+                dados['arquivo_id'] = arquivo_paciente.id
             
             # Atualizar dados da conversa
             dados['anexo_recebido'] = True
             dados['anexo_nome'] = filename
+            dados['anexo_path'] = unique_filename
             conversa.set_dados(dados)
             conversa.estado = 'confirmacao'
             conversa.save()
             
-            logger.info(f"Arquivo anexado via chat - Agendamento: {agendamento.id}, Arquivo: {filename}")
+            logger.info("Arquivo anexado via chat - Agendamento: %s, Arquivo: %s", agendamento.id if agendamento else 'pendente', filename)
             
             # Buscar dados para confirmação
-            local = Local.find_by_id(dados.get('local_id'))
-            especialidade = Especialidade.find_by_id(dados.get('especialidade_id'))
+            local = Local.find_by_id_cached(dados.get('local_id'))
+            especialidade = Especialidade.find_by_id_cached(dados.get('especialidade_id'))
             
             return jsonify({
                 'success': True,
-                'message': f"✅ **Arquivo Recebido com Sucesso!**\n\n" +
-                          f"📎 **Arquivo:** {filename}\n\n" +
-                          f"📋 **Resumo do Agendamento**\n\n" +
-                          f"👤 **Paciente:** {paciente.nome}\n" +
-                          f"🩺 **Médico:** {dados.get('medico_nome', 'N/A')}\n" +
-                          f"🏥 **Especialidade:** {especialidade.nome if especialidade else 'N/A'}\n" +
-                          f"📍 **Local:** {local.nome if local else 'N/A'}\n" +
-                          f"📅 **Data:** {dados.get('data_formatada', 'N/A')}\n" +
-                          f"⏰ **Horário:** {dados.get('hora_formatada', 'N/A')}\n" +
-                          f"📎 **Pedido Médico:** ✅ Anexado\n\n" +
-                          f"Confirma o agendamento? Digite **'sim'** para confirmar ou **'não'** para cancelar:",
+                'message': MENSAGEM_RESUMO.format(
+                    cabecalho=f"✅ **Arquivo Recebido com Sucesso!**\n\n📎 **Arquivo:** {filename}\n\n",
+                    paciente=paciente.nome,
+                    medico=dados.get('medico_nome', 'N/A'),
+                    especialidade=especialidade.nome if especialidade else 'N/A',
+                    local=local.nome if local else 'N/A',
+                    data=dados.get('data_formatada', 'N/A'),
+                    hora=dados.get('hora_formatada', 'N/A'),
+                    anexo="📎 **Pedido Médico:** ✅ Anexado\n"),
                 'tipo': 'confirmacao',
                 'proximo_estado': 'confirmacao'
             })
         else:
             # Arquivo geral do paciente (não relacionado a agendamento específico)
-            logger.info(f"Arquivo geral anexado via chat - Paciente: {paciente.nome} ({paciente_id}), Arquivo: {filename}")
+            logger.info("Arquivo geral anexado via chat - Paciente: %s (%s), Arquivo: %s", paciente.nome, paciente_id, filename)
             
             return jsonify({
                 'success': True,
@@ -378,7 +527,7 @@ def processar_upload_chat():
             })
         
     except Exception as e:
-        logger.error(f"Erro no upload via chat: {e}")
+        logger.error("Erro no upload via chat: %s", e)
         return jsonify({
             'success': False,
             'message': 'Erro interno ao processar arquivo. Tente novamente.'
@@ -388,7 +537,6 @@ def processar_upload_chat():
 def download_arquivo_paciente(arquivo_id):
     """Download de arquivo do paciente"""
     try:
-        from models import ArquivoPaciente
         arquivo = ArquivoPaciente.find_by_id(arquivo_id)
         
         if not arquivo:
@@ -399,25 +547,16 @@ def download_arquivo_paciente(arquivo_id):
         
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], arquivo.caminho_arquivo)
         
-        if not os.path.exists(file_path):
+        try:
+            return enviar_anexo(file_path, arquivo.nome_original or 'arquivo')
+        except FileNotFoundError:
             return jsonify({
                 'success': False,
                 'message': 'Arquivo não encontrado no servidor.'
             }), 404
         
-        # Tentar determinar o tipo MIME
-        import mimetypes
-        mimetype = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
-        
-        return send_file(
-            file_path,
-            as_attachment=True,
-            download_name=arquivo.nome_original or 'arquivo',
-            mimetype=mimetype
-        )
-        
     except Exception as e:
-        logger.error(f"Erro ao fazer download de arquivo: {e}")
+        logger.error("Erro ao fazer download de arquivo: %s", e)
         return jsonify({
             'success': False,
             'message': 'Erro ao fazer download do arquivo.'
@@ -439,15 +578,7 @@ def listar_especialidades():
         
         if local_id:
             # Buscar especialidades que têm médicos com horários no local escolhido
-            from database import db
-            query = """
-                SELECT DISTINCT e.* FROM especialidades e
-                JOIN medicos m ON e.id = m.especialidade_id
-                JOIN horarios_disponiveis h ON m.id = h.medico_id
-                WHERE h.local_id = {} AND e.ativo = 1 AND m.ativo = 1 AND h.ativo = 1
-            """.format(local_id)
-            rows = db.execute_query(query)
-            especialidades = [Especialidade(**dict(row)) for row in rows] if rows else []
+            especialidades = Especialidade.find_active_by_local(local_id)
         else:
             # Fallback para todas as especialidades se não tiver local
             especialidades = Especialidade.find_active()
@@ -455,7 +586,7 @@ def listar_especialidades():
         return jsonify([esp.to_dict() for esp in especialidades])
         
     except Exception as e:
-        logger.error(f"Erro ao listar especialidades: {e}")
+        logger.error("Erro ao listar especialidades: %s", e)
         # Fallback em caso de erro
         especialidades = Especialidade.find_active()
         return jsonify([esp.to_dict() for esp in especialidades])
@@ -483,32 +614,31 @@ def verificar_disponibilidade():
         data_agendamento = datetime.strptime(data_str, '%Y-%m-%d').date()
         hora_agendamento = datetime.strptime(hora_str, '%H:%M').time()
         
-        # Verificar agendamento normal
-        from database import db
+        # Verificar agendamento normal e recorrente em uma única consulta
         query = """
-            SELECT * FROM agendamentos 
-            WHERE medico_id = ? AND data = ? AND hora = ? AND status = 'agendado'
+            SELECT EXISTS(
+                       SELECT 1 FROM agendamentos
+                       WHERE medico_id = ? AND data = ? AND hora = ? AND status = 'agendado'
+                   ) AS ocupado,
+                   EXISTS(
+                       SELECT 1 FROM agendamentos_recorrentes
+                       WHERE medico_id = ? AND dia_semana = ? AND hora = ? AND ativo = 1
+                       AND data_inicio <= ? AND (data_fim IS NULL OR data_fim >= ?)
+                   ) AS bloqueado
         """
-        rows = db.execute_query(query, (medico_id, data_str, hora_str))
+        dia_semana = data_agendamento.weekday()
+        conflito = db.execute_query(query, (medico_id, data_str, hora_str,
+                                            medico_id, dia_semana, hora_str,
+                                            data_str, data_str))[0]
         
-        if rows:
+        if conflito['ocupado']:
             return jsonify({
                 'disponivel': False, 
                 'motivo': 'Horário já ocupado por outro paciente',
                 'timestamp': datetime.utcnow().isoformat()
             })
         
-        # Verificar agendamento recorrente
-        dia_semana = data_agendamento.weekday()
-        query_recorrente = """
-            SELECT * FROM agendamentos_recorrentes 
-            WHERE medico_id = ? AND dia_semana = ? AND hora = ? AND ativo = 1
-            AND data_inicio <= ? AND (data_fim IS NULL OR data_fim >= ?)
-        """
-        rows_recorrentes = db.execute_query(query_recorrente, 
-                                          (medico_id, dia_semana, hora_str, data_str, data_str))
-        
-        if rows_recorrentes:
+        if conflito['bloqueado']:
             return jsonify({
                 'disponivel': False, 
                 'motivo': 'Horário bloqueado por agendamento recorrente',
@@ -521,7 +651,7 @@ def verificar_disponibilidade():
         })
         
     except Exception as e:
-        logger.error(f"Erro ao verificar disponibilidade: {e}")
+        logger.error("Erro ao verificar disponibilidade: %s", e)
         return jsonify({'disponivel': False, 'motivo': 'Erro interno'})
 
 @app.route('/cancelar/<int:agendamento_id>', methods=['POST'])
@@ -540,7 +670,7 @@ def cancelar_agendamento(agendamento_id):
         return redirect(url_for('listar_agendamentos'))
         
     except Exception as e:
-        logging.error(f"Erro ao cancelar agendamento: {e}")
+        logging.error("Erro ao cancelar agendamento: %s", e)
         flash('Erro ao cancelar agendamento. Tente novamente.', 'error')
         return redirect(url_for('listar_agendamentos'))
 
@@ -555,14 +685,13 @@ def concluir_agendamento(agendamento_id):
             flash('Agendamento não encontrado.', 'error')
             return redirect(url_for('listar_agendamentos'))
         
-        agendamento.status = 'concluido'
-        agendamento.save()
+        agendamento.update_fields(status='concluido')
         
         flash('Agendamento marcado como concluído!', 'success')
         return redirect(url_for('listar_agendamentos'))
         
     except Exception as e:
-        logging.error(f"Erro ao concluir agendamento: {e}")
+        logging.error("Erro ao concluir agendamento: %s", e)
         flash('Erro ao concluir agendamento. Tente novamente.', 'error')
         return redirect(url_for('listar_agendamentos'))
 
@@ -582,7 +711,7 @@ def cancelar_agendamento_admin(agendamento_id):
         return redirect(url_for('listar_agendamentos'))
         
     except Exception as e:
-        logging.error(f"Erro ao cancelar agendamento: {e}")
+        logging.error("Erro ao cancelar agendamento: %s", e)
         flash('Erro ao cancelar agendamento. Tente novamente.', 'error')
         return redirect(url_for('listar_agendamentos'))
 
@@ -594,9 +723,8 @@ def admin_login():
         senha = request.form.get('senha', '').strip()
         
         email_admin = Configuracao.get_valor('email_admin', 'joao@gmail.com')
-        senha_admin = Configuracao.get_valor('senha_admin', '30031936Vo')
         
-        if email == email_admin and senha == senha_admin:
+        if email == email_admin and senha_admin_confere(senha):
             session['admin_logado'] = True
             session['admin_email'] = email
             flash('Login realizado com sucesso!', 'success')
@@ -619,19 +747,29 @@ def admin_logout():
 def admin():
     """Página administrativa"""
     especialidades = Especialidade.find_all()
-    # Adicionar contagem de médicos para cada especialidade
+    medicos = Medico.find_all()
+    
+    # Adicionar médicos de cada especialidade (agrupados da lista já carregada)
+    medicos_por_especialidade = {}
+    for medico in medicos:
+        medicos_por_especialidade.setdefault(medico.especialidade_id, []).append(medico)
     for esp in especialidades:
-        esp.medicos = esp.get_medicos()
+        esp.medicos = medicos_por_especialidade.get(esp.id, [])
     
-    medicos = Medico.find_all()
     locais = Local.find_all()
     horarios_disponiveis = HorarioDisponivel.find_all()
     pacientes = Paciente.find_all()
     
+    # get_especialidade()/get_local() do template usam as listas já carregadas
+    Medico.preload_relations(medicos, 'especialidade', Especialidade, 'especialidade_id', especialidades)
+    HorarioDisponivel.preload_relations(horarios_disponiveis, 'local', Local, 'local_id', locais)
+    
     # Agrupar horários por médico para melhor visualização
+    # (médicos já carregados acima: sem uma consulta por horário)
+    medicos_por_id = {medico.id: medico for medico in medicos}
     horarios_agrupados = {}
     for horario in horarios_disponiveis:
-        medico = horario.get_medico()
+        medico = medicos_por_id.get(horario.medico_id)
         medico_nome = medico.nome if medico else 'Médico não encontrado'
         medico_id = horario.medico_id
         chave = f"{medico_id}_{medico_nome}"
@@ -645,49 +783,13 @@ def admin():
     
     # Estatísticas
     total_pacientes = len(pacientes)
-    agendamentos_todos = Agendamento.find_all()
-    total_agendamentos = len(agendamentos_todos)
-    agendamentos_hoje = len(Agendamento.find_active_for_today())
+    total_agendamentos = Agendamento.count()
+    agendamentos_hoje = Agendamento.count_active_for_today()
     total_especialidades = len(Especialidade.find_active())
     
-    # Stats por especialidade para relatórios
-    agendamentos_por_especialidade = []
-    for esp in especialidades:
-        agendamentos_esp = [a for a in agendamentos_todos if a.especialidade_id == esp.id]
-        total = len(agendamentos_esp)
-        agendados = len([a for a in agendamentos_esp if a.status == 'agendado'])
-        concluidos = len([a for a in agendamentos_esp if a.status == 'concluido'])
-        cancelados = len([a for a in agendamentos_esp if a.status == 'cancelado'])
-        
-        if total > 0:  # Só incluir especialidades com agendamentos
-            agendamentos_por_especialidade.append({
-                'especialidade': esp.nome,
-                'total': total,
-                'agendados': agendados,
-                'concluidos': concluidos,
-                'cancelados': cancelados
-            })
-    
-    # Relatório de pacientes por especialidade 
-    pacientes_especialidades = []
-    for paciente in pacientes:
-        # Buscar todas as especialidades que este paciente já consultou/agendou
-        agendamentos_paciente = [a for a in agendamentos_todos if a.paciente_id == paciente.id]
-        especialidades_ids = list(set([a.especialidade_id for a in agendamentos_paciente]))
-        
-        if especialidades_ids:  # Só incluir pacientes que têm agendamentos
-            especialidades_nomes = []
-            for esp_id in especialidades_ids:
-                esp = Especialidade.find_by_id(esp_id)
-                if esp:
-                    especialidades_nomes.append(esp.nome)
-            
-            pacientes_especialidades.append({
-                'nome': paciente.nome,
-                'cpf': paciente.cpf,
-                'especialidades': especialidades_nomes,
-                'total_agendamentos': len(agendamentos_paciente)
-            })
+    # Stats por especialidade e pacientes por especialidade (agregados no SQL)
+    agendamentos_por_especialidade = Agendamento.estatisticas_por_especialidade()
+    pacientes_especialidades = Paciente.resumo_especialidades()
     
     return render_template('admin.html',
                          especialidades=especialidades,
@@ -707,11 +809,8 @@ def admin():
 @requer_login_admin
 def admin_config():
     """Página de configurações"""
-    configuracoes = {}
     chaves_config = ['nome_clinica', 'nome_assistente', 'telefone_clinica', 'email_admin', 'horario_funcionamento', 'bloquear_especialidades_duplicadas', 'duracao_agendamento_recorrente']
-    
-    for chave in chaves_config:
-        configuracoes[chave] = Configuracao.get_valor(chave, '')
+    configuracoes = Configuracao.get_muitos(dict.fromkeys(chaves_config, ''))
     
     return render_template('admin_config.html', configuracoes=configuracoes, locais=Local.find_all())
 
@@ -738,7 +837,7 @@ def salvar_config():
         if email_admin:
             Configuracao.set_valor('email_admin', email_admin)
         if senha_admin:
-            Configuracao.set_valor('senha_admin', senha_admin)
+            Configuracao.set_valor('senha_admin', generate_password_hash(senha_admin))
         if horario_funcionamento:
             Configuracao.set_valor('horario_funcionamento', horario_funcionamento)
         
@@ -752,7 +851,7 @@ def salvar_config():
         return redirect(url_for('admin_config'))
         
     except Exception as e:
-        logging.error(f"Erro ao salvar configurações: {e}")
+        logging.error("Erro ao salvar configurações: %s", e)
         flash('Erro ao salvar configurações. Tente novamente.', 'error')
         return redirect(url_for('admin_config'))
 
@@ -769,23 +868,22 @@ def admin_especialidades():
             flash('Nome da especialidade é obrigatório.', 'error')
             return redirect(url_for('admin'))
         
-        # Verificar se já existe
-        existe = Especialidade.find_one_where({'nome': nome})
-        if existe:
+        # Nome duplicado é barrado pelo UNIQUE da tabela
+        try:
+            Especialidade.create(
+                nome=nome, 
+                descricao=descricao if descricao else None,
+                requer_anexo=requer_anexo
+            )
+        except sqlite3.IntegrityError:
             flash('Especialidade já existe.', 'error')
             return redirect(url_for('admin'))
         
-        Especialidade.create(
-            nome=nome, 
-            descricao=descricao if descricao else None,
-            requer_anexo=requer_anexo
-        )
-        
         flash(f'Especialidade "{nome}" cadastrada com sucesso!', 'success')
         return redirect(url_for('admin'))
         
     except Exception as e:
-        logging.error(f"Erro ao cadastrar especialidade: {e}")
+        logging.error("Erro ao cadastrar especialidade: %s", e)
         flash('Erro ao cadastrar especialidade. Tente novamente.', 'error')
         return redirect(url_for('admin'))
 
@@ -802,25 +900,24 @@ def admin_medicos():
             flash('Todos os campos são obrigatórios.', 'error')
             return redirect(url_for('admin'))
         
-        # Verificar se CRM já existe
-        existe = Medico.find_one_where({'crm': crm})
-        if existe:
-            flash('CRM já cadastrado.', 'error')
-            return redirect(url_for('admin'))
-        
         # Verificar se especialidade existe
-        especialidade = Especialidade.find_by_id(int(especialidade_id))
+        especialidade = Especialidade.find_by_id_cached(int(especialidade_id))
         if not especialidade:
             flash('Especialidade não encontrada.', 'error')
             return redirect(url_for('admin'))
         
-        Medico.create(nome=nome, crm=crm, especialidade_id=int(especialidade_id))
+        # CRM duplicado é barrado pelo UNIQUE da tabela
+        try:
+            Medico.create(nome=nome, crm=crm, especialidade_id=int(especialidade_id))
+        except sqlite3.IntegrityError:
+            flash('CRM já cadastrado.', 'error')
+            return redirect(url_for('admin'))
         
         flash(f'Médico "{nome}" cadastrado com sucesso!', 'success')
         return redirect(url_for('admin'))
         
     except Exception as e:
-        logging.error(f"Erro ao cadastrar médico: {e}")
+        logging.error("Erro ao cadastrar médico: %s", e)
         flash('Erro ao cadastrar médico. Tente novamente.', 'error')
         return redirect(url_for('admin'))
 
@@ -838,24 +935,23 @@ def admin_locais():
             flash('Nome do local é obrigatório.', 'error')
             return redirect(url_for('admin'))
         
-        # Verificar se já existe
-        existe = Local.find_one_where({'nome': nome})
-        if existe:
+        # Nome duplicado é barrado pelo UNIQUE da tabela
+        try:
+            Local.create(
+                nome=nome,
+                endereco=endereco if endereco else None,
+                cidade=cidade if cidade else None,
+                telefone=telefone if telefone else None
+            )
+        except sqlite3.IntegrityError:
             flash('Local já existe.', 'error')
             return redirect(url_for('admin'))
         
-        Local.create(
-            nome=nome,
-            endereco=endereco if endereco else None,
-            cidade=cidade if cidade else None,
-            telefone=telefone if telefone else None
-        )
-        
         flash(f'Local "{nome}" cadastrado com sucesso!', 'success')
         return redirect(url_for('admin'))
         
     except Exception as e:
-        logging.error(f"Erro ao cadastrar local: {e}")
+        logging.error("Erro ao cadastrar local: %s", e)
         flash('Erro ao cadastrar local. Tente novamente.', 'error')
         return redirect(url_for('admin'))
 
@@ -864,12 +960,8 @@ def admin_locais():
 def admin_horarios():
     """Cadastrar novo horário disponível"""
     try:
-        medico_id = request.form.get('medico_id', '').strip()
-        local_id = request.form.get('local_id', '').strip()
-        dia_semana = request.form.get('dia_semana', '').strip()
-        hora_inicio = request.form.get('hora_inicio', '').strip()
-        hora_fim = request.form.get('hora_fim', '').strip()
-        duracao_consulta = request.form.get('duracao_consulta', '30').strip()
+        (medico_id, local_id, dia_semana, hora_inicio, hora_fim,
+         duracao_consulta) = campos_formulario(CAMPOS_HORARIO, duracao_consulta='30')
         
         if not all([medico_id, local_id, dia_semana, hora_inicio, hora_fim]):
             flash('Todos os campos são obrigatórios.', 'error')
@@ -888,28 +980,40 @@ def admin_horarios():
         return redirect(url_for('admin'))
         
     except Exception as e:
-        logging.error(f"Erro ao cadastrar horário: {e}")
+        logging.error("Erro ao cadastrar horário: %s", e)
         flash('Erro ao cadastrar horário. Tente novamente.', 'error')
         return redirect(url_for('admin'))
 
-# Log de sistema ativo (para debug) - Removido before_first_request depreciado
-def log_sistema_ativo():
-    """Log quando o sistema ficar ativo"""
-    logger.info("Sistema João Layon Ativo: SQLite3 Version")
+def estatisticas_sistema():
+    """Resumo do sistema (contagens com COUNT no banco, reaproveitadas por alguns segundos)"""
+    agora = monotonic()
+    if _estatisticas_cache['valor'] is not None and agora < _estatisticas_cache['expira_em']:
+        return _estatisticas_cache['valor']
+    
     stats = {
         'status': 'ativo',
         'versao': '2.0.0 - SQLite3 Pure',
         'desenvolvedor': 'João Layon',
         'preco_mensal': 'R$ 19,90',
-        'total_pacientes': len(Paciente.find_all()),
-        'total_agendamentos': len(Agendamento.find_all()),
-        'agendamentos_hoje': len(Agendamento.find_active_for_today()),
-        'especialidades': len(Especialidade.find_active())
+        'total_pacientes': Paciente.count(),
+        'total_agendamentos': Agendamento.count(),
+        'agendamentos_hoje': Agendamento.count_active_for_today(),
+        'especialidades': Especialidade.count_where({'ativo': 1})
     }
+    _estatisticas_cache['valor'] = stats
+    _estatisticas_cache['expira_em'] = agora + ESTATISTICAS_TTL_SEGUNDOS
+    return stats
+
+# Log de sistema ativo (para debug) - Removido before_first_request depreciado
+def log_sistema_ativo():
+    """Log quando o sistema ficar ativo"""
+    logger.info("Sistema João Layon Ativo: SQLite3 Version")
+    stats = estatisticas_sistema()
     print("Sistema João Layon Ativo:", stats)
 
-# Executar log no carregamento do módulo
-log_sistema_ativo()
+# Executar log no carregamento do módulo (opcional: cada worker pagaria as contagens)
+if os.environ.get('LOG_SISTEMA_ATIVO', '0').lower() in ('1', 'true', 'sim'):
+    log_sistema_ativo()
 
 # Rota para editar médico
 @app.route('/admin/medico/<int:medico_id>/edit')
@@ -967,7 +1071,7 @@ def salvar_local(local_id):
         return redirect(url_for('admin'))
         
     except Exception as e:
-        logging.error(f"Erro ao atualizar local: {e}")
+        logging.error("Erro ao atualizar local: %s", e)
         flash('Erro ao salvar alterações. Tente novamente.', 'error')
         return redirect(url_for('editar_local', local_id=local_id))
 
@@ -981,59 +1085,54 @@ def detalhes_paciente(paciente_id):
         if not paciente:
             return jsonify({'success': False, 'message': 'Paciente não encontrado'})
         
-        # Buscar agendamentos do paciente
-        agendamentos = Agendamento.find_where({'paciente_id': paciente_id})
+        # Contagens por status e últimos agendamentos direto no SQL
+        contagem = Agendamento.count_by_status_for_paciente(paciente_id)
+        ultimos = Agendamento.historico_paciente(paciente_id, 5)
         
-        # Gerar HTML com os detalhes
-        html = f"""
+        # Gerar HTML com os detalhes (partes unidas no final; dados escapados)
+        partes = [f"""
         <div class="row">
             <div class="col-md-6">
                 <h6>Informações Pessoais</h6>
-                <p><strong>Nome:</strong> {paciente.nome}</p>
-                <p><strong>CPF:</strong> {paciente.cpf}</p>
-                <p><strong>Telefone:</strong> {paciente.telefone or 'Não informado'}</p>
-                <p><strong>Email:</strong> {paciente.email or 'Não informado'}</p>
-                <p><strong>Data de Nascimento:</strong> {paciente.data_nascimento or 'Não informado'}</p>
+                <p><strong>Nome:</strong> {escape(paciente.nome)}</p>
+                <p><strong>CPF:</strong> {escape(paciente.cpf)}</p>
+                <p><strong>Telefone:</strong> {escape(paciente.telefone or 'Não informado')}</p>
+                <p><strong>Email:</strong> {escape(paciente.email or 'Não informado')}</p>
+                <p><strong>Data de Nascimento:</strong> {escape(paciente.data_nascimento or 'Não informado')}</p>
             </div>
             <div class="col-md-6">
                 <h6>Estatísticas</h6>
-                <p><strong>Total de Agendamentos:</strong> {len(agendamentos)}</p>
-                <p><strong>Agendamentos Ativos:</strong> {len([a for a in agendamentos if a.status == 'agendado'])}</p>
-                <p><strong>Concluídos:</strong> {len([a for a in agendamentos if a.status == 'concluido'])}</p>
-                <p><strong>Cancelados:</strong> {len([a for a in agendamentos if a.status == 'cancelado'])}</p>
+                <p><strong>Total de Agendamentos:</strong> {sum(contagem.values())}</p>
+                <p><strong>Agendamentos Ativos:</strong> {contagem.get('agendado', 0)}</p>
+                <p><strong>Concluídos:</strong> {contagem.get('concluido', 0)}</p>
+                <p><strong>Cancelados:</strong> {contagem.get('cancelado', 0)}</p>
             </div>
         </div>
-        """
+        """]
         
-        if agendamentos:
-            html += "<hr><h6>Últimos Agendamentos</h6><div class='table-responsive'><table class='table table-sm'>"
-            html += "<thead><tr><th>Data</th><th>Hora</th><th>Especialidade</th><th>Status</th></tr></thead><tbody>"
+        if ultimos:
+            partes.append("<hr><h6>Últimos Agendamentos</h6><div class='table-responsive'><table class='table table-sm'>")
+            partes.append("<thead><tr><th>Data</th><th>Hora</th><th>Especialidade</th><th>Status</th></tr></thead><tbody>")
             
-            # Mostrar últimos 5 agendamentos
-            for agendamento in sorted(agendamentos, key=lambda x: x.data or '0000-00-00', reverse=True)[:5]:
-                status_class = {
-                    'agendado': 'success',
-                    'concluido': 'info', 
-                    'cancelado': 'danger'
-                }.get(agendamento.status, 'secondary')
+            # Mostrar últimos 5 agendamentos (nomes já vêm da view)
+            for agendamento in ultimos:
+                status_class = STATUS_BADGE.get(agendamento['status'], 'secondary')
+                especialidade_nome = agendamento['especialidade_nome'] or 'N/A'
                 
-                especialidade = Especialidade.find_by_id(agendamento.especialidade_id)
-                especialidade_nome = especialidade.nome if especialidade else 'N/A'
-                
-                html += f"""
+                partes.append(f"""
                 <tr>
-                    <td>{agendamento.data or 'N/A'}</td>
-                    <td>{agendamento.hora or 'N/A'}</td>
-                    <td>{especialidade_nome}</td>
-                    <td><span class="badge bg-{status_class}">{agendamento.status.title()}</span></td>
+                    <td>{escape(agendamento['data'] or 'N/A')}</td>
+                    <td>{escape(agendamento['hora'] or 'N/A')}</td>
+                    <td>{escape(especialidade_nome)}</td>
+                    <td><span class="badge bg-{status_class}">{escape(agendamento['status'].title())}</span></td>
                 </tr>
-                """
-            html += "</tbody></table></div>"
+                """)
+            partes.append("</tbody></table></div>")
         
-        return jsonify({'success': True, 'html': html})
+        return jsonify({'success': True, 'html': ''.join(partes)})
         
     except Exception as e:
-        logging.error(f"Erro ao buscar detalhes do paciente: {e}")
+        logging.error("Erro ao buscar detalhes do paciente: %s", e)
         return jsonify({'success': False, 'message': 'Erro interno do servidor'})
 
 # Rota para buscar histórico do paciente (AJAX)
@@ -1046,49 +1145,38 @@ def historico_paciente(paciente_id):
         if not paciente:
             return jsonify({'success': False, 'message': 'Paciente não encontrado'})
         
-        # Buscar todos os agendamentos do paciente
-        agendamentos = Agendamento.find_where({'paciente_id': paciente_id})
-        
-        # Ordenar por data (mais recente primeiro)
-        agendamentos_ordenados = sorted(agendamentos, key=lambda x: x.data or '0000-00-00', reverse=True)
+        # Agendamentos do paciente (mais recente primeiro) com os nomes já resolvidos
+        historico = Agendamento.historico_paciente(paciente_id)
         
         # Gerar HTML com o histórico
-        html = f"<h6>Histórico Completo - {paciente.nome}</h6>"
+        partes = [f"<h6>Histórico Completo - {escape(paciente.nome)}</h6>"]
         
-        if not agendamentos_ordenados:
-            html += "<div class='alert alert-info'>Este paciente ainda não possui agendamentos.</div>"
+        if not historico:
+            partes.append("<div class='alert alert-info'>Este paciente ainda não possui agendamentos.</div>")
         else:
-            html += "<div class='table-responsive'><table class='table table-hover'>"
-            html += "<thead><tr><th>Data</th><th>Hora</th><th>Especialidade</th><th>Médico</th><th>Status</th></tr></thead><tbody>"
+            partes.append("<div class='table-responsive'><table class='table table-hover'>")
+            partes.append("<thead><tr><th>Data</th><th>Hora</th><th>Especialidade</th><th>Médico</th><th>Status</th></tr></thead><tbody>")
             
-            for agendamento in agendamentos_ordenados:
-                status_class = {
-                    'agendado': 'success',
-                    'concluido': 'info', 
-                    'cancelado': 'danger'
-                }.get(agendamento.status, 'secondary')
+            for agendamento in historico:
+                status_class = STATUS_BADGE.get(agendamento['status'], 'secondary')
+                especialidade_nome = agendamento['especialidade_nome'] or 'N/A'
+                medico_nome = agendamento['medico_nome'] or 'N/A'
                 
-                especialidade = Especialidade.find_by_id(agendamento.especialidade_id)
-                especialidade_nome = especialidade.nome if especialidade else 'N/A'
-                
-                medico = Medico.find_by_id(agendamento.medico_id) if agendamento.medico_id else None
-                medico_nome = medico.nome if medico else 'N/A'
-                
-                html += f"""
+                partes.append(f"""
                 <tr>
-                    <td>{agendamento.data or 'N/A'}</td>
-                    <td>{agendamento.hora or 'N/A'}</td>
-                    <td>{especialidade_nome}</td>
-                    <td>{medico_nome}</td>
-                    <td><span class="badge bg-{status_class}">{agendamento.status.title()}</span></td>
+                    <td>{escape(agendamento['data'] or 'N/A')}</td>
+                    <td>{escape(agendamento['hora'] or 'N/A')}</td>
+                    <td>{escape(especialidade_nome)}</td>
+                    <td>{escape(medico_nome)}</td>
+                    <td><span class="badge bg-{status_class}">{escape(agendamento['status'].title())}</span></td>
                 </tr>
-                """
-            html += "</tbody></table></div>"
+                """)
+            partes.append("</tbody></table></div>")
         
-        return jsonify({'success': True, 'html': html})
+        return jsonify({'success': True, 'html': ''.join(partes)})
         
     except Exception as e:
-        logging.error(f"Erro ao buscar histórico do paciente: {e}")
+        logging.error("Erro ao buscar histórico do paciente: %s", e)
         return jsonify({'success': False, 'message': 'Erro interno do servidor'})
 
 # Rotas de edição para admin
@@ -1110,8 +1198,7 @@ def editar_especialidade(especialidade_id):
             return jsonify({'success': False, 'message': 'Nome é obrigatório.'})
         
         # Verificar se já existe outro com mesmo nome
-        existe = Especialidade.find_one_where({'nome': nome})
-        if existe and existe.id != especialidade_id:
+        if Especialidade.exists_where({'nome': nome}, exceto_id=especialidade_id):
             return jsonify({'success': False, 'message': 'Já existe outra especialidade com este nome.'})
         
         # Atualizar os dados
@@ -1134,7 +1221,7 @@ def editar_especialidade(especialidade_id):
         })
         
     except Exception as e:
-        logging.error(f"Erro ao editar especialidade: {e}")
+        logging.error("Erro ao editar especialidade: %s", e)
         return jsonify({'success': False, 'message': 'Erro interno do servidor.'})
 
 @app.route('/admin/especialidade/<int:especialidade_id>/toggle', methods=['POST'])
@@ -1146,8 +1233,7 @@ def toggle_especialidade(especialidade_id):
         if not especialidade:
             return jsonify({'success': False, 'message': 'Especialidade não encontrada.'})
         
-        especialidade.ativo = not especialidade.ativo
-        especialidade.save()
+        especialidade.update_fields(ativo=not especialidade.ativo)
         
         return jsonify({
             'success': True, 
@@ -1156,7 +1242,7 @@ def toggle_especialidade(especialidade_id):
         })
         
     except Exception as e:
-        logging.error(f"Erro ao alterar status da especialidade: {e}")
+        logging.error("Erro ao alterar status da especialidade: %s", e)
         return jsonify({'success': False, 'message': 'Erro interno do servidor.'})
 
 @app.route('/admin/medico/<int:medico_id>/edit', methods=['POST'])
@@ -1181,13 +1267,12 @@ def salvar_medico(medico_id):
             return redirect(url_for('editar_medico', medico_id=medico_id))
         
         # Verificar se CRM já existe em outro médico
-        existe = Medico.find_one_where({'crm': crm})
-        if existe and existe.id != medico_id:
+        if Medico.exists_where({'crm': crm}, exceto_id=medico_id):
             flash('CRM já cadastrado para outro médico.', 'error')
             return redirect(url_for('editar_medico', medico_id=medico_id))
         
         # Verificar se especialidade existe
-        especialidade = Especialidade.find_by_id(int(especialidade_id))
+        especialidade = Especialidade.find_by_id_cached(int(especialidade_id))
         if not especialidade:
             flash('Especialidade não encontrada.', 'error')
             return redirect(url_for('editar_medico', medico_id=medico_id))
@@ -1205,7 +1290,7 @@ def salvar_medico(medico_id):
         return redirect(url_for('admin'))
         
     except Exception as e:
-        logging.error(f"Erro ao atualizar médico: {e}")
+        logging.error("Erro ao atualizar médico: %s", e)
         flash('Erro ao salvar alterações. Tente novamente.', 'error')
         return redirect(url_for('editar_medico', medico_id=medico_id))
 
@@ -1218,19 +1303,15 @@ def editar_horario(horario_id):
         if not horario:
             return jsonify({'success': False, 'message': 'Horário não encontrado.'})
         
-        medico_id = request.form.get('medico_id', '').strip()
-        local_id = request.form.get('local_id', '').strip()
-        dia_semana = request.form.get('dia_semana', '').strip()
-        hora_inicio = request.form.get('hora_inicio', '').strip()
-        hora_fim = request.form.get('hora_fim', '').strip()
-        duracao_consulta = request.form.get('duracao_consulta', '30').strip()
+        (medico_id, local_id, dia_semana, hora_inicio, hora_fim,
+         duracao_consulta) = campos_formulario(CAMPOS_HORARIO, duracao_consulta='30')
         
         if not all([medico_id, local_id, dia_semana, hora_inicio, hora_fim]):
             return jsonify({'success': False, 'message': 'Todos os campos são obrigatórios.'})
         
-        # Verificar se médico e local existem
-        medico = Medico.find_by_id(int(medico_id))
-        local = Local.find_by_id(int(local_id))
+        # Verificar se médico e local existem (leitura pelo cache TTL)
+        medico = Medico.find_by_id_cached(int(medico_id))
+        local = Local.find_by_id_cached(int(local_id))
         
         if not medico:
             return jsonify({'success': False, 'message': 'Médico não encontrado.'})
@@ -1252,7 +1333,7 @@ def editar_horario(horario_id):
         })
         
     except Exception as e:
-        logging.error(f"Erro ao editar horário: {e}")
+        logging.error("Erro ao editar horário: %s", e)
         return jsonify({'success': False, 'message': 'Erro interno do servidor.'})
 
 # Rotas de exclusão para admin
@@ -1271,7 +1352,7 @@ def deletar_especialidade(especialidade_id):
         return redirect(url_for('admin'))
         
     except Exception as e:
-        logging.error(f"Erro ao deletar especialidade: {e}")
+        logging.error("Erro ao deletar especialidade: %s", e)
         flash('Erro ao excluir especialidade. Tente novamente.', 'error')
         return redirect(url_for('admin'))
 
@@ -1285,25 +1366,31 @@ def deletar_medico(medico_id):
             flash('Médico não encontrado.', 'error')
             return redirect(url_for('admin'))
         
-        # Verificar se o médico tem horários ou agendamentos associados
-        horarios = HorarioDisponivel.find_where({'medico_id': medico_id})
-        agendamentos = Agendamento.find_where({'medico_id': medico_id})
-        
-        if horarios or agendamentos:
-            total_registros = len(horarios) + len(agendamentos)
-            flash(f'Não é possível excluir este médico pois ele possui {len(horarios)} horário(s) e {len(agendamentos)} agendamento(s) associados. Delete primeiro os horários e agendamentos relacionados.', 'error')
+        # As chaves estrangeiras (foreign_keys = ON) barram a exclusão se houver
+        # horários, agendamentos ou recorrências associados; só então contamos
+        # para a mensagem
+        try:
+            medico.delete()
+        except sqlite3.IntegrityError:
+            associados = [
+                f'{total} {rotulo}' for total, rotulo in (
+                    (HorarioDisponivel.count_where({'medico_id': medico_id}), 'horário(s)'),
+                    (Agendamento.count_where({'medico_id': medico_id}), 'agendamento(s)'),
+                    (AgendamentoRecorrente.count_where({'medico_id': medico_id}), 'agendamento(s) recorrente(s)'),
+                ) if total
+            ]
+            if associados:
+                flash(f'Não é possível excluir este médico pois ele possui {", ".join(associados)} associados. Delete primeiro os registros relacionados.', 'error')
+            else:
+                flash('Não é possível excluir este médico pois ele possui registros associados.', 'error')
             return redirect(url_for('admin'))
         
-        medico.delete()
         flash(f'Dr(a). {medico.nome} foi excluído(a) com sucesso!', 'success')
         return redirect(url_for('admin'))
         
     except Exception as e:
-        logging.error(f"Erro ao deletar médico: {e}")
-        if "FOREIGN KEY constraint failed" in str(e):
-            flash('Não é possível excluir este médico pois ele possui registros associados (horários ou agendamentos).', 'error')
-        else:
-            flash('Erro ao excluir médico. Tente novamente.', 'error')
+        logging.error("Erro ao deletar médico: %s", e)
+        flash('Erro ao excluir médico. Tente novamente.', 'error')
         return redirect(url_for('admin'))
 
 @app.route('/admin/horario/<int:horario_id>/delete', methods=['POST'])
@@ -1321,7 +1408,7 @@ def deletar_horario(horario_id):
         return redirect(url_for('admin'))
         
     except Exception as e:
-        logging.error(f"Erro ao deletar horário: {e}")
+        logging.error("Erro ao deletar horário: %s", e)
         flash('Erro ao excluir horário. Tente novamente.', 'error')
         return redirect(url_for('admin'))
 
@@ -1340,10 +1427,14 @@ def deletar_local(local_id):
         return redirect(url_for('admin'))
         
     except Exception as e:
-        logging.error(f"Erro ao deletar local: {e}")
+        logging.error("Erro ao deletar local: %s", e)
         flash('Erro ao excluir local. Tente novamente.', 'error')
         return redirect(url_for('admin'))
 
+# Tabelas apagadas ao zerar o banco (em ordem, por causa das chaves estrangeiras)
+TABELAS_ZERADAS = ('agendamentos', 'horarios_disponiveis', 'medicos',
+                   'especialidades', 'pacientes', 'conversas')
+
 @app.route('/admin/zerar-banco-dados', methods=['POST'])
 @requer_login_admin
 def zerar_banco_dados():
@@ -1355,40 +1446,42 @@ def zerar_banco_dados():
             flash('Operação cancelada. Confirmação inválida.', 'error')
             return redirect(url_for('admin_config'))
         
-        # Conectar diretamente ao banco para desabilitar foreign keys temporariamente
-        import sqlite3
-        conn = sqlite3.connect('sistema_agendamento.db')
-        conn.execute('PRAGMA foreign_keys = OFF')
-        
-        try:
-            # Deletar em ordem para evitar problemas de chave estrangeira
-            conn.execute('DELETE FROM agendamentos')
-            conn.execute('DELETE FROM horarios_disponiveis')
-            conn.execute('DELETE FROM medicos')
-            conn.execute('DELETE FROM especialidades')
-            conn.execute('DELETE FROM pacientes')
-            conn.execute('DELETE FROM conversas')
-            
-            # Resetar contadores de ID
-            conn.execute('DELETE FROM sqlite_sequence WHERE name IN ("agendamentos", "horarios_disponiveis", "medicos", "especialidades", "pacientes", "conversas")')
+        # Usar a conexão do request, desabilitando foreign keys temporariamente
+        with db.conexao() as conn:
+            conn.execute('PRAGMA foreign_keys = OFF')
             
-            conn.commit()
-            
-            # Contar o que restou
-            cursor = conn.execute('SELECT COUNT(*) FROM locais')
-            locais_count = cursor.fetchone()[0]
-            
-            flash(f'✅ Banco de dados zerado com sucesso! Mantidos {locais_count} locais.', 'success')
-            logging.info(f"Banco de dados zerado pelo admin. {locais_count} locais mantidos.")
-            
-        finally:
-            conn.execute('PRAGMA foreign_keys = ON')
-            conn.close()
+            try:
+                # Uma única transação (trava de escrita obtida já no início)
+                conn.execute('BEGIN IMMEDIATE')
+                
+                # Deletar em ordem para evitar problemas de chave estrangeira
+                for tabela in TABELAS_ZERADAS:
+                    conn.execute(f'DELETE FROM {tabela}')
+                
+                # Resetar contadores de ID
+                placeholders = ', '.join('?' for _ in TABELAS_ZERADAS)
+                conn.execute(f'DELETE FROM sqlite_sequence WHERE name IN ({placeholders})', TABELAS_ZERADAS)
+                
+                conn.commit()
+                limpar_cache()
+                _anexos_cache.clear()
+                
+                # Contar o que restou
+                cursor = conn.execute('SELECT COUNT(*) FROM locais')
+                locais_count = cursor.fetchone()[0]
+                
+                flash(f'✅ Banco de dados zerado com sucesso! Mantidos {locais_count} locais.', 'success')
+                logging.info("Banco de dados zerado pelo admin. %s locais mantidos.", locais_count)
+                
+            finally:
+                # PRAGMA foreign_keys não tem efeito dentro de uma transação aberta
+                conn.rollback()
+                conn.execute('PRAGMA foreign_keys = ON')
             
         return redirect(url_for('admin_config'))
         
     except Exception as e:
-        logging.error(f"Erro ao zerar banco de dados: {e}")
+        logging.error("Erro ao zerar banco de dados: %s", e)
         flash('Erro ao zerar banco de dados. Tente novamente.', 'error')
         return redirect(url_for('admin_config'))
 
@@ -1396,16 +1489,7 @@ def zerar_banco_dados():
 @app.route('/log-test')
 def log_test():
     """Rota para testar logs no console JavaScript"""
-    stats = {
-        'status': 'ativo',
-        'versao': '2.0.0 - SQLite3 Pure',
-        'desenvolvedor': 'João Layon',
-        'preco_mensal': 'R$ 19,90',
-        'total_pacientes': len(Paciente.find_all()),
-        'total_agendamentos': len(Agendamento.find_all()),
-        'agendamentos_hoje': len(Agendamento.find_active_for_today()),
-        'especialidades': len(Especialidade.find_active())
-    }
+    stats = estatisticas_sistema()
     
     html = f"""
     <script>
@@ -1435,10 +1519,104 @@ def pagina_anexo_paciente(agendamento_id):
         return render_template('anexar_arquivo.html', agendamento=agendamento)
         
     except Exception as e:
-        logger.error(f"Erro ao carregar página de anexo: {e}")
+        logger.error("Erro ao carregar página de anexo: %s", e)
         flash('Erro ao carregar página.', 'error')
         return redirect(url_for('index'))
 
+@app.route('/anexar-pedido/<token>')
+def pagina_anexo_pedido(token):
+    """Página de upload do pedido médico para um horário ainda não gravado"""
+    dados_token = ler_token_anexo(token)
+    if not dados_token:
+        flash('Link de anexo inválido ou expirado. Solicite um novo link no chat.', 'error')
+        return redirect(url_for('index'))
+    
+    agendamento = Agendamento(**dados_token['selecao'])
+    agendamento.paciente_rel = agendamento.get_paciente()
+    agendamento.medico_rel = agendamento.get_medico()
+    agendamento.especialidade_rel = agendamento.get_especialidade()
+    
+    return render_template('anexar_arquivo.html', agendamento=agendamento,
+                           upload_url=url_for('upload_anexo_pedido', token=token))
+
+@app.route('/anexar-pedido/<token>', methods=['POST'])
+def upload_anexo_pedido(token):
+    """Guarda o pedido médico na conversa; o agendamento é gravado quando o
+    paciente confirma no chat (o link vale para um único envio)"""
+    dados_token = ler_token_anexo(token)
+    if not dados_token:
+        flash('Link de anexo inválido ou expirado. Solicite um novo link no chat.', 'error')
+        return redirect(url_for('index'))
+    selecao = dados_token['selecao']
+    
+    try:
+        file = request.files.get('arquivo')
+        if not file or file.filename == '':
+            flash('Nenhum arquivo foi selecionado.', 'error')
+            return redirect(url_for('pagina_anexo_pedido', token=token))
+        
+        if not allowed_file(file.filename):
+            flash(f'Tipo de arquivo não permitido. Tipos aceitos: {TIPOS_ACEITOS}', 'error')
+            return redirect(url_for('pagina_anexo_pedido', token=token))
+        
+        filename = secure_filename(file.filename)
+        unique_filename = f"pac_{selecao['paciente_id']}_{secrets.token_hex(4)}_{filename}"
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+        tamanho_arquivo = salvar_upload(file, file_path)
+        hash_conteudo = deduplicar_upload(file_path)
+        
+        # Conversa relida dentro da transação: o uso do link e o arquivo são
+        # registrados juntos, e um segundo envio com o mesmo link é recusado
+        with db.transacao():
+            conversa = Conversa.find_by_id(dados_token['conversa_id'])
+            dados = conversa.get_dados() if conversa else {}
+            if dados.get('anexo_token_uso') == dados_token['uso']:
+                motivo = 'Este link já foi utilizado. Continue o agendamento pelo chat.'
+            elif (conversa is None
+                  or conversa.paciente_id != selecao['paciente_id']
+                  or conversa.estado not in ('solicitacao_anexo', 'confirmacao')
+                  or dados.get('medico_id') != selecao['medico_id']
+                  or dados.get('data_agendamento') != selecao['data']
+                  or dados.get('hora_agendamento') != selecao['hora']):
+                motivo = 'Este horário não está mais aguardando o pedido médico. Solicite um novo link no chat.'
+            else:
+                motivo = None
+                arquivo_paciente = ArquivoPaciente.create(
+                    paciente_id=selecao['paciente_id'],
+                    nome_original=filename,
+                    nome_arquivo=unique_filename,
+                    caminho_arquivo=unique_filename,
+                    tipo_arquivo=file.content_type or filename.rsplit('.', 1)[-1],
+                    tamanho_arquivo=tamanho_arquivo,
+                    descricao='Pedido médico enviado pelo link do chat',
+                    hash_conteudo=hash_conteudo
+                )
+                # Vinculado ao agendamento em _processar_confirmacao
+                dados.update(anexo_token_uso=dados_token['uso'],
+                             arquivo_id=arquivo_paciente.id,
+                             anexo_recebido=True,
+                             anexo_nome=filename,
+                             anexo_path=unique_filename)
+                conversa.set_dados(dados)
+                conversa.save()
+        
+        if motivo:
+            _executor_remocao.submit(remover_arquivo, file_path)
+            flash(motivo, 'error')
+            return redirect(url_for('index'))
+        
+        agendamento = Agendamento(**selecao)
+        agendamento.paciente_rel = agendamento.get_paciente()
+        
+        logger.info("Pedido médico enviado pelo link - Conversa %s: %s", conversa.id, filename)
+        flash(f'Arquivo "{filename}" foi enviado com sucesso! O administrador poderá visualizá-lo.', 'success')
+        return render_template('anexo_enviado.html', agendamento=agendamento, filename=filename)
+        
+    except Exception as e:
+        logger.error("Erro ao enviar pedido médico: %s", e)
+        flash('Erro ao enviar arquivo.', 'error')
+        return redirect(url_for('pagina_anexo_pedido', token=token))
+
 @app.route('/upload-anexo-paciente/<int:agendamento_id>', methods=['POST'])
 def upload_anexo_paciente(agendamento_id):
     """Upload de arquivo pelo paciente"""
@@ -1460,28 +1638,27 @@ def upload_anexo_paciente(agendamento_id):
         if file and allowed_file(file.filename):
             # Gerar nome único para o arquivo
             filename = secure_filename(file.filename)
-            unique_filename = f"{agendamento_id}_{uuid.uuid4().hex[:8]}_{filename}"
+            unique_filename = f"{agendamento_id}_{secrets.token_hex(4)}_{filename}"
             file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
             
             # Salvar o arquivo
-            file.save(file_path)
+            salvar_upload(file, file_path)
             
             # Atualizar banco de dados
-            agendamento.anexo_nome = filename
-            agendamento.anexo_path = unique_filename
-            agendamento.save()
+            agendamento.update_fields(anexo_nome=filename, anexo_path=unique_filename)
+            _anexos_cache.pop(agendamento_id, None)
             
             flash(f'Arquivo "{filename}" foi enviado com sucesso! O administrador poderá visualizá-lo.', 'success')
-            logger.info(f"Arquivo anexado pelo paciente ao agendamento {agendamento_id}: {filename}")
+            logger.info("Arquivo anexado pelo paciente ao agendamento %s: %s", agendamento_id, filename)
             
             return render_template('anexo_enviado.html', agendamento=agendamento, filename=filename)
             
         else:
-            flash('Tipo de arquivo não permitido. Tipos aceitos: ' + ', '.join(ALLOWED_EXTENSIONS), 'error')
+            flash(f'Tipo de arquivo não permitido. Tipos aceitos: {TIPOS_ACEITOS}', 'error')
             return redirect(url_for('pagina_anexo_paciente', agendamento_id=agendamento_id))
             
     except Exception as e:
-        logger.error(f"Erro ao fazer upload de anexo pelo paciente: {e}")
+        logger.error("Erro ao fazer upload de anexo pelo paciente: %s", e)
         flash('Erro ao enviar arquivo.', 'error')
         return redirect(url_for('pagina_anexo_paciente', agendamento_id=agendamento_id))
 
@@ -1507,25 +1684,24 @@ def upload_anexo(agendamento_id):
         if file and allowed_file(file.filename):
             # Gerar nome único para o arquivo
             filename = secure_filename(file.filename)
-            unique_filename = f"{agendamento_id}_{uuid.uuid4().hex[:8]}_{filename}"
+            unique_filename = f"{agendamento_id}_{secrets.token_hex(4)}_{filename}"
             file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
             
             # Salvar o arquivo
-            file.save(file_path)
+            salvar_upload(file, file_path)
             
             # Atualizar banco de dados
-            agendamento.anexo_nome = filename
-            agendamento.anexo_path = unique_filename
-            agendamento.save()
+            agendamento.update_fields(anexo_nome=filename, anexo_path=unique_filename)
+            _anexos_cache.pop(agendamento_id, None)
             
             flash(f'Arquivo "{filename}" foi anexado com sucesso!', 'success')
-            logger.info(f"Arquivo anexado ao agendamento {agendamento_id}: {filename}")
+            logger.info("Arquivo anexado ao agendamento %s: %s", agendamento_id, filename)
             
         else:
-            flash('Tipo de arquivo não permitido. Tipos aceitos: ' + ', '.join(ALLOWED_EXTENSIONS), 'error')
+            flash(f'Tipo de arquivo não permitido. Tipos aceitos: {TIPOS_ACEITOS}', 'error')
             
     except Exception as e:
-        logger.error(f"Erro ao fazer upload de anexo: {e}")
+        logger.error("Erro ao fazer upload de anexo: %s", e)
         flash('Erro ao fazer upload do arquivo.', 'error')
     
     return redirect(url_for('listar_agendamentos'))
@@ -1534,45 +1710,51 @@ def upload_anexo(agendamento_id):
 def download_anexo(agendamento_id):
     """Download de arquivo anexado ao agendamento"""
     try:
-        logger.info(f"Tentativa de download - Agendamento ID: {agendamento_id}")
-        agendamento = Agendamento.find_by_id(agendamento_id)
+        logger.info("Tentativa de download - Agendamento ID: %s", agendamento_id)
+        anexo = _anexos_cache.get(agendamento_id)
+        do_cache = anexo is not None
         
-        if not agendamento:
-            logger.error(f"Agendamento {agendamento_id} não encontrado")
-            return jsonify({
-                'success': False,
-                'message': 'Agendamento não encontrado.'
-            }), 404
+        if not do_cache:
+            agendamento = Agendamento.find_by_id(agendamento_id)
             
-        if not agendamento.anexo_path:
-            logger.error(f"Agendamento {agendamento_id} sem anexo")
-            return jsonify({
-                'success': False,
-                'message': 'Nenhum anexo encontrado para este agendamento.'
-            }), 404
+            if not agendamento:
+                logger.error("Agendamento %s não encontrado", agendamento_id)
+                return jsonify({
+                    'success': False,
+                    'message': 'Agendamento não encontrado.'
+                }), 404
+                
+            if not agendamento.anexo_path:
+                logger.error("Agendamento %s sem anexo", agendamento_id)
+                return jsonify({
+                    'success': False,
+                    'message': 'Nenhum anexo encontrado para este agendamento.'
+                }), 404
+            
+            anexo = (agendamento.anexo_path, agendamento.anexo_nome or 'anexo')
+            if len(_anexos_cache) >= ANEXOS_CACHE_MAX:
+                _anexos_cache.clear()
+            _anexos_cache[agendamento_id] = anexo
         
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], agendamento.anexo_path)
-        logger.info(f"Verificando arquivo: {file_path}")
+        anexo_path, anexo_nome = anexo
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], anexo_path)
+        logger.info("Verificando arquivo: %s", file_path)
         
-        if not os.path.exists(file_path):
-            logger.error(f"Arquivo não existe: {file_path}")
+        try:
+            return enviar_anexo(file_path, anexo_nome)
+        except FileNotFoundError:
+            _anexos_cache.pop(agendamento_id, None)
+            if do_cache:
+                # Anexo trocado ou removido por outro worker: consultar o banco
+                return download_anexo(agendamento_id)
+            logger.error("Arquivo não existe: %s", file_path)
             return jsonify({
                 'success': False,
                 'message': 'Arquivo não encontrado no servidor.'
             }), 404
         
-        # Tentar determinar o tipo MIME
-        mimetype = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
-        
-        return send_file(
-            file_path,
-            as_attachment=True,
-            download_name=agendamento.anexo_nome or 'anexo',
-            mimetype=mimetype
-        )
-        
     except Exception as e:
-        logger.error(f"Erro ao fazer download de anexo: {e}")
+        logger.error("Erro ao fazer download de anexo: %s", e)
         return jsonify({
             'success': False,
             'message': 'Erro ao fazer download do arquivo.'
@@ -1591,22 +1773,20 @@ def remover_anexo(agendamento_id):
         if agendamento.anexo_path:
             file_path = os.path.join(app.config['UPLOAD_FOLDER'], agendamento.anexo_path)
             
-            # Remover arquivo do sistema de arquivos
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            
             # Limpar campos do banco de dados
-            agendamento.anexo_nome = ''
-            agendamento.anexo_path = ''
-            agendamento.save()
+            agendamento.update_fields(anexo_nome='', anexo_path='')
+            _anexos_cache.pop(agendamento_id, None)
+            
+            # Remover arquivo do sistema de arquivos fora do request
+            _executor_remocao.submit(remover_arquivo, file_path)
             
             flash('Anexo removido com sucesso!', 'success')
-            logger.info(f"Anexo removido do agendamento {agendamento_id}")
+            logger.info("Anexo removido do agendamento %s", agendamento_id)
         else:
             flash('Nenhum anexo encontrado para remover.', 'error')
             
     except Exception as e:
-        logger.error(f"Erro ao remover anexo: {e}")
+        logger.error("Erro ao remover anexo: %s", e)
         flash('Erro ao remover anexo.', 'error')
     
     return redirect(url_for('listar_agendamentos'))
@@ -0,0 +1,127 @@
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+# Exemplos rotulados usados para treinar o classificador no carregamento
+EXEMPLOS_TREINO = {
+    'agendamento': [
+        'oi', 'olá', 'bom dia', 'boa tarde', 'boa noite',
+        'quero marcar uma consulta', 'preciso de uma consulta',
+        'gostaria de agendar uma consulta', 'quero agendar',
+        'preciso marcar um horário', 'estou com dor de cabeça',
+        'estou com dor nas costas', 'meu filho está doente',
+        'preciso de um médico', 'quero consultar com um cardiologista',
+        'tem horário para dermatologista', 'agendar exame',
+        'preciso de atendimento', 'estou passando mal',
+        'meu filho precisa de consulta', 'preciso de consulta',
+        'consulta com dermatologista', 'quero uma consulta',
+        'marcar consulta', 'consulta para minha mãe',
+        'quero remarcar', 'remarcar consulta', 'mudar o dia da consulta',
+    ],
+    'cancelamento': [
+        'quero cancelar minha consulta', 'cancelar agendamento',
+        'preciso desmarcar', 'desmarcar consulta',
+        'não vou poder ir na consulta', 'não poderei comparecer',
+        'remover meu agendamento', 'quero cancelar',
+        'gostaria de cancelar o horário', 'cancela pra mim',
+    ],
+    'consulta': [
+        'quais são meus agendamentos', 'ver meus agendamentos',
+        'minhas consultas', 'quando é minha consulta',
+        'qual o horário da minha consulta', 'tenho consulta marcada',
+        'listar minhas consultas', 'consultar meus horários marcados',
+        'verificar meu agendamento', 'que dia ficou minha consulta',
+    ],
+    'informacao': [
+        'qual o telefone da clínica', 'qual o endereço',
+        'onde fica a clínica', 'qual o horário de funcionamento',
+        'que horas vocês abrem', 'vocês atendem sábado',
+        'quais especialidades vocês têm', 'quais médicos atendem',
+        'como chegar na clínica', 'aceitam plano de saúde',
+        'qual a localização', 'qual o contato da clínica',
+    ],
+    'fora_escopo': [
+        'como está o tempo', 'vai chover hoje', 'quem ganhou o jogo',
+        'me conta uma piada', 'qual a capital da frança',
+        'você gosta de futebol', 'o que você acha de política',
+        'me passa uma receita de bolo', 'qual seu nome verdadeiro',
+        'quanto é dois mais dois', 'me recomenda um filme',
+    ],
+}
+
+PALAVRA_RE = re.compile(r'[a-z0-9]+')
+
+
+def _normalizar(texto):
+    """Remove acentos e converte para minúsculas"""
+    texto = unicodedata.normalize('NFKD', texto.lower())
+    return ''.join(c for c in texto if not unicodedata.combining(c))
+
+
+def _termos(texto):
+    """Gera unigramas e bigramas de palavras"""
+    palavras = PALAVRA_RE.findall(_normalizar(texto))
+    bigramas = [f"{a} {b}" for a, b in zip(palavras, palavras[1:])]
+    return palavras + bigramas
+
+
+class ClassificadorIntencao:
+    """Classificador TF-IDF por centroide (similaridade de cosseno)"""
+
+    def __init__(self, exemplos):
+        documentos = [(tipo, _termos(texto))
+                      for tipo, textos in exemplos.items()
+                      for texto in textos]
+
+        frequencia_documentos = Counter()
+        for _, termos in documentos:
+            frequencia_documentos.update(set(termos))
+
+        total = len(documentos)
+        self.idf = {
+            termo: math.log((1 + total) / (1 + freq)) + 1
+            for termo, freq in frequencia_documentos.items()
+        }
+
+        somas = defaultdict(Counter)
+        for tipo, termos in documentos:
+            for termo, peso in self._vetorizar(termos).items():
+                somas[tipo][termo] += peso
+        self.centroides = {
+            tipo: self._normalizar_vetor(soma)
+            for tipo, soma in somas.items()
+        }
+
+    def _vetorizar(self, termos):
+        contagem = Counter(t for t in termos if t in self.idf)
+        vetor = {t: freq * self.idf[t] for t, freq in contagem.items()}
+        return self._normalizar_vetor(vetor)
+
+    @staticmethod
+    def _normalizar_vetor(vetor):
+        norma = math.sqrt(sum(peso * peso for peso in vetor.values()))
+        if not norma:
+            return {}
+        return {termo: peso / norma for termo, peso in vetor.items()}
+
+    def classificar(self, mensagem):
+        """Retorna (tipo, similaridade, margem) da classe mais próxima; a
+        margem é a diferença para a segunda classe mais próxima"""
+        vetor = self._vetorizar(_termos(mensagem))
+        if not vetor:
+            return 'agendamento', 0.0, 0.0
+
+        melhor_tipo, melhor_score, segundo_score = 'agendamento', 0.0, 0.0
+        for tipo, centroide in self.centroides.items():
+            score = sum(peso * centroide.get(termo, 0.0)
+                        for termo, peso in vetor.items())
+            if score > melhor_score:
+                melhor_tipo, melhor_score, segundo_score = tipo, score, melhor_score
+            elif score > segundo_score:
+                segundo_score = score
+        return melhor_tipo, melhor_score, melhor_score - segundo_score
+
+
+# Instância global treinada no carregamento do módulo
+classificador_intencao = ClassificadorIntencao(EXEMPLOS_TREINO)
@@ -1,66 +1,116 @@
 import sqlite3
 import os
+import atexit
 import logging
+import threading
+import queue
+from contextlib import closing, contextmanager
 from datetime import datetime, date, time
 import json
+from werkzeug.security import generate_password_hash
 from typing import Optional, List, Dict, Any
 
 logger = logging.getLogger('SistemaAgendamento')
 
+# Ajustes aplicados a cada conexão (o journal WAL é persistido no arquivo)
+PRAGMAS_CONEXAO = (
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA journal_size_limit = 67108864",
+)
+
+# Conexões ociosas mantidas para reaproveitamento entre requests
+POOL_MAX_CONEXOES = max(4, os.cpu_count() or 1)
+
+# Statements preparados mantidos por conexão (cache do sqlite3 por texto do SQL);
+# como as conexões ficam no pool, cada consulta repetida é compilada uma vez por conexão
+CACHE_STATEMENTS = 256
+
+# Intervalo da manutenção periódica (PRAGMA optimize) iniciada por iniciar_manutencao
+MANUTENCAO_INTERVALO_SEGUNDOS = 15 * 60
+
+# Versão do schema gravada em PRAGMA user_version; incremente ao alterar
+# tabelas, índices ou COLUNAS_ADICIONADAS para que a migração rode de novo
+VERSAO_SCHEMA = 6
+
+# Colunas acrescentadas depois da criação original das tabelas
+COLUNAS_ADICIONADAS = (
+    ('especialidades', 'requer_anexo', 'BOOLEAN DEFAULT 0'),
+    ('agendamentos', 'anexo_nome', 'TEXT'),
+    ('agendamentos', 'anexo_path', 'TEXT'),
+    ('medicos', 'data_abertura_agenda', 'DATE'),
+    ('arquivos_pacientes', 'hash_conteudo', 'TEXT'),
+)
+
+def _rows_as_dicts(cursor) -> List[Dict[str, Any]]:
+    """Converte o resultado em dicts, montando os nomes das colunas uma vez por query"""
+    colunas = [descricao[0] for descricao in cursor.description]
+    return [dict(zip(colunas, row)) for row in cursor.fetchall()]
+
 class Database:
     """Classe principal para gerenciar conexão SQLite3"""
     
     def __init__(self, db_path: str = "sistema_agendamento.db"):
         self.db_path = db_path
+        # Conexão reaproveitada dentro de um request (uma por thread)
+        self._local = threading.local()
+        # Conexões já abertas e configuradas, devolvidas ao fim de cada uso
+        self._pool = queue.LifoQueue(maxsize=POOL_MAX_CONEXOES)
+        self._thread_manutencao = None
+        self._parar_manutencao = threading.Event()
         self._init_database()
     
     def _init_database(self):
         """Inicializa o banco de dados e cria as tabelas"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute("PRAGMA foreign_keys = ON")
-                self._create_tables(conn)
+            with closing(sqlite3.connect(self.db_path)) as conn, conn:
+                # WAL: leituras do chat não esperam pelas gravações
+                conn.execute("PRAGMA journal_mode = WAL")
+                self._aplicar_pragmas(conn)
+                # Migração e carga inicial em uma única transação (um único commit);
+                # com o lock de escrita tomado no início, outros workers esperam
+                # e já encontram o schema atualizado
+                conn.execute("BEGIN IMMEDIATE")
+                # Criação/migração só quando o arquivo está em uma versão anterior
+                versao = conn.execute("PRAGMA user_version").fetchone()[0]
+                if versao < VERSAO_SCHEMA:
+                    self._create_tables(conn)
+                    self._add_missing_columns(conn)
+                    self._create_indexes(conn)
+                    self._create_views(conn)
+                    conn.execute(f"PRAGMA user_version = {VERSAO_SCHEMA}")
                 self._populate_initial_data(conn)
-            logger.info(f"Banco de dados SQLite inicializado: {self.db_path}")
+                conn.commit()
+                # Atualiza as estatísticas do planejador quando necessário (barato se já estiverem em dia)
+                conn.execute('PRAGMA optimize')
+            logger.info("Banco de dados SQLite inicializado: %s", self.db_path)
         except Exception as e:
-            logger.error(f"Erro ao inicializar banco de dados: {e}")
+            logger.error("Erro ao inicializar banco de dados: %s", e)
             raise
     
     def _add_missing_columns(self, conn):
         """Adiciona colunas que podem estar faltantes em tabelas existentes"""
-        try:
-            # Verificar e adicionar coluna requer_anexo na tabela especialidades
-            cursor = conn.execute("PRAGMA table_info(especialidades)")
-            colunas = [row[1] for row in cursor.fetchall()]
-            if 'requer_anexo' not in colunas:
-                conn.execute("ALTER TABLE especialidades ADD COLUMN requer_anexo BOOLEAN DEFAULT 0")
-                logger.info("Coluna 'requer_anexo' adicionada à tabela especialidades")
-            
-            # Verificar e adicionar colunas anexo na tabela agendamentos
-            cursor = conn.execute("PRAGMA table_info(agendamentos)")
-            colunas = [row[1] for row in cursor.fetchall()]
-            if 'anexo_nome' not in colunas:
-                conn.execute("ALTER TABLE agendamentos ADD COLUMN anexo_nome TEXT")
-                logger.info("Coluna 'anexo_nome' adicionada à tabela agendamentos")
-            if 'anexo_path' not in colunas:
-                conn.execute("ALTER TABLE agendamentos ADD COLUMN anexo_path TEXT")
-                logger.info("Coluna 'anexo_path' adicionada à tabela agendamentos")
-            
-            # Verificar e adicionar coluna data_abertura_agenda na tabela medicos
-            cursor = conn.execute("PRAGMA table_info(medicos)")
-            colunas = [row[1] for row in cursor.fetchall()]
-            if 'data_abertura_agenda' not in colunas:
-                conn.execute("ALTER TABLE medicos ADD COLUMN data_abertura_agenda DATE")
-                logger.info("Coluna 'data_abertura_agenda' adicionada à tabela medicos")
-            
-        except Exception as e:
-            logger.error(f"Erro ao adicionar colunas faltantes: {e}")
+        for tabela, coluna, tipo in COLUNAS_ADICIONADAS:
+            existe = conn.execute(
+                "SELECT 1 FROM pragma_table_info(?) WHERE name = ?", (tabela, coluna)
+            ).fetchone()
+            if existe:
+                continue
+            # Cada ALTER isolado: uma falha (ex.: coluna criada ao mesmo tempo
+            # por outro worker) não impede as demais colunas
+            try:
+                conn.execute(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {tipo}")
+                logger.info("Coluna '%s' adicionada à tabela %s", coluna, tabela)
+            except sqlite3.OperationalError as e:
+                if 'duplicate column' not in str(e):
+                    logger.error("Erro ao adicionar coluna '%s' à tabela %s: %s", coluna, tabela, e)
 
     def _create_tables(self, conn):
         """Cria todas as tabelas necessárias"""
-        # Adicionar colunas faltantes se necessário
-        self._add_missing_columns(conn)
-        
         # Tabela de locais
         conn.execute('''
             CREATE TABLE IF NOT EXISTS locais (
@@ -215,13 +265,117 @@ class Database:
                 tipo_arquivo TEXT,
                 tamanho_arquivo INTEGER DEFAULT 0,
                 descricao TEXT,
+                hash_conteudo TEXT,
                 criado_em DATETIME DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (paciente_id) REFERENCES pacientes (id),
                 FOREIGN KEY (agendamento_id) REFERENCES agendamentos (id)
             )
         ''')
+
+        # Auditoria: rótulo das regras/modelo local vs. confirmação do Gemini
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS auditoria_intencoes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                mensagem TEXT NOT NULL,
+                tipo_previsto TEXT NOT NULL,
+                tipo_ia TEXT,
+                origem TEXT,
+                criado_em DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    
+    def _create_views(self, conn):
+        """Cria as views de leitura (agendamentos com os nomes relacionados)"""
+        # LEFT JOIN: agendamentos com cadastro relacionado ausente continuam
+        # aparecendo; joins cujas colunas a consulta não usa são descartados pelo SQLite
+        conn.execute('''
+            CREATE VIEW IF NOT EXISTS v_agendamentos_nomes AS
+            SELECT a.*,
+                   p.nome AS paciente_nome,
+                   m.nome AS medico_nome,
+                   e.nome AS especialidade_nome,
+                   l.nome AS local_nome
+            FROM agendamentos a
+            LEFT JOIN pacientes p ON p.id = a.paciente_id
+            LEFT JOIN medicos m ON m.id = a.medico_id
+            LEFT JOIN especialidades e ON e.id = a.especialidade_id
+            LEFT JOIN locais l ON l.id = a.local_id
+        ''')
+    
+    def _create_indexes(self, conn):
+        """Cria os índices (depois das colunas adicionadas por migração)"""
+        # Índices para as consultas mais frequentes do chatbot
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_horarios_local_medico
+            ON horarios_disponiveis (local_id, medico_id) WHERE ativo = 1
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_medicos_esp_ativo
+            ON medicos (especialidade_id, ativo)
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_agendamentos_medico_data
+            ON agendamentos (medico_id, data)
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_agendamentos_data_hora
+            ON agendamentos (data, hora)
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_recorrentes_medico_dia
+            ON agendamentos_recorrentes (medico_id, dia_semana, hora) WHERE ativo = 1
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_conversas_abandonadas
+            ON conversas (atualizado_em) WHERE estado != 'finalizado'
+        ''')
+        
+        # Índices das telas do admin (histórico do paciente, relatórios, exclusões)
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_agendamentos_paciente_data
+            ON agendamentos (paciente_id, data)
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_agendamentos_especialidade
+            ON agendamentos (especialidade_id)
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_horarios_medico
+            ON horarios_disponiveis (medico_id)
+        ''')
         
-        conn.commit()
+        # Demais chaves estrangeiras: filtros por local/paciente e checagens das exclusões
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_agendamentos_local
+            ON agendamentos (local_id)
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_arquivos_paciente
+            ON arquivos_pacientes (paciente_id)
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_arquivos_agendamento
+            ON arquivos_pacientes (agendamento_id)
+        ''')
+        
+        # Agendamentos ativos do dia (painel e /log-test): índice parcial pequeno,
+        # e a contagem é respondida só pelo índice
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_agendamentos_ativos_data
+            ON agendamentos (data, status) WHERE status = 'agendado'
+        ''')
+        
+        # Médicos com agenda aberta (Medico.find_with_open_agenda)
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_medicos_ativo_abertura
+            ON medicos (ativo, data_abertura_agenda)
+        ''')
+        
+        # Deduplicação de uploads pelo conteúdo
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_arquivos_hash
+            ON arquivos_pacientes (hash_conteudo) WHERE hash_conteudo IS NOT NULL
+        ''')
     
     def _populate_initial_data(self, conn):
         """Popula dados iniciais se não existirem"""
@@ -312,12 +466,16 @@ class Database:
         ''', horarios_maria)
         
         # Horários para outros médicos (em Contagem, segunda a sexta)
-        for medico_id in range(3, 7):
-            for dia_semana in range(5):
-                conn.execute('''
-                    INSERT INTO horarios_disponiveis (medico_id, local_id, dia_semana, hora_inicio, hora_fim, duracao_consulta)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (medico_id, 1, dia_semana, "08:00", "18:00", 30))
+        horarios_outros = [
+            (medico_id, 1, dia_semana, "08:00", "18:00", 30)
+            for medico_id in range(3, 7)
+            for dia_semana in range(5)
+        ]
+        
+        conn.executemany('''
+            INSERT INTO horarios_disponiveis (medico_id, local_id, dia_semana, hora_inicio, hora_fim, duracao_consulta)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', horarios_outros)
         
         # Inserir configurações iniciais
         configuracoes_iniciais = [
@@ -325,7 +483,7 @@ class Database:
             ('nome_assistente', 'Assistente Virtual', 'Nome do assistente de agendamentos'),
             ('telefone_clinica', '(31) 3333-4444', 'Telefone principal da clínica'),
             ('email_admin', 'joao@gmail.com', 'Email do administrador'),
-            ('senha_admin', '30031936Vo', 'Senha do administrador'),
+            ('senha_admin', generate_password_hash('30031936Vo'), 'Senha do administrador (hash)'),
             ('horario_funcionamento', 'Segunda a Sexta, 8h às 18h', 'Horário de funcionamento da clínica'),
             ('bloquear_especialidades_duplicadas', 'false', 'Impedir paciente ter agendamentos em especialidades iguais'),
             ('duracao_agendamento_recorrente', '4', 'Duração em semanas para agendamentos recorrentes')
@@ -336,35 +494,161 @@ class Database:
             VALUES (?, ?, ?)
         ''', configuracoes_iniciais)
         
-        conn.commit()
+        # Estatísticas iniciais para o planejador de consultas
+        conn.execute("ANALYZE")
         logger.info("Dados iniciais inseridos no banco SQLite")
     
+    @staticmethod
+    def _aplicar_pragmas(conn):
+        for pragma in PRAGMAS_CONEXAO:
+            conn.execute(pragma)
+    
     def get_connection(self):
         """Retorna uma nova conexão com o banco"""
-        conn = sqlite3.connect(self.db_path)
-        conn.execute("PRAGMA foreign_keys = ON")
+        # check_same_thread=False: a conexão volta ao pool e pode ser usada
+        # depois por outra thread (nunca por duas ao mesmo tempo)
+        conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                               cached_statements=CACHE_STATEMENTS)
+        self._aplicar_pragmas(conn)
         conn.row_factory = sqlite3.Row  # Para acessar colunas por nome
         return conn
     
-    def execute_query(self, query: str, params: tuple = ()) -> List[sqlite3.Row]:
-        """Executa uma query SELECT e retorna os resultados"""
-        with self.get_connection() as conn:
-            cursor = conn.execute(query, params)
+    def _obter_conexao(self):
+        """Retira uma conexão ociosa do pool ou abre uma nova"""
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self.get_connection()
+    
+    def _devolver_conexao(self, conn):
+        """Devolve a conexão ao pool (ou a fecha se o pool estiver cheio)"""
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            self._fechar_conexao(conn)
+    
+    @staticmethod
+    def _fechar_conexao(conn):
+        """Fecha a conexão atualizando antes as estatísticas do planejador
+        das tabelas que mudaram bastante (PRAGMA optimize é barato quando não há o que fazer)"""
+        try:
+            conn.execute('PRAGMA optimize')
+        except sqlite3.Error as e:
+            logger.warning("PRAGMA optimize falhou ao fechar conexão: %s", e)
+        conn.close()
+    
+    def fechar_conexoes(self):
+        """Encerra a manutenção periódica e fecha as conexões ociosas do pool
+        (chamado na saída do processo)"""
+        self._parar_manutencao.set()
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                return
+            self._fechar_conexao(conn)
+    
+    def iniciar_manutencao(self, intervalo: float = MANUTENCAO_INTERVALO_SEGUNDOS):
+        """Inicia (uma vez por processo) a thread que roda PRAGMA optimize periodicamente"""
+        if self._thread_manutencao is not None:
+            return
+        self._thread_manutencao = threading.Thread(
+            target=self._manutencao_periodica, args=(intervalo,),
+            name='manutencao-banco', daemon=True)
+        self._thread_manutencao.start()
+    
+    def _manutencao_periodica(self, intervalo: float):
+        while not self._parar_manutencao.wait(intervalo):
+            try:
+                with self.conexao() as conn:
+                    conn.execute('PRAGMA optimize')
+            except sqlite3.Error as e:
+                logger.warning("Manutenção periódica do banco falhou: %s", e)
+    
+    def abrir_conexao_request(self):
+        """Reserva a conexão compartilhada pelas consultas do request atual"""
+        if getattr(self._local, 'conn', None) is None:
+            self._local.conn = self._obter_conexao()
+    
+    def fechar_conexao_request(self):
+        """Devolve ao pool a conexão reservada por abrir_conexao_request"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            self._devolver_conexao(conn)
+    
+    @contextmanager
+    def conexao(self):
+        """Usa a conexão do request, se houver, ou uma conexão do pool"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            if conn.in_transaction:
+                # Dentro de uma transação aberta: quem a abriu faz commit/rollback
+                yield conn
+                return
+            with conn:
+                yield conn
+            return
+        conn = self._obter_conexao()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self._devolver_conexao(conn)
+    
+    @contextmanager
+    def transacao(self):
+        """Transação de escrita que reserva o banco logo no início (BEGIN IMMEDIATE),
+        evitando SQLITE_BUSY no meio dela; chamadas aninhadas participam da externa"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and conn.in_transaction:
+            yield conn
+            return
+        # Fora de um request a conexão do pool fica visível às chamadas aninhadas
+        avulsa = conn is None
+        if avulsa:
+            conn = self._local.conn = self._obter_conexao()
+        try:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                yield conn
+        finally:
+            if avulsa:
+                self._local.conn = None
+                self._devolver_conexao(conn)
+    
+    def execute_query(self, query: str, params: tuple = (), como_dict: bool = False,
+                      como_tupla: bool = False) -> List[Any]:
+        """Executa uma query SELECT e retorna os resultados (sqlite3.Row, dicts
+        quando como_dict=True ou tuplas simples quando como_tupla=True)"""
+        with self.conexao() as conn:
+            cursor = conn.cursor()
+            if como_tupla:
+                cursor.row_factory = None
+            cursor.execute(query, params)
+            if como_dict:
+                return _rows_as_dicts(cursor)
             return cursor.fetchall()
     
     def execute_insert(self, query: str, params: tuple = ()) -> int:
         """Executa uma query INSERT e retorna o ID inserido"""
-        with self.get_connection() as conn:
-            cursor = conn.execute(query, params)
-            conn.commit()
-            return cursor.lastrowid
+        with self.transacao() as conn:
+            return conn.execute(query, params).lastrowid
+    
+    def execute_many(self, query: str, params_seq) -> int:
+        """Executa um INSERT para vários conjuntos de parâmetros (um único statement
+        preparado, em uma transação) e retorna o ID do último registro inserido"""
+        with self.transacao() as conn:
+            conn.executemany(query, params_seq)
+            return conn.execute("SELECT last_insert_rowid()").fetchone()[0]
     
     def execute_update(self, query: str, params: tuple = ()) -> int:
         """Executa uma query UPDATE/DELETE e retorna o número de linhas afetadas"""
-        with self.get_connection() as conn:
-            cursor = conn.execute(query, params)
-            conn.commit()
-            return cursor.rowcount
+        with self.transacao() as conn:
+            return conn.execute(query, params).rowcount
 
 # Instância global do banco
-db = Database()
\ No newline at end of file
+db = Database()
+atexit.register(db.fechar_conexoes)
\ No newline at end of file
@@ -1,32 +1,167 @@
 from database import db
 from datetime import datetime, date, time
+import copy
 import json
 import logging
+import threading
+from contextvars import ContextVar
+from time import monotonic
 from typing import Optional, List, Dict, Any
 
 logger = logging.getLogger('SistemaAgendamento')
 
+# JSON dos dados temporários da conversa: orjson (C) quando instalado, senão stdlib
+try:
+    import orjson
+    
+    def _json_dumps(valor) -> str:
+        return orjson.dumps(valor, option=orjson.OPT_NON_STR_KEYS).decode()
+    
+    _json_loads = orjson.loads
+except ImportError:
+    _json_dumps = json.dumps
+    _json_loads = json.loads
+
+# Cache TTL para leituras repetidas (configurações, locais e especialidades).
+# O cache é de cada processo: uma alteração só invalida o worker que a fez, e
+# os demais workers (gunicorn) podem servir o valor antigo por até o TTL
+CACHE_TTL_SEGUNDOS = 300
+# A grade de horários oferecida no chat expira antes: horários e médicos
+# desativados em outro worker somem rápido (a confirmação confere no banco)
+GRADE_CACHE_TTL_SEGUNDOS = 30
+_cache_consultas: Dict[tuple, tuple] = {}
+_cache_lock = threading.Lock()
+
+# Mapa de identidade do request atual ({(tabela, id): registro}) usado por find_by_id;
+# None fora de um request (sem cache)
+_mapa_identidade: ContextVar[Optional[Dict[tuple, Any]]] = ContextVar('mapa_identidade', default=None)
+
+def _data_iso_para_br(texto: str, invalida: Optional[str] = None) -> str:
+    """'AAAA-MM-DD' -> 'DD/MM/AAAA'. Fora desse formato devolve `invalida`
+    (ou o próprio texto); só datas impossíveis como 2026-02-30 chegam ao except"""
+    if len(texto) == 10 and texto[4] == '-' and texto[7] == '-':
+        try:
+            return date.fromisoformat(texto).strftime('%d/%m/%Y')
+        except ValueError:
+            pass
+    return texto if invalida is None else invalida
+
+# Nomes dos dias da semana (índice = dia_semana, 0 = segunda)
+DIAS_SEMANA = ('Segunda', 'Terça', 'Quarta', 'Quinta', 'Sexta', 'Sábado', 'Domingo')
+
+# Tamanho fixo dos lotes de IDs em find_by_ids (bem abaixo do limite de variáveis do SQLite)
+LOTE_IDS = 64
+
+def _cache_obter(chave: tuple):
+    """Retorna o valor em cache ou None se ausente/expirado"""
+    with _cache_lock:
+        item = _cache_consultas.get(chave)
+        if item is None:
+            return None
+        valor, expira_em = item
+        if monotonic() > expira_em:
+            del _cache_consultas[chave]
+            return None
+        return valor
+
+def _cache_salvar(chave: tuple, valor, ttl: float = CACHE_TTL_SEGUNDOS):
+    """Armazena um valor no cache (TTL padrão: CACHE_TTL_SEGUNDOS)"""
+    with _cache_lock:
+        _cache_consultas[chave] = (valor, monotonic() + ttl)
+
+def abrir_mapa_identidade():
+    """Inicia o mapa de identidade do request atual"""
+    _mapa_identidade.set({})
+
+def fechar_mapa_identidade():
+    """Descarta o mapa de identidade do request atual"""
+    _mapa_identidade.set(None)
+
+def limpar_cache(table_name: Optional[str] = None):
+    """Invalida o cache de uma tabela (ou todo o cache), inclusive no mapa de identidade"""
+    mapa = _mapa_identidade.get()
+    if mapa:
+        if table_name is None:
+            mapa.clear()
+        else:
+            for chave in [c for c in mapa if c[0] == table_name]:
+                del mapa[chave]
+    with _cache_lock:
+        if table_name is None:
+            _cache_consultas.clear()
+            return
+        for chave in [c for c in _cache_consultas if c[0] == table_name]:
+            del _cache_consultas[chave]
+
+def _formatar_temporal(valor):
+    """Valor de coluna de data/hora no to_dict (date/datetime em ISO, time em HH:MM)"""
+    if isinstance(valor, (date, datetime)):
+        return valor.isoformat() if valor else None
+    if isinstance(valor, time):
+        return valor.strftime('%H:%M') if valor else None
+    return valor
+
+def _eh_coluna_temporal(coluna: str) -> bool:
+    return coluna in ('data', 'hora') or coluna.startswith(('data_', 'hora_')) or coluna.endswith('_em')
+
+def _gerar_serializador(colunas: tuple):
+    """Gera o to_dict de um modelo: um literal de dicionário com um acesso direto por
+    coluna (só as de data/hora passam por _formatar_temporal)"""
+    itens = ', '.join(
+        f"'{c}': _formatar_temporal(self.{c})" if _eh_coluna_temporal(c) else f"'{c}': self.{c}"
+        for c in colunas)
+    escopo = {'_formatar_temporal': _formatar_temporal}
+    exec(f"def _to_dict_colunas(self):\n    return {{{itens}}}\n", escopo)
+    return escopo['_to_dict_colunas']
+
+def _gerar_carregador(cls, colunas: tuple):
+    """Gera o _from_row de um modelo: a linha (tupla na ordem de `colunas`) é
+    desempacotada direto nos atributos, sem dict intermediário nem __init__"""
+    alvos = ', '.join(f"obj.{c}" for c in colunas) + (',' if len(colunas) == 1 else '')
+    escopo = {'_novo': object.__new__, 'cls': cls}
+    exec(f"def _from_row(row):\n    obj = _novo(cls)\n    {alvos} = row\n    return obj\n", escopo)
+    return staticmethod(escopo['_from_row'])
+
 class BaseModel:
     """Classe base para todos os modelos"""
     table_name = ""
+    # Colunas da tabela, na ordem em que _from_row as recebe (SELECT explícito)
+    _COLUMNS = ()
+    # Chaves de cache derivadas desta tabela (invalidadas junto com ela)
+    cache_dependentes = ()
+    
+    def __init_subclass__(cls, **kwargs):
+        """Monta uma vez, na definição do modelo, o SQL fixo das operações básicas"""
+        super().__init_subclass__(**kwargs)
+        cls._SQL_SELECT = f"SELECT {', '.join(cls._COLUMNS)} FROM {cls.table_name}"
+        cls._SQL_FIND_BY_ID = f"{cls._SQL_SELECT} WHERE id = ?"
+        cls._SQL_FIND_BY_IDS = f"{cls._SQL_SELECT} WHERE id IN ({', '.join('?' * LOTE_IDS)})"
+        cls._SQL_FIND_ALL = cls._SQL_SELECT
+        cls._SQL_COUNT = f"SELECT COUNT(*) AS total FROM {cls.table_name}"
+        cls._SQL_DELETE = f"DELETE FROM {cls.table_name} WHERE id = ?"
+        # INSERT/UPDATE por tupla de colunas, montados na primeira vez que aparecem
+        cls._sql_insert = {}
+        cls._sql_update = {}
+        cls._to_dict_colunas = _gerar_serializador(cls._COLUMNS)
+        cls._from_row = _gerar_carregador(cls, cls._COLUMNS)
     
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
     
+    @classmethod
+    def _sql_insert_colunas(cls, colunas: tuple) -> str:
+        """INSERT com as colunas informadas (texto estável: reaproveita o statement preparado)"""
+        query = cls._sql_insert.get(colunas)
+        if query is None:
+            placeholders = ', '.join('?' * len(colunas))
+            query = f"INSERT INTO {cls.table_name} ({', '.join(colunas)}) VALUES ({placeholders})"
+            cls._sql_insert[colunas] = query
+        return query
+    
     def to_dict(self) -> Dict[str, Any]:
-        """Converte o objeto para dicionário"""
-        result = {}
-        for key, value in self.__dict__.items():
-            if key.startswith('_'):
-                continue
-            if isinstance(value, (date, datetime)):
-                result[key] = value.isoformat() if value else None
-            elif isinstance(value, time):
-                result[key] = value.strftime('%H:%M') if value else None
-            else:
-                result[key] = value
-        return result
+        """Converte o objeto para dicionário (colunas de _COLUMNS)"""
+        return self._to_dict_colunas()
     
     @classmethod
     def create(cls, **kwargs):
@@ -38,42 +173,162 @@ class BaseModel:
         if not kwargs:
             raise ValueError("Nenhum dado fornecido para criação")
         
-        columns = ', '.join(kwargs.keys())
-        placeholders = ', '.join(['?' for _ in kwargs])
-        query = f"INSERT INTO {cls.table_name} ({columns}) VALUES ({placeholders})"
-        
+        query = cls._sql_insert_colunas(tuple(kwargs))
         record_id = db.execute_insert(query, tuple(kwargs.values()))
+        cls._limpar_cache()
         return cls.find_by_id(record_id)
     
+    @classmethod
+    def bulk_create(cls, registros: List[Dict[str, Any]]) -> List['BaseModel']:
+        """Cria vários registros em uma única transação, com um INSERT (executemany)
+        por conjunto de colunas; retorna os registros relidos do banco (com os
+        DEFAULT das colunas, como create), na ordem de `registros`"""
+        grupos: Dict[tuple, list] = {}
+        for indice, kwargs in enumerate(registros):
+            campos = {k: v for k, v in kwargs.items() if k not in ('id', 'criado_em')}
+            if not campos:
+                raise ValueError("Nenhum dado fornecido para criação")
+            grupos.setdefault(tuple(sorted(campos)), []).append((indice, campos))
+        
+        ids = [None] * len(registros)
+        # Com a trava de escrita da transação, os IDs de cada grupo são consecutivos
+        with db.transacao():
+            for colunas, itens in grupos.items():
+                query = cls._sql_insert_colunas(colunas)
+                ultimo_id = db.execute_many(query, [tuple(campos[c] for c in colunas)
+                                                    for _, campos in itens])
+                primeiro_id = ultimo_id - len(itens) + 1
+                for deslocamento, (indice, _) in enumerate(itens):
+                    ids[indice] = primeiro_id + deslocamento
+            carregados = {registro.id: registro for registro in cls.find_by_ids(ids)}
+        if grupos:
+            cls._limpar_cache()
+        return [carregados[record_id] for record_id in ids]
+    
+    @classmethod
+    def _limpar_cache(cls):
+        """Invalida o cache da tabela e das consultas que dependem dela"""
+        limpar_cache(cls.table_name)
+        for chave in cls.cache_dependentes:
+            limpar_cache(chave)
+    
     @classmethod
     def find_by_id(cls, record_id: int):
-        """Busca um registro por ID"""
-        query = f"SELECT * FROM {cls.table_name} WHERE id = ?"
-        rows = db.execute_query(query, (record_id,))
-        if rows:
-            return cls(**dict(rows[0]))
-        return None
+        """Busca um registro por ID (uma consulta por registro dentro do request)"""
+        mapa = _mapa_identidade.get()
+        chave = (cls.table_name, record_id)
+        if mapa is not None and chave in mapa:
+            registro = mapa[chave]
+        else:
+            rows = db.execute_query(cls._SQL_FIND_BY_ID, (record_id,), como_tupla=True)
+            registro = cls._from_row(rows[0]) if rows else None
+            if mapa is None:
+                return registro
+            mapa[chave] = registro
+        # Cópia: alterações não salvas de quem chamou não vazam para o mapa
+        return copy.copy(registro) if registro is not None else None
+    
+    @classmethod
+    def find_by_id_cached(cls, record_id: int):
+        """Busca um registro por ID usando o cache TTL"""
+        chave = (cls.table_name, 'id', record_id)
+        resultado = _cache_obter(chave)
+        if resultado is None:
+            resultado = cls.find_by_id(record_id)
+            _cache_salvar(chave, resultado)
+        return resultado
+    
+    @staticmethod
+    def preload_relations(objs: List['BaseModel'], attr: str, related_cls, fk: str,
+                          carregados: Optional[List['BaseModel']] = None) -> List['BaseModel']:
+        """Carrega com uma consulta (find_by_ids) o relacionamento `attr` de todos
+        os objetos; get_<attr>() passa a devolver o valor pré-carregado.
+        `carregados`: registros de related_cls já em memória (dispensa a consulta)"""
+        if carregados is None:
+            ids = {getattr(obj, fk) for obj in objs} - {None}
+            carregados = related_cls.find_by_ids(ids)
+        por_id = {registro.id: registro for registro in carregados}
+        for obj in objs:
+            setattr(obj, f'_cached_{attr}', por_id.get(getattr(obj, fk)))
+        return objs
+    
+    @classmethod
+    def find_by_ids(cls, record_ids) -> List['BaseModel']:
+        """Busca vários registros por ID em lotes de tamanho fixo"""
+        record_ids = list(dict.fromkeys(record_ids))
+        if not record_ids:
+            return []
+        # Mesmo SQL para todos os lotes: o sqlite3 reaproveita o statement preparado
+        query = cls._SQL_FIND_BY_IDS
+        registros = []
+        for inicio in range(0, len(record_ids), LOTE_IDS):
+            lote = record_ids[inicio:inicio + LOTE_IDS]
+            # Completa o último lote repetindo um ID (IN ignora duplicados)
+            lote += [lote[-1]] * (LOTE_IDS - len(lote))
+            rows = db.execute_query(query, tuple(lote), como_tupla=True)
+            registros.extend(map(cls._from_row, rows))
+        return registros
     
     @classmethod
     def find_all(cls) -> List['BaseModel']:
         """Busca todos os registros"""
-        query = f"SELECT * FROM {cls.table_name}"
-        rows = db.execute_query(query)
-        return [cls(**dict(row)) for row in rows]
+        rows = db.execute_query(cls._SQL_FIND_ALL, como_tupla=True)
+        return [cls._from_row(row) for row in rows]
     
     @classmethod
-    def find_where(cls, conditions: Dict[str, Any]) -> List['BaseModel']:
-        """Busca registros com condições"""
+    def count(cls) -> int:
+        """Conta todos os registros da tabela"""
+        rows = db.execute_query(cls._SQL_COUNT)
+        return rows[0]['total']
+    
+    @classmethod
+    def count_where(cls, conditions: Dict[str, Any]) -> int:
+        """Conta registros com condições"""
         where_clause = ' AND '.join([f"{key} = ?" for key in conditions.keys()])
-        query = f"SELECT * FROM {cls.table_name} WHERE {where_clause}"
-        rows = db.execute_query(query, tuple(conditions.values()))
-        return [cls(**dict(row)) for row in rows]
+        query = f"SELECT COUNT(*) AS total FROM {cls.table_name} WHERE {where_clause}"
+        return db.execute_query(query, tuple(conditions.values()))[0]['total']
+    
+    @classmethod
+    def find_where(cls, conditions: Dict[str, Any], order_by: str = None,
+                   limit: int = None) -> List['BaseModel']:
+        """Busca registros com condições (ordenação e limite opcionais, feitos no SQL)"""
+        where_clause = ' AND '.join([f"{key} = ?" for key in conditions.keys()])
+        query = f"{cls._SQL_SELECT} WHERE {where_clause}"
+        if order_by:
+            query += f" ORDER BY {order_by}"
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+        rows = db.execute_query(query, tuple(conditions.values()), como_tupla=True)
+        return [cls._from_row(row) for row in rows]
+    
+    @classmethod
+    def find_where_cached(cls, conditions: Dict[str, Any]) -> List['BaseModel']:
+        """Busca registros com condições usando o cache TTL"""
+        chave = (cls.table_name, tuple(sorted(conditions.items())))
+        resultado = _cache_obter(chave)
+        if resultado is None:
+            resultado = cls.find_where(conditions)
+            _cache_salvar(chave, resultado)
+        return list(resultado)
     
     @classmethod
     def find_one_where(cls, conditions: Dict[str, Any]):
         """Busca um registro com condições"""
-        results = cls.find_where(conditions)
-        return results[0] if results else None
+        where_clause = ' AND '.join([f"{key} = ?" for key in conditions.keys()])
+        query = f"{cls._SQL_SELECT} WHERE {where_clause} LIMIT 1"
+        rows = db.execute_query(query, tuple(conditions.values()), como_tupla=True)
+        return cls._from_row(rows[0]) if rows else None
+    
+    @classmethod
+    def exists_where(cls, conditions: Dict[str, Any], exceto_id: Optional[int] = None) -> bool:
+        """Verifica se existe registro com condições (opcionalmente ignorando um ID)"""
+        params = list(conditions.values())
+        where_clause = ' AND '.join([f"{key} = ?" for key in conditions.keys()])
+        if exceto_id is not None:
+            where_clause += " AND id != ?"
+            params.append(exceto_id)
+        query = f"SELECT 1 FROM {cls.table_name} WHERE {where_clause} LIMIT 1"
+        return bool(db.execute_query(query, tuple(params)))
     
     def save(self):
         """Salva alterações no registro"""
@@ -87,23 +342,46 @@ class BaseModel:
         if not data:
             return
         
-        set_clause = ', '.join([f"{key} = ?" for key in data.keys()])
-        query = f"UPDATE {self.table_name} SET {set_clause} WHERE id = ?"
-        
+        query = self._sql_update_colunas(tuple(data))
         params = list(data.values()) + [self.id]
         db.execute_update(query, tuple(params))
+        self._limpar_cache()
+    
+    def update_fields(self, **changes):
+        """Grava só as colunas informadas (UPDATE ... SET col = ? WHERE id = ?)
+        e as atualiza no objeto; as demais colunas não são reescritas"""
+        if not getattr(self, 'id', None):
+            raise ValueError("Registro deve ter ID para ser atualizado")
+        if not changes:
+            return
+        query = self._sql_update_colunas(tuple(changes))
+        db.execute_update(query, (*changes.values(), self.id))
+        self.__dict__.update(changes)
+        self._limpar_cache()
+    
+    @classmethod
+    def _sql_update_colunas(cls, colunas: tuple) -> str:
+        """UPDATE das colunas informadas por ID (texto estável: reaproveita o statement preparado)"""
+        query = cls._sql_update.get(colunas)
+        if query is None:
+            set_clause = ', '.join([f"{key} = ?" for key in colunas])
+            query = f"UPDATE {cls.table_name} SET {set_clause} WHERE id = ?"
+            cls._sql_update[colunas] = query
+        return query
     
     def delete(self):
         """Exclui o registro"""
         if not hasattr(self, 'id') or not self.id:
             raise ValueError("Registro deve ter ID para ser excluído")
         
-        query = f"DELETE FROM {self.table_name} WHERE id = ?"
-        db.execute_update(query, (self.id,))
+        db.execute_update(self._SQL_DELETE, (self.id,))
+        self._limpar_cache()
 
 class Paciente(BaseModel):
     """Modelo para pacientes da clínica"""
     table_name = "pacientes"
+    _COLUMNS = ('id', 'cpf', 'nome', 'data_nascimento', 'telefone', 'email', 'carteirinha',
+                'tipo_atendimento', 'criado_em')
     
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -123,6 +401,27 @@ class Paciente(BaseModel):
         """Busca paciente por CPF"""
         return cls.find_one_where({'cpf': cpf})
     
+    @classmethod
+    def resumo_especialidades(cls) -> List[Dict[str, Any]]:
+        """Pacientes com agendamentos, o total deles e as especialidades já agendadas"""
+        separador = '\x1f'
+        query = f"""
+            SELECT p.nome, p.cpf, COUNT(*) AS total_agendamentos,
+                   (SELECT GROUP_CONCAT(e.nome, ?) FROM especialidades e
+                    WHERE e.id IN (SELECT especialidade_id FROM agendamentos
+                                   WHERE paciente_id = p.id)) AS especialidades
+            FROM {cls.table_name} p
+            JOIN agendamentos a ON a.paciente_id = p.id
+            GROUP BY p.id
+            ORDER BY p.id
+        """
+        resumo = []
+        for item in db.execute_query(query, (separador,), como_dict=True):
+            nomes = item['especialidades']
+            item['especialidades'] = nomes.split(separador) if nomes else []
+            resumo.append(item)
+        return resumo
+    
     def get_agendamentos(self) -> List['Agendamento']:
         """Retorna agendamentos do paciente"""
         return Agendamento.find_where({'paciente_id': self.id})
@@ -131,12 +430,7 @@ class Paciente(BaseModel):
         data = super().to_dict()
         if self.data_nascimento:
             if isinstance(self.data_nascimento, str):
-                # Se já é string, tentar converter para date para depois formatar
-                try:
-                    dt = datetime.strptime(self.data_nascimento, '%Y-%m-%d').date()
-                    data['data_nascimento'] = dt.strftime('%d/%m/%Y')
-                except:
-                    data['data_nascimento'] = self.data_nascimento
+                data['data_nascimento'] = _data_iso_para_br(self.data_nascimento)
             else:
                 data['data_nascimento'] = self.data_nascimento.strftime('%d/%m/%Y')
         return data
@@ -144,6 +438,7 @@ class Paciente(BaseModel):
 class Local(BaseModel):
     """Modelo para locais de atendimento"""
     table_name = "locais"
+    _COLUMNS = ('id', 'nome', 'endereco', 'cidade', 'telefone', 'ativo', 'criado_em')
     
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -158,11 +453,12 @@ class Local(BaseModel):
     @classmethod
     def find_active(cls) -> List['Local']:
         """Busca locais ativos"""
-        return cls.find_where({'ativo': 1})
+        return cls.find_where_cached({'ativo': 1})
 
 class Especialidade(BaseModel):
     """Modelo para especialidades médicas"""
     table_name = "especialidades"
+    _COLUMNS = ('id', 'nome', 'descricao', 'ativo', 'requer_anexo', 'criado_em')
     
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -176,7 +472,19 @@ class Especialidade(BaseModel):
     @classmethod
     def find_active(cls) -> List['Especialidade']:
         """Busca especialidades ativas"""
-        return cls.find_where({'ativo': 1})
+        return cls.find_where_cached({'ativo': 1})
+    
+    @classmethod
+    def find_active_by_local(cls, local_id) -> List['Especialidade']:
+        """Busca especialidades ativas com médicos atendendo no local"""
+        query = f"""
+            SELECT DISTINCT e.* FROM {cls.table_name} e
+            JOIN medicos m ON e.id = m.especialidade_id
+            JOIN horarios_disponiveis h ON m.id = h.medico_id
+            WHERE h.local_id = ? AND e.ativo = 1 AND m.ativo = 1 AND h.ativo = 1
+        """
+        rows = db.execute_query(query, (local_id,))
+        return [cls(**dict(row)) for row in rows]
     
     def get_medicos(self) -> List['Medico']:
         """Retorna médicos desta especialidade"""
@@ -185,6 +493,9 @@ class Especialidade(BaseModel):
 class Medico(BaseModel):
     """Modelo para médicos da clínica"""
     table_name = "medicos"
+    _COLUMNS = ('id', 'nome', 'crm', 'especialidade_id', 'ativo', 'agenda_recorrente', 'criado_em',
+                'data_abertura_agenda')
+    cache_dependentes = ('grade_horarios',)
     
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -202,10 +513,27 @@ class Medico(BaseModel):
         """Busca médicos ativos"""
         return cls.find_where({'ativo': 1})
     
+    @classmethod
+    def find_by_especialidade(cls, especialidade_id: int) -> List['Medico']:
+        """Busca médicos ativos de uma especialidade"""
+        return cls.find_where({'especialidade_id': especialidade_id, 'ativo': 1})
+    
+    @classmethod
+    def find_with_open_agenda(cls, data_consulta: date = None) -> List['Medico']:
+        """Busca médicos ativos com a agenda aberta na data (mesma regra de agenda_aberta, feita no SQL)"""
+        data_consulta = (data_consulta or date.today()).isoformat()
+        query = (f"{cls._SQL_SELECT} WHERE ativo = 1 "
+                 "AND (data_abertura_agenda IS NULL OR data_abertura_agenda = '' "
+                 "OR data_abertura_agenda <= ?)")
+        rows = db.execute_query(query, (data_consulta,), como_tupla=True)
+        return [cls._from_row(row) for row in rows]
+    
     def get_especialidade(self) -> Optional['Especialidade']:
         """Retorna a especialidade do médico"""
+        if '_cached_especialidade' in self.__dict__:
+            return self._cached_especialidade
         if self.especialidade_id:
-            return Especialidade.find_by_id(self.especialidade_id)
+            return Especialidade.find_by_id_cached(self.especialidade_id)
         return None
     
     def get_horarios(self) -> List['HorarioDisponivel']:
@@ -216,30 +544,40 @@ class Medico(BaseModel):
         """Retorna agendamentos do médico"""
         return Agendamento.find_where({'medico_id': self.id})
     
+    def data_abertura(self) -> Optional[date]:
+        """Data de abertura da agenda como date (None = sempre aberta)"""
+        if not self.data_abertura_agenda:
+            return None
+        
+        # Converter string para date se necessário
+        if isinstance(self.data_abertura_agenda, str):
+            try:
+                return date.fromisoformat(self.data_abertura_agenda)
+            except ValueError:
+                return None
+        return self.data_abertura_agenda
+    
     def agenda_aberta(self, data_consulta: date = None) -> bool:
         """Verifica se a agenda do médico está aberta para uma data"""
         if not data_consulta:
             data_consulta = date.today()
         
-        if not self.data_abertura_agenda:
+        data_abertura = self.data_abertura()
+        if not data_abertura:
             # Se não tem data configurada, considera agenda sempre aberta
             return True
         
-        # Converter string para date se necessário
-        if isinstance(self.data_abertura_agenda, str):
-            try:
-                data_abertura = datetime.strptime(self.data_abertura_agenda, '%Y-%m-%d').date()
-            except:
-                return True
-        else:
-            data_abertura = self.data_abertura_agenda
-        
         # Agenda está aberta se a data de consulta for igual ou posterior à data de abertura
         return data_consulta >= data_abertura
 
 class HorarioDisponivel(BaseModel):
     """Modelo para horários disponíveis dos médicos"""
     table_name = "horarios_disponiveis"
+    _COLUMNS = ('id', 'medico_id', 'local_id', 'dia_semana', 'hora_inicio', 'hora_fim',
+                'duracao_consulta', 'ativo', 'criado_em')
+    cache_dependentes = ('grade_horarios',)
+    # Nomes relacionados trazidos por find_with_joins (guardados como _<campo>)
+    NOMES_RELACIONADOS = ('medico_nome', 'local_nome', 'especialidade_nome')
     
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -255,36 +593,98 @@ class HorarioDisponivel(BaseModel):
     
     def get_medico(self) -> Optional['Medico']:
         """Retorna o médico deste horário"""
+        if '_cached_medico' in self.__dict__:
+            return self._cached_medico
         if self.medico_id:
             return Medico.find_by_id(self.medico_id)
         return None
     
     def get_local(self) -> Optional['Local']:
         """Retorna o local deste horário"""
+        if '_cached_local' in self.__dict__:
+            return self._cached_local
         if self.local_id:
-            return Local.find_by_id(self.local_id)
+            return Local.find_by_id_cached(self.local_id)
         return None
     
     def get_dia_semana_nome(self) -> str:
         """Retorna o nome do dia da semana"""
-        dias = ['Segunda', 'Terça', 'Quarta', 'Quinta', 'Sexta', 'Sábado', 'Domingo']
-        return dias[self.dia_semana] if 0 <= self.dia_semana < len(dias) else 'N/A'
+        return DIAS_SEMANA[self.dia_semana] if 0 <= self.dia_semana < 7 else 'N/A'
+    
+    @classmethod
+    def find_with_joins(cls, conditions: Dict[str, Any]) -> List['HorarioDisponivel']:
+        """Busca horários já com os nomes de médico, local e especialidade do médico
+        (uma consulta com JOIN): to_dict não consulta as outras tabelas"""
+        where_clause = ' AND '.join([f"h.{key} = ?" for key in conditions.keys()])
+        query = f"""
+            SELECT h.*, m.nome AS medico_nome, l.nome AS local_nome,
+                   e.nome AS especialidade_nome
+            FROM {cls.table_name} h
+            LEFT JOIN medicos m ON m.id = h.medico_id
+            LEFT JOIN locais l ON l.id = h.local_id
+            LEFT JOIN especialidades e ON e.id = m.especialidade_id
+            WHERE {where_clause}
+        """
+        horarios = []
+        for item in db.execute_query(query, tuple(conditions.values()), como_dict=True):
+            nomes = [(f'_{campo}', item.pop(campo)) for campo in cls.NOMES_RELACIONADOS]
+            horario = cls(**item)
+            for atributo, nome in nomes:
+                setattr(horario, atributo, nome)
+            horarios.append(horario)
+        return horarios
+    
+    @classmethod
+    def find_grade(cls, especialidade_id: int, local_id: int) -> List[Any]:
+        """Médicos ativos da especialidade com seus horários no local (cache TTL)"""
+        chave = ('grade_horarios', especialidade_id, local_id)
+        rows = _cache_obter(chave)
+        if rows is None:
+            query = """
+                SELECT m.*, h.* FROM medicos m
+                JOIN horarios_disponiveis h ON m.id = h.medico_id
+                WHERE m.especialidade_id = ? AND h.local_id = ? AND m.ativo = 1 AND h.ativo = 1
+            """
+            rows = db.execute_query(query, (especialidade_id, local_id))
+            _cache_salvar(chave, rows, GRADE_CACHE_TTL_SEGUNDOS)
+        return list(rows)
+    
+    @classmethod
+    def atende(cls, medico_id: int, local_id: int, data: date, hora: str) -> bool:
+        """Confere no banco (sem cache) se o médico está ativo e tem horário
+        ativo no local cobrindo a data e a hora ('HH:MM')"""
+        query = f"""
+            SELECT 1 FROM {cls.table_name} h
+            JOIN medicos m ON m.id = h.medico_id
+            WHERE h.medico_id = ? AND h.local_id = ? AND h.dia_semana = ?
+            AND h.ativo = 1 AND m.ativo = 1
+            AND substr(h.hora_inicio, 1, 5) <= ? AND substr(h.hora_fim, 1, 5) > ?
+            LIMIT 1
+        """
+        return bool(db.execute_query(query, (medico_id, local_id, data.weekday(), hora, hora)))
     
     def to_dict(self):
         data = super().to_dict()
-        medico = self.get_medico()
-        local = self.get_local()
-        
-        data['medico_nome'] = medico.nome if medico else 'N/A'
-        data['local_nome'] = local.nome if local else 'N/A'
         data['dia_semana_nome'] = self.get_dia_semana_nome()
         
-        # Adicionar especialidade do médico
-        if medico:
-            especialidade = medico.get_especialidade()
-            data['especialidade_nome'] = especialidade.nome if especialidade else 'N/A'
+        if hasattr(self, '_medico_nome'):
+            # Nomes já trazidos pelo JOIN de find_with_joins
+            for campo in self.NOMES_RELACIONADOS:
+                nome = getattr(self, f'_{campo}')
+                data[campo] = nome if nome is not None else 'N/A'
         else:
-            data['especialidade_nome'] = 'N/A'
+            medico = self.get_medico()
+            local = self.get_local()
+            
+            data['medico_nome'] = medico.nome if medico else 'N/A'
+            data['local_nome'] = local.nome if local else 'N/A'
+            
+            # Adicionar especialidade do médico
+            if medico:
+                especialidade = medico.get_especialidade()
+                data['especialidade_nome'] = especialidade.nome if especialidade else 'N/A'
+            else:
+                data['especialidade_nome'] = 'N/A'
         
         # Formatar horários
         if self.hora_inicio:
@@ -304,6 +704,11 @@ class HorarioDisponivel(BaseModel):
 class Agendamento(BaseModel):
     """Modelo para agendamentos médicos"""
     table_name = "agendamentos"
+    _COLUMNS = ('id', 'paciente_id', 'medico_id', 'especialidade_id', 'local_id', 'data', 'hora',
+                'observacoes', 'status', 'anexo_nome', 'anexo_path', 'criado_em', 'cancelado_em',
+                'motivo_cancelamento')
+    # Nomes relacionados trazidos por find_with_joins (guardados como _<campo>)
+    NOMES_RELACIONADOS = ('paciente_nome', 'medico_nome', 'especialidade_nome', 'local_nome')
     
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -324,28 +729,91 @@ class Agendamento(BaseModel):
     
     def get_paciente(self) -> Optional['Paciente']:
         """Retorna o paciente do agendamento"""
+        if '_cached_paciente' in self.__dict__:
+            return self._cached_paciente
         if self.paciente_id:
             return Paciente.find_by_id(self.paciente_id)
         return None
     
     def get_medico(self) -> Optional['Medico']:
         """Retorna o médico do agendamento"""
+        if '_cached_medico' in self.__dict__:
+            return self._cached_medico
         if self.medico_id:
             return Medico.find_by_id(self.medico_id)
         return None
     
     def get_especialidade(self) -> Optional['Especialidade']:
         """Retorna a especialidade do agendamento"""
+        if '_cached_especialidade' in self.__dict__:
+            return self._cached_especialidade
         if self.especialidade_id:
-            return Especialidade.find_by_id(self.especialidade_id)
+            return Especialidade.find_by_id_cached(self.especialidade_id)
         return None
     
     def get_local(self) -> Optional['Local']:
         """Retorna o local do agendamento"""
+        if '_cached_local' in self.__dict__:
+            return self._cached_local
         if self.local_id:
-            return Local.find_by_id(self.local_id)
+            return Local.find_by_id_cached(self.local_id)
         return None
     
+    @classmethod
+    def find_filtrados(cls, data_inicio: str = None, data_fim: str = None,
+                       status: str = None, local_id=None) -> List['Agendamento']:
+        """Busca agendamentos aplicando os filtros da listagem no SQL"""
+        condicoes, params = [], []
+        if data_inicio:
+            condicoes.append("data >= ?")
+            params.append(data_inicio)
+        if data_fim:
+            condicoes.append("data <= ?")
+            params.append(data_fim)
+        if status:
+            condicoes.append("status = ?")
+            params.append(status)
+        if local_id:
+            condicoes.append("local_id = ?")
+            params.append(local_id)
+        
+        query = cls._SQL_SELECT
+        if condicoes:
+            query += " WHERE " + " AND ".join(condicoes)
+        # data e hora são NOT NULL: ordenar direto pelas colunas usa o índice
+        query += " ORDER BY data, hora"
+        rows = db.execute_query(query, tuple(params), como_tupla=True)
+        return [cls._from_row(row) for row in rows]
+    
+    @classmethod
+    def find_with_joins(cls, conditions: Dict[str, Any]) -> List['Agendamento']:
+        """Busca agendamentos já com os nomes de paciente, médico, especialidade
+        e local (view v_agendamentos_nomes): to_dict não consulta as outras tabelas"""
+        where_clause = ' AND '.join([f"{key} = ?" for key in conditions.keys()])
+        query = f"SELECT * FROM v_agendamentos_nomes WHERE {where_clause}"
+        agendamentos = []
+        for item in db.execute_query(query, tuple(conditions.values()), como_dict=True):
+            nomes = [(f'_{campo}', item.pop(campo)) for campo in cls.NOMES_RELACIONADOS]
+            agendamento = cls(**item)
+            for atributo, nome in nomes:
+                setattr(agendamento, atributo, nome)
+            agendamentos.append(agendamento)
+        return agendamentos
+    
+    @staticmethod
+    def carregar_relacionados(agendamentos: List['Agendamento']) -> List['Agendamento']:
+        """Preenche paciente_rel, medico_rel, especialidade_rel e local_rel
+        com uma consulta por tabela (em vez de quatro por agendamento)"""
+        relacoes = (('paciente', 'paciente_id', Paciente),
+                    ('medico', 'medico_id', Medico),
+                    ('especialidade', 'especialidade_id', Especialidade),
+                    ('local', 'local_id', Local))
+        for atributo, campo, modelo in relacoes:
+            BaseModel.preload_relations(agendamentos, atributo, modelo, campo)
+            for agendamento in agendamentos:
+                setattr(agendamento, f'{atributo}_rel', getattr(agendamento, f'_cached_{atributo}'))
+        return agendamentos
+    
     @classmethod
     def find_by_date(cls, data: date) -> List['Agendamento']:
         """Busca agendamentos por data"""
@@ -355,39 +823,83 @@ class Agendamento(BaseModel):
     def find_active_for_today(cls) -> List['Agendamento']:
         """Busca agendamentos ativos para hoje"""
         today = date.today().isoformat()
-        query = f"SELECT * FROM {cls.table_name} WHERE data = ? AND status = 'agendado'"
-        rows = db.execute_query(query, (today,))
-        return [cls(**dict(row)) for row in rows]
+        query = f"{cls._SQL_SELECT} WHERE data = ? AND status = 'agendado'"
+        rows = db.execute_query(query, (today,), como_tupla=True)
+        return [cls._from_row(row) for row in rows]
+    
+    @classmethod
+    def count_active_for_today(cls) -> int:
+        """Conta agendamentos ativos para hoje"""
+        today = date.today().isoformat()
+        query = f"SELECT COUNT(*) AS total FROM {cls.table_name} WHERE data = ? AND status = 'agendado'"
+        return db.execute_query(query, (today,))[0]['total']
+    
+    @classmethod
+    def count_by_status_for_paciente(cls, paciente_id: int) -> Dict[str, int]:
+        """Conta os agendamentos do paciente por status ({status: total})"""
+        query = f"SELECT status, COUNT(*) AS total FROM {cls.table_name} WHERE paciente_id = ? GROUP BY status"
+        return {row['status']: row['total'] for row in db.execute_query(query, (paciente_id,))}
+    
+    @classmethod
+    def estatisticas_por_especialidade(cls) -> List[Dict[str, Any]]:
+        """Totais por status de cada especialidade que tem agendamentos"""
+        query = f"""
+            SELECT e.nome AS especialidade,
+                   COUNT(*) AS total,
+                   SUM(a.status = 'agendado') AS agendados,
+                   SUM(a.status = 'concluido') AS concluidos,
+                   SUM(a.status = 'cancelado') AS cancelados
+            FROM {cls.table_name} a
+            JOIN especialidades e ON e.id = a.especialidade_id
+            GROUP BY e.id
+            ORDER BY e.id
+        """
+        return db.execute_query(query, como_dict=True)
+    
+    @classmethod
+    def historico_paciente(cls, paciente_id: int, limite: int = None) -> List[Dict[str, Any]]:
+        """Histórico do paciente (mais recente primeiro) com os nomes de
+        especialidade e médico já resolvidos pela view v_agendamentos_nomes"""
+        query = """
+            SELECT data, hora, status, especialidade_nome, medico_nome
+            FROM v_agendamentos_nomes
+            WHERE paciente_id = ?
+            ORDER BY data DESC, id
+        """
+        if limite is not None:
+            query += f" LIMIT {int(limite)}"
+        return db.execute_query(query, (paciente_id,), como_dict=True)
     
     def cancelar(self, motivo: str = ''):
         """Cancela o agendamento"""
-        self.status = 'cancelado'
-        self.cancelado_em = datetime.utcnow().isoformat()
-        self.motivo_cancelamento = motivo
-        self.save()
+        self.update_fields(status='cancelado',
+                           cancelado_em=datetime.utcnow().isoformat(),
+                           motivo_cancelamento=motivo)
     
     def to_dict(self):
         data = super().to_dict()
         
-        # Buscar dados relacionados
-        paciente = self.get_paciente()
-        medico = self.get_medico()
-        especialidade = self.get_especialidade()
-        local = self.get_local()
-        
-        data['paciente_nome'] = paciente.nome if paciente else 'N/A'
-        data['medico_nome'] = medico.nome if medico else 'N/A'
-        data['especialidade_nome'] = especialidade.nome if especialidade else 'N/A'
-        data['local_nome'] = local.nome if local else 'N/A'
+        if hasattr(self, '_paciente_nome'):
+            # Nomes já trazidos pelo JOIN de find_with_joins
+            for campo in self.NOMES_RELACIONADOS:
+                nome = getattr(self, f'_{campo}')
+                data[campo] = nome if nome is not None else 'N/A'
+        else:
+            # Buscar dados relacionados
+            paciente = self.get_paciente()
+            medico = self.get_medico()
+            especialidade = self.get_especialidade()
+            local = self.get_local()
+            
+            data['paciente_nome'] = paciente.nome if paciente else 'N/A'
+            data['medico_nome'] = medico.nome if medico else 'N/A'
+            data['especialidade_nome'] = especialidade.nome if especialidade else 'N/A'
+            data['local_nome'] = local.nome if local else 'N/A'
         
         # Formatar data
         if self.data:
             if isinstance(self.data, str):
-                try:
-                    dt = datetime.strptime(self.data, '%Y-%m-%d').date()
-                    data['data'] = dt.strftime('%d/%m/%Y')
-                except:
-                    data['data'] = self.data
+                data['data'] = _data_iso_para_br(self.data)
             else:
                 data['data'] = self.data.strftime('%d/%m/%Y')
         
@@ -402,7 +914,7 @@ class Agendamento(BaseModel):
         if self.criado_em:
             if isinstance(self.criado_em, str):
                 try:
-                    dt = datetime.fromisoformat(self.criado_em.replace('Z', '+00:00'))
+                    dt = datetime.fromisoformat(self.criado_em)  # aceita o sufixo 'Z' (Python 3.11+)
                     data['criado_em'] = dt.strftime('%d/%m/%Y %H:%M')
                 except:
                     data['criado_em'] = self.criado_em
@@ -412,6 +924,8 @@ class Agendamento(BaseModel):
 class Conversa(BaseModel):
     """Modelo para manter estado das conversas do chatbot"""
     table_name = "conversas"
+    _COLUMNS = ('id', 'session_id', 'paciente_id', 'estado', 'dados_temporarios', 'criado_em',
+                'atualizado_em')
     
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -428,23 +942,54 @@ class Conversa(BaseModel):
         """Busca conversa por session ID"""
         return cls.find_one_where({'session_id': session_id})
     
+    @classmethod
+    def delete_abandonadas(cls, data_limite: str, limite: int) -> int:
+        """Exclui até `limite` conversas não finalizadas sem atividade desde
+        data_limite, em um único DELETE; retorna quantas foram removidas"""
+        query = f"""
+            DELETE FROM {cls.table_name} WHERE id IN (
+                SELECT id FROM {cls.table_name}
+                WHERE atualizado_em < ? AND estado != 'finalizado'
+                LIMIT ?)
+        """
+        removidas = db.execute_update(query, (data_limite, limite))
+        if removidas:
+            cls._limpar_cache()
+        return removidas
+    
+    def save(self):
+        """Atualiza a conversa; na primeira gravação, insere o registro"""
+        if self.id:
+            return super().save()
+        campos = {k: v for k, v in self.__dict__.items()
+                  if not k.startswith('_') and v is not None}
+        self.id = type(self).create(**campos).id
+    
     def get_dados(self) -> Dict[str, Any]:
-        """Retorna dados temporários como dicionário"""
+        """Retorna dados temporários como dicionário (decodificado uma vez por texto)"""
+        # (texto, dicionário) do último get_dados/set_dados; vale enquanto o texto não mudar
+        cache = getattr(self, '_dados_cache', None)
+        if cache is not None and cache[0] is self.dados_temporarios:
+            return cache[1]
+        dados = {}
         if self.dados_temporarios:
             try:
-                return json.loads(self.dados_temporarios)
+                dados = _json_loads(self.dados_temporarios)
             except:
-                return {}
-        return {}
+                dados = {}
+        self._dados_cache = (self.dados_temporarios, dados)
+        return dados
     
     def set_dados(self, dados: Dict[str, Any]):
         """Define dados temporários a partir de dicionário"""
-        self.dados_temporarios = json.dumps(dados)
+        self.dados_temporarios = _json_dumps(dados)
+        self._dados_cache = (self.dados_temporarios, dados)
         self.atualizado_em = datetime.utcnow().isoformat()
 
 class Configuracao(BaseModel):
     """Modelo para configurações do sistema"""
     table_name = "configuracoes"
+    _COLUMNS = ('id', 'chave', 'valor', 'descricao', 'atualizado_em')
     
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -454,11 +999,39 @@ class Configuracao(BaseModel):
         self.descricao = kwargs.get('descricao', '')
         self.atualizado_em = kwargs.get('atualizado_em')
     
+    # Lidas sempre do banco: uma troca de senha vale na hora em todos os workers
+    CHAVES_SEM_CACHE = ('senha_admin',)
+    
+    @classmethod
+    def _carregar_valores(cls) -> Dict[str, str]:
+        """Carrega todas as configurações em uma única consulta (com cache,
+        exceto CHAVES_SEM_CACHE)"""
+        chave_cache = (cls.table_name, 'valores')
+        valores = _cache_obter(chave_cache)
+        if valores is None:
+            rows = db.execute_query(f"SELECT chave, valor FROM {cls.table_name}")
+            valores = {row['chave']: row['valor'] for row in rows
+                       if row['chave'] not in cls.CHAVES_SEM_CACHE}
+            _cache_salvar(chave_cache, valores)
+        return valores
+    
     @classmethod
     def get_valor(cls, chave: str, padrao: str = '') -> str:
         """Obtém valor de uma configuração"""
-        config = cls.find_one_where({'chave': chave})
-        return config.valor if config else padrao
+        if chave in cls.CHAVES_SEM_CACHE:
+            rows = db.execute_query(
+                f"SELECT valor FROM {cls.table_name} WHERE chave = ?", (chave,))
+            return rows[0]['valor'] if rows else padrao
+        valores = cls._carregar_valores()
+        return valores[chave] if chave in valores else padrao
+    
+    @classmethod
+    def get_muitos(cls, padroes: Dict[str, str]) -> Dict[str, str]:
+        """Obtém várias configurações de uma vez ({chave: padrão} -> {chave: valor})"""
+        valores = cls._carregar_valores()
+        return {chave: cls.get_valor(chave, padrao) if chave in cls.CHAVES_SEM_CACHE
+                else valores[chave] if chave in valores else padrao
+                for chave, padrao in padroes.items()}
     
     @classmethod
     def set_valor(cls, chave: str, valor: str, descricao: str = '') -> 'Configuracao':
@@ -482,6 +1055,9 @@ class Configuracao(BaseModel):
 class ArquivoPaciente(BaseModel):
     """Modelo para arquivos anexados pelos pacientes"""
     table_name = "arquivos_pacientes"
+    _COLUMNS = ('id', 'paciente_id', 'agendamento_id', 'nome_original', 'nome_arquivo',
+                'caminho_arquivo', 'tipo_arquivo', 'tamanho_arquivo', 'descricao', 'hash_conteudo',
+                'criado_em')
     
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -494,10 +1070,13 @@ class ArquivoPaciente(BaseModel):
         self.tipo_arquivo = kwargs.get('tipo_arquivo', '')
         self.tamanho_arquivo = kwargs.get('tamanho_arquivo', 0)
         self.descricao = kwargs.get('descricao', '')
+        self.hash_conteudo = kwargs.get('hash_conteudo')  # SHA-256 do conteúdo
         self.criado_em = kwargs.get('criado_em')
     
     def get_paciente(self) -> Optional['Paciente']:
         """Retorna o paciente dono do arquivo"""
+        if '_cached_paciente' in self.__dict__:
+            return self._cached_paciente
         if self.paciente_id:
             return Paciente.find_by_id(self.paciente_id)
         return None
@@ -508,6 +1087,11 @@ class ArquivoPaciente(BaseModel):
             return Agendamento.find_by_id(self.agendamento_id)
         return None
     
+    @classmethod
+    def find_by_hash(cls, hash_conteudo: str) -> Optional['ArquivoPaciente']:
+        """Busca um arquivo já armazenado com o mesmo conteúdo"""
+        return cls.find_one_where({'hash_conteudo': hash_conteudo})
+    
     @classmethod
     def find_by_paciente(cls, paciente_id: int) -> List['ArquivoPaciente']:
         """Busca arquivos de um paciente"""
@@ -539,6 +1123,8 @@ class ArquivoPaciente(BaseModel):
 class AgendamentoRecorrente(BaseModel):
     """Modelo para agendamentos recorrentes semanais"""
     table_name = "agendamentos_recorrentes"
+    _COLUMNS = ('id', 'paciente_id', 'medico_id', 'especialidade_id', 'local_id', 'dia_semana',
+                'hora', 'data_inicio', 'data_fim', 'ativo', 'observacoes', 'criado_em')
     
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -557,8 +1143,7 @@ class AgendamentoRecorrente(BaseModel):
     
     def get_dia_semana_nome(self) -> str:
         """Retorna o nome do dia da semana"""
-        dias = ['Segunda', 'Terça', 'Quarta', 'Quinta', 'Sexta', 'Sábado', 'Domingo']
-        return dias[self.dia_semana] if 0 <= self.dia_semana < len(dias) else 'N/A'
+        return DIAS_SEMANA[self.dia_semana] if 0 <= self.dia_semana < 7 else 'N/A'
     
     def to_dict(self):
         data = super().to_dict()
@@ -574,22 +1159,32 @@ class AgendamentoRecorrente(BaseModel):
         # Formatar datas
         if self.data_inicio:
             if isinstance(self.data_inicio, str):
-                try:
-                    dt = datetime.strptime(self.data_inicio, '%Y-%m-%d').date()
-                    data['data_inicio'] = dt.strftime('%d/%m/%Y')
-                except:
-                    data['data_inicio'] = self.data_inicio
+                data['data_inicio'] = _data_iso_para_br(self.data_inicio)
         
         if self.data_fim:
             if isinstance(self.data_fim, str):
-                try:
-                    dt = datetime.strptime(self.data_fim, '%Y-%m-%d').date()
-                    data['data_fim'] = dt.strftime('%d/%m/%Y')
-                except:
-                    data['data_fim'] = 'Indefinido'
+                data['data_fim'] = _data_iso_para_br(self.data_fim, 'Indefinido')
             else:
                 data['data_fim'] = self.data_fim.strftime('%d/%m/%Y')
         else:
             data['data_fim'] = 'Indefinido'
         
-        return data
\ No newline at end of file
+        return data
+class AuditoriaIntencao(BaseModel):
+    """Modelo para a auditoria das intenções classificadas sem a IA"""
+    table_name = "auditoria_intencoes"
+    _COLUMNS = ('id', 'mensagem', 'tipo_previsto', 'tipo_ia', 'origem', 'criado_em')
+    
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.id = kwargs.get('id')
+        self.mensagem = kwargs.get('mensagem', '')
+        self.tipo_previsto = kwargs.get('tipo_previsto', '')
+        self.tipo_ia = kwargs.get('tipo_ia')
+        self.origem = kwargs.get('origem', '')
+        self.criado_em = kwargs.get('criado_em')
+    
+    @property
+    def divergente(self) -> bool:
+        """Indica se a IA discordou da classificação original"""
+        return bool(self.tipo_ia) and self.tipo_ia != self.tipo_previsto
@@ -0,0 +1,15 @@
+"""Testes do sistema de agendamento (python -m unittest, a partir da raiz)
+
+Os módulos criam o banco, o log e a pasta de uploads com caminhos relativos
+ao diretório atual; os testes rodam em um diretório temporário para não
+tocar no sistema_agendamento.db do projeto."""
+import os
+import sys
+import tempfile
+
+RAIZ_PROJETO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if RAIZ_PROJETO not in sys.path:
+    sys.path.insert(0, RAIZ_PROJETO)
+
+DIRETORIO_TESTES = tempfile.mkdtemp(prefix='agendamento-testes-')
+os.chdir(DIRETORIO_TESTES)
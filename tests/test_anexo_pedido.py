@@ -0,0 +1,196 @@
+import io
+import logging
+import os
+import re
+import secrets
+import unittest
+from datetime import date, timedelta
+from unittest import mock
+
+from itsdangerous import URLSafeTimedSerializer
+
+import ai_service
+import app as app_module
+from database import db
+from models import (Agendamento, ArquivoPaciente, Conversa, Especialidade, HorarioDisponivel,
+                    Local, Medico, Paciente)
+
+LINK_ANEXO_RE = re.compile(r'/anexar-pedido/\S+')
+
+
+def _proxima_segunda():
+    hoje = date.today() + timedelta(days=7)
+    return hoje + timedelta(days=-hoje.weekday())
+
+
+class TestAnexoPedido(unittest.TestCase):
+    """Link de upload do pedido médico (/anexar-pedido/<token>)"""
+
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.CRITICAL)
+        app_module.app.config['TESTING'] = True
+        cls.pasta_uploads = app_module.app.config['UPLOAD_FOLDER'] = os.path.abspath('uploads-testes')
+        os.makedirs(cls.pasta_uploads, exist_ok=True)
+
+        sufixo = secrets.token_hex(3)
+        cls.especialidade = Especialidade.create(nome=f'Ortopedia {sufixo}', requer_anexo=True)
+        cls.local = Local.create(nome=f'Unidade {sufixo}')
+        cls.medico = Medico.create(nome='Dr. Teste', crm=f'CRM{sufixo}',
+                                   especialidade_id=cls.especialidade.id)
+        cls.data = _proxima_segunda()
+        HorarioDisponivel.create(medico_id=cls.medico.id, local_id=cls.local.id,
+                                 dia_semana=cls.data.weekday(), hora_inicio='08:00',
+                                 hora_fim='12:00', duracao_consulta=30)
+
+    @classmethod
+    def tearDownClass(cls):
+        logging.disable(logging.NOTSET)
+
+    def setUp(self):
+        self.cliente = app_module.app.test_client()
+        paciente = Paciente.create(cpf=secrets.token_hex(6), nome='Paciente Teste',
+                                   data_nascimento='1990-03-15', telefone='31999998888')
+        session_id = secrets.token_hex(8)
+        self.conversa = Conversa.create(
+            session_id=session_id, paciente_id=paciente.id, estado='solicitacao_anexo',
+            dados_temporarios='{}')
+        self.conversa.set_dados({
+            'medico_id': self.medico.id,
+            'medico_nome': self.medico.nome,
+            'especialidade_id': self.especialidade.id,
+            'especialidade_nome': self.especialidade.nome,
+            'local_id': self.local.id,
+            'data_agendamento': self.data.isoformat(),
+            'hora_agendamento': '08:00',
+            'data_formatada': self.data.strftime('%d/%m/%Y'),
+            'hora_formatada': '08:00',
+        })
+        self.conversa.save()
+        with self.cliente.session_transaction() as sessao:
+            sessao['chat_session_id'] = session_id
+
+    def _chat(self, mensagem):
+        return self.cliente.post('/chat', json={'mensagem': mensagem}).get_json()
+
+    def _link(self):
+        return LINK_ANEXO_RE.search(self._chat('link')['message']).group(0)
+
+    def _enviar(self, link, nome='pedido.pdf'):
+        return self.cliente.post(link, data={'arquivo': (io.BytesIO(nome.encode()), nome)},
+                                 content_type='multipart/form-data')
+
+    def _agendamentos_do_horario(self):
+        return Agendamento.find_where({'medico_id': self.medico.id,
+                                       'data': self.data.isoformat(), 'hora': '08:00'})
+
+    def _arquivos_do_paciente(self):
+        return ArquivoPaciente.find_where({'paciente_id': self.conversa.paciente_id})
+
+    def _aguardar_remocoes(self):
+        # Executor de um único worker: uma tarefa vazia termina depois das anteriores
+        app_module._executor_remocao.submit(lambda: None).result()
+
+    def tearDown(self):
+        for agendamento in self._agendamentos_do_horario():
+            db.execute_update("UPDATE arquivos_pacientes SET agendamento_id = NULL WHERE agendamento_id = ?",
+                              (agendamento.id,))
+            agendamento.delete()
+
+    def test_upload_guarda_arquivo_sem_criar_agendamento(self):
+        resposta = self._enviar(self._link())
+
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual(self._agendamentos_do_horario(), [])
+        arquivos = self._arquivos_do_paciente()
+        self.assertEqual(len(arquivos), 1)
+        self.assertIsNone(arquivos[0].agendamento_id)
+        dados = Conversa.find_by_id(self.conversa.id).get_dados()
+        self.assertEqual(dados['arquivo_id'], arquivos[0].id)
+        self.assertEqual(dados['anexo_path'], arquivos[0].caminho_arquivo)
+
+    def test_link_vale_para_um_unico_envio(self):
+        link = self._link()
+        self.assertEqual(self._enviar(link, 'a.pdf').status_code, 200)
+        arquivos_na_pasta = set(os.listdir(self.pasta_uploads))
+
+        resposta = self._enviar(link, 'b.pdf')
+        self._aguardar_remocoes()
+
+        self.assertEqual(resposta.status_code, 302)
+        self.assertEqual([a.nome_original for a in self._arquivos_do_paciente()], ['a.pdf'])
+        self.assertEqual(set(os.listdir(self.pasta_uploads)), arquivos_na_pasta)
+
+    def test_recusa_quando_horario_da_conversa_mudou(self):
+        link = self._link()
+        dados = self.conversa.get_dados()
+        dados['hora_agendamento'] = '09:00'
+        self.conversa.set_dados(dados)
+        self.conversa.save()
+        arquivos_na_pasta = set(os.listdir(self.pasta_uploads))
+
+        resposta = self._enviar(link)
+        self._aguardar_remocoes()
+
+        self.assertEqual(resposta.status_code, 302)
+        self.assertEqual(self._arquivos_do_paciente(), [])
+        self.assertEqual(set(os.listdir(self.pasta_uploads)), arquivos_na_pasta)
+
+    def test_recusa_quando_conversa_finalizada(self):
+        link = self._link()
+        self.conversa.estado = 'finalizado'
+        self.conversa.save()
+
+        self.assertEqual(self._enviar(link).status_code, 302)
+        self.assertEqual(self._arquivos_do_paciente(), [])
+
+    def test_confirmacao_cria_agendamento_e_vincula_arquivo(self):
+        self.assertEqual(self._enviar(self._link()).status_code, 200)
+
+        self.assertEqual(self._chat('enviei')['proximo_estado'], 'confirmacao')
+        resposta = self._chat('sim')
+
+        self.assertEqual(resposta['proximo_estado'], 'finalizado')
+        agendamentos = self._agendamentos_do_horario()
+        self.assertEqual(len(agendamentos), 1)
+        self.assertEqual(agendamentos[0].id, resposta['agendamento_id'])
+        self.assertEqual(agendamentos[0].status, 'agendado')
+        self.assertEqual(agendamentos[0].anexo_nome, 'pedido.pdf')
+        arquivo = self._arquivos_do_paciente()[0]
+        self.assertEqual(arquivo.agendamento_id, agendamentos[0].id)
+
+    def test_enviei_sem_arquivo_reenvia_link(self):
+        resposta = self._chat('enviei')
+
+        self.assertEqual(resposta['proximo_estado'], 'solicitacao_anexo')
+        self.assertRegex(resposta['message'], LINK_ANEXO_RE)
+
+    def test_token_forjado(self):
+        # Mesmo conteúdo de um link válido, assinado com outra chave
+        forjado = '/anexar-pedido/' + URLSafeTimedSerializer(
+            'outra-chave', salt=ai_service.ANEXO_TOKEN_SALT).dumps({
+                'conversa_id': self.conversa.id,
+                'uso': secrets.token_hex(8),
+                'selecao': {'paciente_id': self.conversa.paciente_id,
+                            'medico_id': self.medico.id,
+                            'especialidade_id': self.especialidade.id,
+                            'local_id': self.local.id,
+                            'data': self.data.isoformat(), 'hora': '08:00'},
+            })
+
+        self.assertEqual(self.cliente.get('/anexar-pedido/abc').status_code, 302)
+        self.assertEqual(self.cliente.get(forjado).status_code, 302)
+        self.assertEqual(self._enviar(forjado).status_code, 302)
+        self.assertEqual(self._arquivos_do_paciente(), [])
+
+    def test_token_expirado(self):
+        link = self._link()
+
+        with mock.patch.object(ai_service, 'ANEXO_TOKEN_VALIDADE', -1):
+            self.assertEqual(self.cliente.get(link).status_code, 302)
+            self.assertEqual(self._enviar(link).status_code, 302)
+        self.assertEqual(self._arquivos_do_paciente(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
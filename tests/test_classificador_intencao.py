@@ -0,0 +1,56 @@
+import logging
+import unittest
+from unittest import mock
+
+import ai_service
+from ai_service import ChatbotService
+from classificador_intencao import classificador_intencao
+
+# Frases reais do chat e a intenção esperada de _detectar_tipo_mensagem
+FRASES_INTENCAO = {
+    'minha filha precisa de consulta': 'agendamento',
+    'tenho consulta com dermatologista': 'agendamento',
+    'consulta': 'agendamento',
+    'quero remarcar minha consulta': 'agendamento',
+    'estou com febre': 'agendamento',
+    'quero ver minhas consultas': 'consulta',
+    'meus agendamentos': 'consulta',
+    'quero cancelar a consulta de amanhã': 'cancelamento',
+    'não vou conseguir ir': 'cancelamento',
+    'qual o endereço da clínica': 'informacao',
+    'me conta uma piada': 'fora_escopo',
+}
+
+
+class TestClassificadorIntencao(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        # Sem Gemini: casos sem margem suficiente caem no fallback das regras
+        patcher = mock.patch.object(ai_service, 'CLASSIFICADOR_GEMINI_ATIVO', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.servico = ChatbotService()
+
+    def test_frases_detectadas(self):
+        for frase, esperado in FRASES_INTENCAO.items():
+            with self.subTest(frase=frase):
+                self.assertEqual(self.servico._detectar_tipo_mensagem(frase), esperado)
+
+    def test_consulta_no_sentido_de_marcar_nao_vai_para_consulta(self):
+        tipo, _, _ = classificador_intencao.classificar('minha filha precisa de consulta')
+        self.assertEqual(tipo, 'agendamento')
+
+    def test_margem_entre_classes(self):
+        tipo, score, margem = classificador_intencao.classificar('qual o endereço da clínica')
+        self.assertEqual(tipo, 'informacao')
+        self.assertGreaterEqual(score, margem)
+        self.assertGreater(margem, 0)
+
+    def test_mensagem_sem_termos_conhecidos(self):
+        self.assertEqual(classificador_intencao.classificar('xyz'), ('agendamento', 0.0, 0.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
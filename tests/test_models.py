@@ -0,0 +1,49 @@
+import secrets
+import unittest
+
+from database import db
+from models import Local
+
+
+class TestBulkCreate(unittest.TestCase):
+
+    def test_ids_e_defaults_com_grupos_de_colunas_mistos(self):
+        sufixo = secrets.token_hex(3)
+        registros = [
+            {'nome': f'A {sufixo}'},
+            {'nome': f'B {sufixo}', 'cidade': 'Contagem'},
+            {'nome': f'C {sufixo}'},
+            {'cidade': 'Betim', 'nome': f'D {sufixo}'},
+            {'nome': f'E {sufixo}', 'cidade': 'Contagem', 'telefone': '3133334444'},
+        ]
+
+        criados = Local.bulk_create(registros)
+
+        # Cada objeto retornado corresponde à linha gravada com o mesmo ID
+        self.assertEqual([local.nome for local in criados], [r['nome'] for r in registros])
+        for local, registro in zip(criados, registros):
+            linha = db.execute_query("SELECT nome, cidade, telefone FROM locais WHERE id = ?",
+                                     (local.id,))[0]
+            self.assertEqual(linha['nome'], registro['nome'])
+            self.assertEqual(linha['cidade'], registro.get('cidade'))
+            self.assertEqual(linha['telefone'], registro.get('telefone'))
+        self.assertEqual(len({local.id for local in criados}), len(registros))
+
+    def test_objetos_retornados_completos_como_create(self):
+        criado = Local.bulk_create([{'nome': f'Unidade {secrets.token_hex(3)}'}])[0]
+        unitario = Local.create(nome=f'Unidade {secrets.token_hex(3)}')
+
+        self.assertEqual(criado.to_dict().keys(), unitario.to_dict().keys())
+        self.assertEqual(criado.ativo, unitario.ativo)
+        self.assertIsNotNone(criado.criado_em)
+
+    def test_lista_vazia(self):
+        self.assertEqual(Local.bulk_create([]), [])
+
+    def test_registro_sem_dados(self):
+        with self.assertRaises(ValueError):
+            Local.bulk_create([{'nome': 'X'}, {'id': 1}])
+
+
+if __name__ == '__main__':
+    unittest.main()